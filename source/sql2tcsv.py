@@ -1,27 +1,21 @@
-import re
+import os
+import sys
 
-def parse_schema_sql(sql_path):
-    with open(sql_path, 'r') as f:
-        sql = f.read()
+# The catalog lives with the pipeline modules in src/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+from schema_catalog import load_catalog
 
-    tables = re.findall(r'CREATE TABLE (\w+)\s*\((.*?)\);', sql, re.DOTALL)
+def parse_schema_sql(sql_path, cache_dir='vector_db'):
+    catalog = load_catalog(sql_path, cache_dir)
     records = []
-    for table_name, columns_block in tables:
-        # Split columns by line, ignore empty lines
-        for line in columns_block.split('\n'):
-            line = line.strip()
-            if not line or line.startswith('--'):
-                continue
-            # Extract column name, type, and optional comment
-            m = re.match(r'(\w+)\s+([\w\(\)]+)[^,]*?(?:--\s*(.*))?', line)
-            if m:
-                col, typ, comment = m.groups()
-                comment = comment or ""
-                records.append({
-                    'table_name': table_name,
-                    'column_name': col,
-                    'type': typ,
-                    'description': comment,
-                    'text_for_embedding': f"Table: {table_name}\nColumn: {col}\nType: {typ}\nDescription: {comment}"
-                })
+    for table_name in catalog.table_names():
+        for column in catalog.columns(table_name):
+            col, typ, comment = column['name'], column['type'], column['description']
+            records.append({
+                'table_name': table_name,
+                'column_name': col,
+                'type': typ,
+                'description': comment,
+                'text_for_embedding': f"Table: {table_name}\nColumn: {col}\nType: {typ}\nDescription: {comment}"
+            })
     return records
@@ -1,6 +1,11 @@
 def is_medical_query(user_query):
+    """True if the query is medical-related (see medical_relevance)"""
+    score, threshold = medical_relevance(user_query)
+    return score >= threshold
+
+def medical_relevance(user_query):
     """
-    Determine if a query is related to medical database content with improved accuracy.
+    Score how strongly a query relates to medical database content.
     
     The function uses multiple approaches to identify medical queries:
     1. Medical terminology detection
@@ -13,7 +18,7 @@ def is_medical_query(user_query):
         user_query (str): The user's input query to analyze
         
     Returns:
-        bool: True if the query is medical-related, False otherwise
+        tuple: (score, threshold); the query is medical-related when score >= threshold
     """
     import re
     from collections import Counter
@@ -274,5 +279,5 @@ def is_medical_query(user_query):
     if any(re.search(pattern, normalized_query) for pattern in drug_formulations):
         score += 3
        
-    # Return final decision based on score
-    return score >= threshold
\ No newline at end of file
+    # Return the score with the threshold it is judged against
+    return score, threshold
\ No newline at end of file
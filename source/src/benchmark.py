@@ -0,0 +1,519 @@
+import time
+
+_PROCESS_START = time.perf_counter()
+
+import os
+import re
+import sys
+import json
+import argparse
+import platform
+import resource
+import subprocess
+import zlib
+from db_prepare import same_result
+
+# Memory growth below this is never reported as a regression
+MEMORY_NOISE_MB = 1.0
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def git_commit():
+    """Current git commit, so results can be lined up between commits"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+def parse_slice(spec):
+    """Parse 'start:stop' into a slice (either bound may be empty)"""
+    start, _, stop = spec.partition(':')
+    return slice(int(start) if start else None, int(stop) if stop else None)
+
+def load_rows(dataset_paths, row_slice):
+    """Load (dataset, id, question, gold query) rows from the given CSVs, sliced per file"""
+    import pandas as pd
+    rows = []
+    for path in dataset_paths:
+        df = pd.read_csv(path).dropna(subset=['question'])
+        for _, row in df.iloc[row_slice].iterrows():
+            query = row.get('query')
+            rows.append({
+                'dataset': os.path.basename(path),
+                'id': str(row.get('id', '')),
+                'question': str(row['question']),
+                'query': query if isinstance(query, str) else None
+            })
+    return rows
+
+def oracle_responder(rows):
+    """Stub LLM answering each benchmark question with its gold SQL (ABSTAIN if unanswerable)"""
+    gold = {row['question']: row['query'] for row in rows}
+
+    def respond(prompt):
+        match = re.search(r"User question: (.*)", prompt)
+        sql = gold.get(match.group(1).strip()) if match else None
+        return sql if sql else "ABSTAIN: No gold SQL for this question."
+    return respond
+
+def faulty_responder(responder, error_rate):
+    """Wrap a responder so a fixed share of questions (by hash) get SQL that fails to execute"""
+    def respond(prompt):
+        match = re.search(r"User question: (.*)", prompt)
+        question = match.group(1).strip() if match else prompt
+        if zlib.crc32(question.encode()) % 1000 < error_rate * 1000:
+            return "SELECT * FROM missing_table"
+        return responder(prompt)
+    return respond
+
+def summarize_latencies(latencies):
+    """Latency percentiles (seconds) over a list of samples"""
+    from metrics import StageHistogram
+    histogram = StageHistogram(window=max(1, len(latencies)))
+    for latency in latencies:
+        histogram.observe(latency)
+    return histogram.summary()
+
+def compare_to_baseline(result, baseline, tolerance):
+    """Return the latency (and, when both runs profiled memory, per-stage peak memory) metrics
+    that regressed by more than `tolerance` (fraction) against a baseline"""
+    regressions = []
+    checks = [('warm_latency', key) for key in ('p50', 'p95', 'p99')]
+    checks += [('stages', stage) for stage in result['stages']]
+    for section, key in checks:
+        new = result[section].get(key)
+        old = baseline.get(section, {}).get(key)
+        if isinstance(new, dict):
+            new, old = new.get('p95'), (old or {}).get('p95')
+        if new is None or not old:
+            continue
+        if new > old * (1 + tolerance):
+            regressions.append({'metric': f"{section}.{key}", 'baseline': old, 'current': new, 'unit': 's'})
+    if 'memory' in result and 'memory' in baseline:
+        memory_checks = [(f"memory.stages.{stage}.peak_traced_mb", stats['peak_traced_mb'],
+                          baseline['memory']['stages'].get(stage, {}).get('peak_traced_mb'))
+                         for stage, stats in result['memory']['stages'].items()]
+        memory_checks.append(('memory.peak_rss_mb', result['memory']['peak_rss_mb'], baseline['memory']['peak_rss_mb']))
+        for metric, new, old in memory_checks:
+            # Sub-megabyte stages fluctuate by more than any relative tolerance
+            if old and new > old * (1 + tolerance) and new - old > MEMORY_NOISE_MB:
+                regressions.append({'metric': metric, 'baseline': old, 'current': new, 'unit': 'MB'})
+    return regressions
+
+def run_benchmark(args):
+    """Run the pipeline over the benchmark slice and collect performance figures"""
+    # Cold start: imports, model load and index load are measured separately
+    import_start = time.perf_counter()
+    from main import process_user_query
+    from query_processor import load_embedding_model
+    from similarity_search import load_vector_store, load_bm25_store
+    from llm_backend import StubBackend, HedgedBackend, create_backend, get_backend, set_backend
+    from llm_router import LLMRouter, set_router
+    from metrics import PIPELINE_METRICS
+    from memory_profile import MEMORY_PROFILER
+    from db_executor import InMemoryDatabase
+    from sql_generator import DEFAULT_CONTEXT_TOKEN_BUDGET
+    import_seconds = time.perf_counter() - import_start
+    if args.memory_profile:
+        MEMORY_PROFILER.enable()
+
+    rows = load_rows(args.dataset, parse_slice(args.slice))
+    if not rows:
+        raise SystemExit("No benchmark rows selected")
+
+    if args.llm == 'stub':
+        set_backend(StubBackend(oracle_responder(rows), latency=args.stub_latency,
+                                tail_probability=args.stub_tail_probability, tail_multiplier=args.stub_tail_multiplier))
+    else:
+        set_backend(create_backend('replay', args.cassette, replay_latency=args.replay_latency))
+    if args.hedge_percentile is not None:
+        set_backend(HedgedBackend(get_backend(), percentile=args.hedge_percentile, budget=args.hedge_budget))
+    router = None
+    if args.route:
+        if args.llm == 'stub':
+            fast = StubBackend(faulty_responder(oracle_responder(rows), args.fast_error_rate),
+                               latency=args.fast_stub_latency, model_name='stub-fast')
+        else:
+            fast = create_backend('replay', args.cassette, replay_latency=args.replay_latency,
+                                  model_name=args.fast_model)
+        router = LLMRouter(fast, get_backend(), min_top_score=args.route_min_score)
+    set_router(router)
+
+    model_start = time.perf_counter()
+    model = load_embedding_model() if args.retrieval != 'bm25' else None
+    model_load_seconds = time.perf_counter() - model_start
+
+    index_start = time.perf_counter()
+    if args.retrieval != 'bm25':
+        load_vector_store(args.vector_db)
+    if args.retrieval != 'dense':
+        load_bm25_store(args.vector_db)
+    index_load_seconds = time.perf_counter() - index_start
+
+    token_budget = args.token_budget if args.token_budget is not None else DEFAULT_CONTEXT_TOKEN_BUDGET
+    pool = InMemoryDatabase(args.db) if args.in_memory else None
+
+    def run_one(row):
+        start_time = time.perf_counter()
+        result = process_user_query(row['question'], model, vector_db_dir=args.vector_db, db_path=args.db,
+                                    token_budget=token_budget, retrieval_mode=args.retrieval, pool=pool)
+        return time.perf_counter() - start_time, result
+
+    # First query in a fresh process pays every lazy initialisation
+    cold_query_seconds, _ = run_one(rows[0])
+    time_to_first_result = time.perf_counter() - _PROCESS_START
+    for row in rows[1:1 + args.warmup]:
+        run_one(row)
+
+    PIPELINE_METRICS.reset()
+    MEMORY_PROFILER.reset()
+    if router is not None:
+        router.reset()
+    latencies = []
+    successes = 0
+    prompt_tokens = []
+    warm_start = time.perf_counter()
+    for _ in range(args.repeat):
+        for row in rows:
+            latency, result = run_one(row)
+            latencies.append(latency)
+            successes += int(bool(result['execution_success']))
+            prompt_tokens.append(result['prompt_tokens'])
+    warm_seconds = time.perf_counter() - warm_start
+
+    result = {
+        'config': {
+            'datasets': args.dataset,
+            'slice': args.slice,
+            'rows': len(rows),
+            'repeat': args.repeat,
+            'warmup': args.warmup,
+            'llm': args.llm,
+            'retrieval': args.retrieval,
+            'token_budget': token_budget,
+            'route': args.route,
+            'in_memory': args.in_memory,
+            'hedge_percentile': args.hedge_percentile
+        },
+        'environment': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()
+        },
+        'cold_start': {
+            'import_seconds': import_seconds,
+            'model_load_seconds': model_load_seconds,
+            'index_load_seconds': index_load_seconds,
+            'first_query_seconds': cold_query_seconds,
+            'time_to_first_result_seconds': time_to_first_result
+        },
+        'throughput_qps': len(latencies) / warm_seconds if warm_seconds > 0 else 0.0,
+        'warm_latency': summarize_latencies(latencies),
+        'stages': PIPELINE_METRICS.summary(),
+        'execution_success_rate': successes / len(latencies),
+        'mean_prompt_tokens': sum(prompt_tokens) / len(prompt_tokens),
+        'peak_rss_mb': peak_rss_mb()
+    }
+    if router is not None:
+        result['routes'] = router.summary()
+    if args.hedge_percentile is not None:
+        result['hedging'] = get_backend().summary()
+    if args.memory_profile:
+        result['memory'] = MEMORY_PROFILER.report()
+    return result
+
+def run_retrieval_benchmark(args):
+    """Compare dense (encoder + FAISS) and BM25 retrieval latency and top-k overlap"""
+    from query_processor import load_embedding_model, vectorize_user_query
+    from similarity_search import load_vector_store, load_bm25_store
+
+    rows = load_rows(args.dataset, parse_slice(args.slice))
+    start_time = time.perf_counter()
+    model = load_embedding_model()
+    model_load_seconds = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    dense = load_vector_store(args.vector_db)
+    dense_load_seconds = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    lexical = load_bm25_store(args.vector_db)
+    bm25_load_seconds = time.perf_counter() - start_time
+
+    k = args.top_k
+    dense_latencies, bm25_latencies = [], []
+    overlap = {'schema': [], 'train': []}
+    for row in rows:
+        start_time = time.perf_counter()
+        embedding = vectorize_user_query(row['question'], model)
+        dense_ids = {name: set(dense[f'{name}_index'].search(embedding, k)[1][0].tolist()) for name in overlap}
+        dense_latencies.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        bm25_ids = {name: set(lexical[f'{name}_bm25'].search(row['question'], k)[0].tolist()) for name in overlap}
+        bm25_latencies.append(time.perf_counter() - start_time)
+
+        for name in overlap:
+            overlap[name].append(len(dense_ids[name] & bm25_ids[name]) / k)
+
+    return {
+        'config': {'datasets': args.dataset, 'slice': args.slice, 'rows': len(rows), 'top_k': k},
+        'environment': {'commit': git_commit(), 'python': platform.python_version()},
+        'load_seconds': {'model': model_load_seconds, 'dense_index': dense_load_seconds, 'bm25_index': bm25_load_seconds},
+        'dense_latency': summarize_latencies(dense_latencies),
+        'bm25_latency': summarize_latencies(bm25_latencies),
+        'overlap_at_k': {name: sum(values) / len(values) for name, values in overlap.items()},
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+def run_db_benchmark(args):
+    """Execute the gold SQL of the benchmark rows per query connection, on pooled file connections and in memory
+
+    Every mode runs the same queries with --db-threads threads; results are
+    compared with the file-backed ones.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from db_executor import execute_sql_query, SQLiteConnectionPool, InMemoryDatabase
+
+    rows = load_rows(args.dataset, parse_slice(args.slice))
+    queries = [row['query'] for row in rows if row['query']] * args.repeat
+    if not queries:
+        raise SystemExit("No gold SQL in the benchmark rows")
+
+    start_time = time.perf_counter()
+    memory = InMemoryDatabase(args.db, size=args.db_threads)
+    memory_load_seconds = time.perf_counter() - start_time
+    memory_image_mb = memory.image_bytes / (1024 * 1024)
+    pools = {'connect': None, 'file_pool': SQLiteConnectionPool(args.db, size=args.db_threads), 'memory': memory}
+
+    def timed(pool, sql):
+        start_time = time.perf_counter()
+        result = execute_sql_query(sql, args.db, pool=pool)
+        return time.perf_counter() - start_time, result
+
+    modes = {}
+    reference = None
+    try:
+        for mode, pool in pools.items():
+            # One untimed pass warms the page cache and the rewrite profile for every mode alike
+            for sql in queries[:len(queries) // args.repeat]:
+                execute_sql_query(sql, args.db, pool=pool)
+            start_time = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.db_threads) as executor:
+                outcomes = list(executor.map(lambda sql: timed(pool, sql), queries))
+            wall_seconds = time.perf_counter() - start_time
+            results = [result for _, result in outcomes]
+            if reference is None:
+                reference = results
+            mismatches = sum(not (a['success'] == b['success'] and
+                                  (same_result(a['data'], b['data']) if a['success'] else a['error'] == b['error']))
+                             for a, b in zip(reference, results))
+            modes[mode] = {'latency': summarize_latencies([latency for latency, _ in outcomes]),
+                           'queries_per_second': len(queries) / wall_seconds, 'mismatches': mismatches}
+    finally:
+        for pool in pools.values():
+            if pool is not None:
+                pool.close()
+
+    return {
+        'config': {'datasets': args.dataset, 'slice': args.slice, 'queries': len(queries), 'threads': args.db_threads,
+                   'db': args.db},
+        'environment': {'commit': git_commit(), 'python': platform.python_version(), 'cpu_count': os.cpu_count()},
+        'memory_load_seconds': memory_load_seconds,
+        'memory_image_mb': memory_image_mb,
+        'modes': modes,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+def process_memory_mb(pid):
+    """RSS, PSS (shared pages split between their users) and private memory of a process, in MB (Linux)"""
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if value.strip().endswith('kB'):
+                    fields[name] = int(value.split()[0]) / 1024
+    except OSError:
+        return None
+    return {
+        'rss': fields.get('Rss', 0.0),
+        'pss': fields.get('Pss', 0.0),
+        'private': fields.get('Private_Clean', 0.0) + fields.get('Private_Dirty', 0.0)
+    }
+
+def _index_worker(vector_db, mmap, searches, ready, release):
+    """Load the vector store like a pipeline worker, search it, report, then hold it until released"""
+    start_time = time.perf_counter()
+    import numpy as np
+    from similarity_search import load_vector_store
+    store = load_vector_store(vector_db, mmap)
+    load_seconds = time.perf_counter() - start_time
+    indexes = [store['schema_index'], store['train_templates']['index'] if 'train_templates' in store
+               else store['train_index']]
+    rng = np.random.default_rng(os.getpid())
+    # Flat search reads every vector, so the whole index is resident afterwards
+    for index in indexes:
+        queries = rng.standard_normal((searches, index.d)).astype(np.float32)
+        index.search(queries, 5)
+    ready.put({'pid': os.getpid(), 'load_seconds': load_seconds,
+               'startup_seconds': time.perf_counter() - start_time})
+    release.wait()
+
+def run_index_sharing_benchmark(args):
+    """Start N worker processes per load mode (private copy vs mmap) and measure their combined memory"""
+    import multiprocessing
+    # Fresh interpreters: nothing inherited from this process is shared by accident
+    context = multiprocessing.get_context('spawn')
+    modes = {}
+    for mode, mmap in (('copy', False), ('mmap', True)):
+        ready, release = context.Queue(), context.Event()
+        start_time = time.perf_counter()
+        workers = [context.Process(target=_index_worker, args=(args.vector_db, mmap, args.searches, ready, release))
+                   for _ in range(args.index_workers)]
+        for worker in workers:
+            worker.start()
+        reports = [ready.get() for _ in workers]
+        all_ready_seconds = time.perf_counter() - start_time
+        # Measured while every worker still holds its store
+        for report in reports:
+            report['memory_mb'] = process_memory_mb(report['pid'])
+        release.set()
+        for worker in workers:
+            worker.join()
+        measured = [r['memory_mb'] for r in reports if r['memory_mb']]
+        modes[mode] = {
+            'workers': reports,
+            'all_ready_seconds': all_ready_seconds,
+            'startup_seconds': summarize_latencies([r['startup_seconds'] for r in reports]),
+            'load_seconds': summarize_latencies([r['load_seconds'] for r in reports]),
+            'total_rss_mb': sum(m['rss'] for m in measured) if measured else None,
+            'total_pss_mb': sum(m['pss'] for m in measured) if measured else None,
+            'total_private_mb': sum(m['private'] for m in measured) if measured else None
+        }
+    index_files = [name for name in os.listdir(args.vector_db) if name.endswith('.faiss')]
+    return {
+        'config': {'vector_db': args.vector_db, 'workers': args.index_workers, 'searches': args.searches,
+                   'index_mb': sum(os.path.getsize(os.path.join(args.vector_db, name)) for name in index_files) / 1e6},
+        'environment': {'commit': git_commit(), 'python': platform.python_version()},
+        'modes': modes
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end pipeline benchmark')
+    parser.add_argument('--dataset', nargs='+', default=['./data/test.csv'], help='Benchmark CSV files (test/valid)')
+    parser.add_argument('--slice', default='0:50', help='Row slice start:stop taken from each dataset')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of timed passes over the slice')
+    parser.add_argument('--warmup', type=int, default=3, help='Untimed warm-up queries after the cold query')
+    parser.add_argument('--llm', choices=['stub', 'replay'], default='stub',
+                        help='Stub LLM answering with gold SQL, or replay a recorded cassette')
+    parser.add_argument('--stub-latency', type=float, default=0.0, help='Simulated LLM latency for the stub (seconds)')
+    parser.add_argument('--stub-tail-probability', type=float, default=0.0,
+                        help='Share of stub LLM calls that take --stub-tail-multiplier times the latency')
+    parser.add_argument('--stub-tail-multiplier', type=float, default=10.0, help='Latency multiplier of slow stub calls')
+    parser.add_argument('--hedge-percentile', type=float,
+                        help='Hedge LLM requests slower than this percentile of recent latency')
+    parser.add_argument('--hedge-budget', type=float, default=0.05, help='Maximum hedge requests per LLM request')
+    parser.add_argument('--cassette', help='Cassette for --llm replay')
+    parser.add_argument('--route', action='store_true',
+                        help='Route easy questions to a fast model (stub: --fast-stub-latency/--fast-error-rate)')
+    parser.add_argument('--fast-model', default='gemini-1.5-flash', help='Model name of the fast route for --llm replay')
+    parser.add_argument('--route-min-score', type=float, default=0.8,
+                        help='Minimum top training-example similarity for the fast route')
+    parser.add_argument('--fast-stub-latency', type=float, default=0.0, help='Simulated latency of the fast stub (seconds)')
+    parser.add_argument('--fast-error-rate', type=float, default=0.0,
+                        help='Share of questions the fast stub answers with failing SQL')
+    parser.add_argument('--replay-latency', action='store_true', help='Sleep for the recorded latency when replaying')
+    parser.add_argument('--vector-db', default='vector_db', help='Vector database directory')
+    parser.add_argument('--db', default='./mimic_iv.sqlite', help='Path to SQLite database')
+    parser.add_argument('--token-budget', type=int, help='Token budget for the retrieved prompt context')
+    parser.add_argument('--retrieval', choices=['dense', 'bm25', 'hybrid'], default='dense', help='Retrieval mode to benchmark')
+    parser.add_argument('--compare-retrieval', action='store_true',
+                        help='Only compare dense vs BM25 retrieval latency and top-k overlap')
+    parser.add_argument('--top-k', type=int, default=5, help='k for --compare-retrieval overlap')
+    parser.add_argument('--index-workers', type=int,
+                        help='Only measure total memory and startup of N processes loading the indices, copied vs mmap')
+    parser.add_argument('--searches', type=int, default=8, help='Searches per index in each --index-workers process')
+    parser.add_argument('--in-memory', action='store_true', help='Run the pipeline SQL on an in-memory copy of --db')
+    parser.add_argument('--compare-db', action='store_true',
+                        help='Only compare gold-SQL execution: connect per query vs pooled file connections vs an in-memory copy')
+    parser.add_argument('--db-threads', type=int, default=1, help='Concurrent queries (and pool size) for --compare-db')
+    parser.add_argument('--memory-profile', action='store_true',
+                        help='Add per-stage tracemalloc/RSS figures to the results (tracing slows every stage down)')
+    parser.add_argument('--output', default='benchmark_results.json', help='Where to write the JSON results')
+    parser.add_argument('--baseline', help='Previous results JSON to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown against the baseline (fraction)')
+    args = parser.parse_args()
+
+    if args.index_workers:
+        result = run_index_sharing_benchmark(args)
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+        for mode, stats in result['modes'].items():
+            memory = (f"total RSS {stats['total_rss_mb']:.0f} MB, PSS {stats['total_pss_mb']:.0f} MB, "
+                      f"private {stats['total_private_mb']:.0f} MB" if stats['total_rss_mb'] is not None
+                      else "memory not available on this platform")
+            print(f"{mode:<5} x{args.index_workers}: {memory}; startup p50 "
+                  f"{stats['startup_seconds']['p50'] * 1000:.0f} ms (store load p50 {stats['load_seconds']['p50'] * 1000:.0f} ms)")
+        print(f"Results written to {args.output}")
+        return
+
+    if args.compare_db:
+        result = run_db_benchmark(args)
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+        print(f"In-memory copy: {result['memory_image_mb']:.0f} MB loaded in {result['memory_load_seconds']:.2f}s")
+        for mode, stats in result['modes'].items():
+            print(f"{mode:<10} p50 {stats['latency']['p50'] * 1000:.2f} ms, p95 {stats['latency']['p95'] * 1000:.2f} ms, "
+                  f"{stats['queries_per_second']:.0f} queries/s, {stats['mismatches']} result mismatches")
+        print(f"Results written to {args.output}")
+        return
+
+    if args.compare_retrieval:
+        result = run_retrieval_benchmark(args)
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+        print(f"Dense p50 {result['dense_latency']['p50'] * 1000:.2f} ms vs BM25 p50 "
+              f"{result['bm25_latency']['p50'] * 1000:.2f} ms; overlap@{args.top_k} {result['overlap_at_k']}")
+        print(f"Results written to {args.output}")
+        return
+
+    result = run_benchmark(args)
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+
+    print(f"Benchmark complete: {result['config']['rows']} rows x {args.repeat}, "
+          f"{result['throughput_qps']:.2f} queries/s, p95 {result['warm_latency']['p95'] * 1000:.1f} ms, "
+          f"peak RSS {result['peak_rss_mb']:.0f} MB")
+    if 'hedging' in result:
+        hedging = result['hedging']
+        print(f"Hedging: {hedging['hedges']} of {hedging['requests']} LLM requests hedged ({hedging['hedges_won']} won); "
+              + ", ".join(f"{p} {hedging[f'unhedged_{p}'] * 1000:.0f} ms unhedged -> {hedging[p] * 1000:.0f} ms"
+                          for p in ('p95', 'p99') if p in hedging))
+    for route, stats in result.get('routes', {}).items():
+        success = f"{stats['success_rate']:.1%}" if stats['success_rate'] is not None else "n/a"
+        print(f"Route {route}: {stats['answered']} questions, success {success}, escalated {stats['escalations']}")
+    if args.memory_profile:
+        from memory_profile import MEMORY_PROFILER
+        print(MEMORY_PROFILER.format_summary())
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(result, baseline, args.tolerance)
+        for regression in regressions:
+            if regression['unit'] == 'MB':
+                print(f"REGRESSION {regression['metric']}: {regression['baseline']:.1f} MB -> "
+                      f"{regression['current']:.1f} MB")
+            else:
+                print(f"REGRESSION {regression['metric']}: {regression['baseline'] * 1000:.1f} ms -> "
+                      f"{regression['current'] * 1000:.1f} ms")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
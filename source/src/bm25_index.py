@@ -0,0 +1,129 @@
+import os
+import re
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from mmap_store import save_array
+
+def tokenize(text):
+    """Lowercase word tokens; snake_case identifiers also yield their parts"""
+    tokens = []
+    for token in re.findall(r"[a-z0-9_]+", str(text).lower()):
+        tokens.append(token)
+        if '_' in token:
+            tokens.extend(part for part in token.split('_') if part)
+    return tokens
+
+class BM25Index:
+    """Okapi BM25 inverted index stored as flat numpy arrays (term offsets, doc ids, weights)"""
+
+    def __init__(self, terms, offsets, doc_ids, weights, idf, n_docs):
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.idf = idf
+        self.n_docs = n_docs
+
+    @classmethod
+    def build(cls, texts, k1=1.5, b=0.75):
+        """Build the index; per-posting weights fold in tf and length normalization"""
+        docs = [tokenize(text) for text in texts]
+        lengths = np.array([len(doc) for doc in docs], dtype=np.float32)
+        avgdl = float(lengths.mean()) if len(docs) else 0.0
+        postings = {}
+        for doc_id, doc in enumerate(docs):
+            counts = {}
+            for token in doc:
+                counts[token] = counts.get(token, 0) + 1
+            for token, tf in counts.items():
+                postings.setdefault(token, []).append((doc_id, tf))
+
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        doc_ids, weights, idf = [], [], np.zeros(len(terms), dtype=np.float32)
+        for i, term in enumerate(terms):
+            entries = postings[term]
+            offsets[i + 1] = offsets[i] + len(entries)
+            df = len(entries)
+            idf[i] = np.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+            for doc_id, tf in entries:
+                norm = k1 * (1 - b + b * lengths[doc_id] / avgdl) if avgdl else k1
+                doc_ids.append(doc_id)
+                weights.append(tf * (k1 + 1) / (tf + norm))
+        return cls(terms, offsets, np.array(doc_ids, dtype=np.int32), np.array(weights, dtype=np.float32), idf,
+                   len(docs))
+
+    def save(self, prefix, metadata_sha256=None):
+        """Write <prefix>_terms.json (with the hash of the metadata it indexes) plus one .npy file per array"""
+        terms = sorted(self.term_ids, key=self.term_ids.get)
+        with open(f"{prefix}_terms.json", 'w') as f:
+            json.dump({'terms': terms, 'n_docs': self.n_docs, 'metadata_sha256': metadata_sha256}, f)
+        save_array(f"{prefix}_offsets.npy", self.offsets)
+        save_array(f"{prefix}_doc_ids.npy", self.doc_ids)
+        save_array(f"{prefix}_weights.npy", self.weights)
+        save_array(f"{prefix}_idf.npy", self.idf)
+
+    @classmethod
+    def load(cls, prefix):
+        """Load an index with its arrays memory-mapped read-only"""
+        with open(f"{prefix}_terms.json") as f:
+            header = json.load(f)
+        return cls(header['terms'],
+                   np.load(f"{prefix}_offsets.npy", mmap_mode='r'),
+                   np.load(f"{prefix}_doc_ids.npy", mmap_mode='r'),
+                   np.load(f"{prefix}_weights.npy", mmap_mode='r'),
+                   np.load(f"{prefix}_idf.npy", mmap_mode='r'),
+                   header['n_docs'])
+
+    def search(self, query_text, top_k=5):
+        """Return (doc ids, scores) of the top_k documents for a query string"""
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for token in set(tokenize(query_text)):
+            term_id = self.term_ids.get(token)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            # Doc ids are unique within one posting list, so fancy-index add is exact
+            scores[self.doc_ids[start:end]] += self.idf[term_id] * self.weights[start:end]
+        candidates = np.flatnonzero(scores)
+        if candidates.size > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        order = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return order, scores[order]
+
+def _file_sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def build_bm25_indices(vector_db_dir='vector_db'):
+    """Build BM25 indices over the text_for_embedding of the schema and training metadata"""
+    for name in ('schema', 'train'):
+        metadata_path = os.path.join(vector_db_dir, f'{name}_metadata.csv')
+        if not os.path.exists(metadata_path):
+            print(f"No {name} metadata found, skipping BM25 index.")
+            continue
+        texts = pd.read_csv(metadata_path, usecols=['text_for_embedding'])['text_for_embedding'].fillna('').tolist()
+        index = BM25Index.build(texts)
+        index.save(os.path.join(vector_db_dir, f'{name}_bm25'), _file_sha256(metadata_path))
+        print(f"BM25 {name} index complete: {len(texts)} documents, {len(index.term_ids)} terms")
+
+def bm25_index_exists(vector_db_dir='vector_db'):
+    return all(os.path.exists(os.path.join(vector_db_dir, f'{name}_bm25_terms.json')) for name in ('schema', 'train'))
+
+def bm25_index_current(vector_db_dir='vector_db'):
+    """Whether both BM25 indices exist and were built from the metadata files now on disk
+
+    Doc ids index into the metadata rows, so an index over older metadata would
+    return unrelated examples.
+    """
+    for name in ('schema', 'train'):
+        terms_path = os.path.join(vector_db_dir, f'{name}_bm25_terms.json')
+        metadata_path = os.path.join(vector_db_dir, f'{name}_metadata.csv')
+        if not os.path.exists(terms_path) or not os.path.exists(metadata_path):
+            return False
+        with open(terms_path) as f:
+            if json.load(f).get('metadata_sha256') != _file_sha256(metadata_path):
+                return False
+    return True
@@ -1,18 +1,177 @@
+import os
+import time
 import sqlite3
+import queue
+import threading
+from contextlib import contextmanager
 import pandas as pd
+from sql_rewrite import prepare_sql
 
-def execute_sql_query(sql_query, db_path="mimic_iv.sqlite"):
-    """Execute SQL query on the database and return results"""
+class SQLiteConnectionPool:
+    """Fixed-size pool of read-only SQLite connections shared across threads"""
+
+    def __init__(self, db_path="mimic_iv.sqlite", size=4):
+        self.db_path = db_path
+        self.size = size
+        self._connections = queue.Queue()
+        self._all = []
+        self._lock = threading.Lock()
+        for _ in range(size):
+            conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+            self._all.append(conn)
+            self._connections.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a block"""
+        conn = self._connections.get()
+        try:
+            yield conn
+        finally:
+            self._connections.put(conn)
+
+    def close(self):
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all = []
+
+class InMemoryDatabase:
+    """Read-only in-memory copy of a SQLite file, served through a pool of connections
+
+    The file is copied once with the backup API into a named memdb image that
+    every pooled connection opens read-only, so threads share one copy and no
+    query touches the file. Drop-in for SQLiteConnectionPool. At most
+    every `check_interval` seconds the file's mtime/size are compared with the
+    loaded copy; on a change a fresh image is loaded and swapped in, and
+    connections to the old one are closed as they are returned.
+    """
+
+    def __init__(self, db_path="mimic_iv.sqlite", size=4, check_interval=1.0):
+        self.db_path = db_path
+        self.size = size
+        self.check_interval = check_interval
+        self.generation = 0
+        self.reloads = 0
+        self._available = threading.Condition()
+        self._checked = time.monotonic()
+        self._current = None
+        with self._available:
+            self._load()
+
+    def _file_state(self):
+        stat = os.stat(self.db_path)
+        return stat.st_mtime, stat.st_size
+
+    def _load(self):
+        """Copy the file into a new memdb image and make it current (called with the lock held)"""
+        state = self._file_state()
+        self.generation += 1
+        uri = f"file:/clinicalai_{os.getpid()}_{id(self)}_{self.generation}?vfs=memdb"
+        # The holder connection keeps the image alive until the last reader is closed
+        holder = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        source = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+        try:
+            source.backup(holder)
+        finally:
+            source.close()
+        image_bytes = holder.execute("PRAGMA page_count").fetchone()[0] * holder.execute("PRAGMA page_size").fetchone()[0]
+        idle = [sqlite3.connect(f"{uri}&mode=ro", uri=True, check_same_thread=False) for _ in range(self.size)]
+        previous = self._current
+        self._current = {'state': state, 'holder': holder, 'idle': idle, 'borrowed': 0, 'bytes': image_bytes}
+        if previous is not None:
+            self.reloads += 1
+            self._retire(previous)
+        self._available.notify_all()
+
+    def _retire(self, image):
+        """Close the idle connections of a replaced image (and the image once none is borrowed)"""
+        for conn in image['idle']:
+            conn.close()
+        image['idle'] = []
+        if image['borrowed'] == 0:
+            image['holder'].close()
+
+    def refresh(self, force=False):
+        """Reload when the file changed since it was loaded; returns True if it was reloaded"""
+        with self._available:
+            now = time.monotonic()
+            if not force and now - self._checked < self.check_interval:
+                return False
+            self._checked = now
+            try:
+                changed = force or self._file_state() != self._current['state']
+            except OSError:
+                # Keep serving the loaded copy while the file is being replaced
+                return False
+            if changed:
+                self._load()
+            return changed
+
+    @property
+    def image_bytes(self):
+        return self._current['bytes']
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection to the current image for the duration of a block"""
+        self.refresh()
+        with self._available:
+            while not self._current['idle']:
+                self._available.wait()
+            image = self._current
+            conn = image['idle'].pop()
+            image['borrowed'] += 1
+        try:
+            yield conn
+        finally:
+            with self._available:
+                image['borrowed'] -= 1
+                if image is self._current:
+                    image['idle'].append(conn)
+                    self._available.notify()
+                else:
+                    conn.close()
+                    self._retire(image)
+
+    def close(self):
+        with self._available:
+            image, self._current = self._current, None
+            if image is not None:
+                self._retire(image)
+
+def open_pool(db_path="mimic_iv.sqlite", size=4, in_memory=False):
+    """Connection pool over the database file, or over an in-memory copy of it"""
+    if in_memory:
+        return InMemoryDatabase(db_path, size)
+    return SQLiteConnectionPool(db_path, size)
+
+def execute_sql_query(sql_query, db_path="mimic_iv.sqlite", pool=None, shards=None):
+    """Execute SQL query on the database and return results
+
+    With `shards` (a db_shards.ShardedExecutor), the query runs over the
+    subject-sharded copies of the database instead.
+    """
+    # Sargable time filters when the database has been profiled by db_prepare.py
+    sql_query = prepare_sql(sql_query, pool.db_path if pool is not None else db_path)
+    if shards is not None:
+        return shards.execute(sql_query)
     try:
-        # Connect to the database
-        conn = sqlite3.connect(db_path)
-        
-        # Execute the query
-        result_df = pd.read_sql_query(sql_query, conn)
-        
-        # Close the connection
-        conn.close()
-        
+        if pool is not None:
+            # Reuse a warm connection from the pool
+            with pool.connection() as conn:
+                result_df = pd.read_sql_query(sql_query, conn)
+        else:
+            # Connect to the database
+            conn = sqlite3.connect(db_path)
+
+            # Execute the query
+            try:
+                result_df = pd.read_sql_query(sql_query, conn)
+            finally:
+                # Close the connection
+                conn.close()
+
         return {
             "success": True,
             "data": result_df
@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+import pandas as pd
+from sql_canonical import sql_fingerprint
+from sql_rewrite import rewrite_sql, profile_path, ADMISSION_LOOKUP_TABLE, ADMISSION_LOOKUP_COLUMNS
+
+# Non-NULL values must match this (and be TEXT) for a column to be rewritten
+CANONICAL_TIMESTAMP_GLOB = '[0-9][0-9][0-9][0-9]-[0-1][0-9]-[0-3][0-9] [0-2][0-9]:[0-5][0-9]:[0-5][0-9]'
+
+def _tables(conn):
+    return [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+
+def _time_candidates(conn, table):
+    """Columns that look like timestamps by declared type or name"""
+    columns = []
+    for _, name, declared_type, *_ in conn.execute(f'PRAGMA table_info("{table}")'):
+        declared_type = (declared_type or '').upper()
+        if 'TIME' in declared_type or 'DATE' in declared_type or name.lower().endswith('time'):
+            columns.append(name)
+    return columns
+
+def profile_time_columns(db_path):
+    """Column names whose values are canonical TEXT timestamps in every table that has them"""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        verdicts = {}
+        for table in _tables(conn):
+            for column in _time_candidates(conn, table):
+                bad = conn.execute(
+                    f'SELECT COUNT(*) FROM "{table}" WHERE "{column}" IS NOT NULL '
+                    f'AND (typeof("{column}") != \'text\' OR "{column}" NOT GLOB ?)',
+                    (CANONICAL_TIMESTAMP_GLOB,)).fetchone()[0]
+                verdicts.setdefault(column.lower(), []).append((table, bad == 0))
+    finally:
+        conn.close()
+    # Rewrites match columns by name (aliases hide the table), so every table must agree
+    canonical = sorted(column for column, results in verdicts.items() if all(ok for _, ok in results))
+    tables = {}
+    for column in canonical:
+        for table, _ in verdicts[column]:
+            tables.setdefault(table, []).append(column)
+    return canonical, tables
+
+def create_time_indexes(db_path, tables):
+    """CREATE INDEX on each canonical time column, then ANALYZE for the planner"""
+    conn = sqlite3.connect(db_path)
+    try:
+        for table, columns in tables.items():
+            for column in columns:
+                conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{table}_{column}" ON "{table}"("{column}")')
+        conn.execute("ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
+
+def create_admission_lookup(db_path):
+    """(Re)build the subject/admission lookup table with its two covering indexes
+
+    subject -> hadm_ids and hadm -> subject/admit/discharge time are each
+    answered from an index alone, without touching the wide admissions rows.
+    """
+    columns = ', '.join(ADMISSION_LOOKUP_COLUMNS)
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute(f"DROP TABLE IF EXISTS {ADMISSION_LOOKUP_TABLE}")
+        conn.execute(f"CREATE TABLE {ADMISSION_LOOKUP_TABLE} AS SELECT {columns} FROM admissions ORDER BY rowid")
+        conn.execute(f"CREATE INDEX idx_{ADMISSION_LOOKUP_TABLE}_subject ON {ADMISSION_LOOKUP_TABLE}"
+                     "(subject_id, hadm_id, admittime, dischtime)")
+        conn.execute(f"CREATE INDEX idx_{ADMISSION_LOOKUP_TABLE}_hadm ON {ADMISSION_LOOKUP_TABLE}"
+                     "(hadm_id, subject_id, admittime, dischtime)")
+        conn.execute(f"ANALYZE {ADMISSION_LOOKUP_TABLE}")
+        conn.commit()
+    finally:
+        conn.close()
+
+def admission_lookup_current(db_path):
+    """True when the lookup table exists and holds exactly the admissions key/time rows"""
+    columns = ', '.join(ADMISSION_LOOKUP_COLUMNS)
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        if ADMISSION_LOOKUP_TABLE not in _tables(conn):
+            return False
+        counts = conn.execute(f"SELECT (SELECT COUNT(*) FROM admissions), (SELECT COUNT(*) FROM {ADMISSION_LOOKUP_TABLE})").fetchone()
+        if counts[0] != counts[1]:
+            return False
+        for left, right in (('admissions', ADMISSION_LOOKUP_TABLE), (ADMISSION_LOOKUP_TABLE, 'admissions')):
+            missing = conn.execute(f"SELECT COUNT(*) FROM (SELECT {columns} FROM {left} "
+                                   f"EXCEPT SELECT {columns} FROM {right})").fetchone()[0]
+            if missing:
+                return False
+        return True
+    except sqlite3.Error:
+        return False
+    finally:
+        conn.close()
+
+def write_profile(db_path, columns, tables, admission_lookup, slower_shapes=()):
+    """Record what was verified together with the database file state it was checked on"""
+    stat = os.stat(db_path)
+    profile = {'columns': columns, 'tables': tables, 'admission_lookup': admission_lookup,
+               'slower_shapes': sorted(slower_shapes), 'db_mtime': stat.st_mtime, 'db_size': stat.st_size}
+    with open(profile_path(db_path), 'w') as f:
+        json.dump(profile, f, indent=2)
+    return profile
+
+def _run(conn, sql, repeat=1):
+    """Result, error and best-of-`repeat` wall time of one query"""
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        try:
+            df = pd.read_sql_query(sql, conn)
+            error = None
+        except Exception as e:
+            # pandas embeds the SQL text in its message; compare the database error only
+            df, error = None, str(e.__cause__ or e)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return df, error, best
+
+def same_result(a, b):
+    """Identical rows, ignoring row order only (ORDER BY ties may legitimately reorder)"""
+    if a is None or b is None:
+        return a is None and b is None
+    if list(a.columns) != list(b.columns) or len(a) != len(b):
+        return False
+    if a.equals(b):
+        return True
+    key = lambda df: sorted(map(repr, df.itertuples(index=False, name=None)))
+    return key(a) == key(b)
+
+def verify_rewrites(db_path, csv_paths, profile, limit=None, repeat=1):
+    """Run each distinct gold query as written and rewritten; compare results and time both"""
+    queries = pd.concat([pd.read_csv(path) for path in csv_paths])['query'].dropna().unique()
+    if limit:
+        queries = queries[:limit]
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    rows = []
+    try:
+        for sql in queries:
+            rewritten, counts = rewrite_sql(sql, profile)
+            if not any(counts.values()):
+                continue
+            original_df, original_error, original_seconds = _run(conn, sql, repeat)
+            rewritten_df, rewritten_error, rewritten_seconds = _run(conn, rewritten, repeat)
+            rows.append({
+                'query': sql,
+                'shape': sql_fingerprint(sql, parameterize=True),
+                'rewritten': rewritten,
+                **{f"{kind}_rewrites": count for kind, count in counts.items()},
+                'identical': same_result(original_df, rewritten_df) and original_error == rewritten_error,
+                'original_ms': original_seconds * 1000,
+                'rewritten_ms': rewritten_seconds * 1000,
+                'speedup': original_seconds / rewritten_seconds if rewritten_seconds else None
+            })
+    finally:
+        conn.close()
+    return pd.DataFrame(rows)
+
+def slower_shapes(report):
+    """Query shapes (literal-free fingerprints) whose rewrites took at least as long in total as the originals"""
+    totals = report.groupby('shape')[['original_ms', 'rewritten_ms']].sum()
+    return set(totals.index[totals['rewritten_ms'] >= totals['original_ms']])
+
+def _print_speedup(label, report):
+    print(f"{label}: {len(report)} queries, median speedup {report['speedup'].median():.2f}x, "
+          f"total {report['original_ms'].sum():.0f} ms -> {report['rewritten_ms'].sum():.0f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description='Prepare the database for fast queries: time indexes, '
+                                                 'lookup tables, and verified query rewrites')
+    parser.add_argument('--db', default='./mimic_iv.sqlite', help='Path to SQLite database')
+    parser.add_argument('--create-indexes', action='store_true', help='Create indexes on the canonical time columns')
+    parser.add_argument('--admission-lookup', action='store_true',
+                        help='Build the indexed subject/admission lookup table used for patient-scoped subqueries')
+    parser.add_argument('--verify', nargs='*', help='CSV files whose gold queries are run both ways (e.g. data/test.csv)')
+    parser.add_argument('--limit', type=int, help='Verify at most N distinct queries')
+    parser.add_argument('--repeat', type=int, default=1, help='Time each query N times and keep the best')
+    parser.add_argument('--output', help='Write the per-query verification report (CSV)')
+    args = parser.parse_args()
+
+    columns, tables = profile_time_columns(args.db)
+    print(f"Canonical time columns: {', '.join(columns) or 'none'}")
+    if args.create_indexes:
+        create_time_indexes(args.db, tables)
+        print(f"Indexed {sum(len(c) for c in tables.values())} time columns")
+    if args.admission_lookup:
+        create_admission_lookup(args.db)
+    admission_lookup = admission_lookup_current(args.db)
+    if args.admission_lookup or admission_lookup:
+        print(f"Admission lookup table: {'current' if admission_lookup else 'stale, rebuild with --admission-lookup'}")
+    # Written last: the profile pins the database file state after any index or table creation
+    profile = write_profile(args.db, columns, tables, admission_lookup)
+    print(f"Profile written to {profile_path(args.db)}")
+
+    if args.verify:
+        profile['columns'] = frozenset(columns)
+        report = verify_rewrites(args.db, args.verify, profile, args.limit, args.repeat)
+        if args.output:
+            report.to_csv(args.output, index=False)
+        if report.empty:
+            print("No query was rewritten.")
+            return
+        mismatches = int((~report['identical']).sum())
+        print(f"Rewritten queries: {len(report)}, identical results: {len(report) - mismatches}")
+        _print_speedup("All rewrites", report)
+        for kind in ('time_range', 'admission_lookup'):
+            subset = report[report[f"{kind}_rewrites"] > 0]
+            if not subset.empty:
+                _print_speedup(f"With {kind} rewrites", subset)
+        if mismatches:
+            print(f"{mismatches} rewritten queries returned different results; remove {profile_path(args.db)} "
+                  "to disable rewrites")
+            raise SystemExit(1)
+        # Keep a rewrite only where it measured faster: slower shapes run as written
+        slower = slower_shapes(report)
+        write_profile(args.db, columns, tables, admission_lookup, slower)
+        kept = report[~report['shape'].isin(slower)]
+        print(f"Rewrites kept for {report['shape'].nunique() - len(slower)} of {report['shape'].nunique()} query shapes "
+              f"({len(report) - len(kept)} queries measured slower run as written)")
+        if not kept.empty:
+            _print_speedup("Kept rewrites", kept)
+        total_ms = report['original_ms'].sum()
+        print(f"Workload total: {total_ms:.0f} ms as written -> "
+              f"{kept['rewritten_ms'].sum() + total_ms - kept['original_ms'].sum():.0f} ms with the kept rewrites")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,540 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+from multiprocessing import Pool
+import pandas as pd
+from sql_canonical import tokenize
+from metrics import PIPELINE_METRICS
+
+MANIFEST_FILE = 'manifest.json'
+SHARD_KEY = 'subject_id'
+# Columns that may identify one subject's rows across tables; kept only if the data agrees
+CANDIDATE_KEYS = ('hadm_id', 'stay_id')
+_AGGREGATES = ('count', 'sum', 'min', 'max', 'avg')
+_CLAUSES = ('from', 'where', 'group', 'order', 'limit', 'having', 'window')
+_COMPOUND = ('union', 'intersect', 'except')
+_NOT_ALIAS = set(_CLAUSES) | set(_COMPOUND) | {'join', 'inner', 'left', 'right', 'full', 'cross', 'outer',
+                                               'natural', 'on', 'using', 'as', 'select', 'and', 'or', 'not'}
+
+def shard_path(shard_dir, index):
+    return os.path.join(shard_dir, f"shard_{index:03d}.sqlite")
+
+def shard_of(subject_id, n_shards):
+    """Shard holding a subject; matches the SQL used by shard_database"""
+    return abs(int(subject_id)) % n_shards
+
+def _shard_expression(n_shards):
+    # Rows without a subject all land on shard 0
+    return f'COALESCE(abs(CAST("{SHARD_KEY}" AS INTEGER)) % {n_shards}, 0)'
+
+def _columns(conn, table):
+    return [row[1].lower() for row in conn.execute(f'PRAGMA table_info("{table}")')]
+
+def colocated_keys(conn, sharded_tables, n_shards):
+    """Candidate keys whose every value lives on a single shard in all sharded tables"""
+    keys = []
+    for key in CANDIDATE_KEYS:
+        tables = [table for table in sharded_tables if key in _columns(conn, table)]
+        if not tables:
+            continue
+        union = ' UNION ALL '.join(f'SELECT "{key}" AS k, {_shard_expression(n_shards)} AS s FROM "{table}"'
+                                   for table in tables)
+        split = conn.execute(f"SELECT COUNT(*) FROM (SELECT k FROM ({union}) WHERE k IS NOT NULL "
+                             "GROUP BY k HAVING COUNT(DISTINCT s) > 1)").fetchone()[0]
+        if split == 0:
+            keys.append(key)
+    return keys
+
+def shard_database(db_path, shard_dir, n_shards):
+    """Split db_path into n_shards files by subject_id; tables without it are copied to every shard"""
+    source = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        tables = source.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table' AND sql IS NOT NULL "
+                                "AND name NOT LIKE 'sqlite_%'").fetchall()
+        indexes = [row[0] for row in source.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")]
+        sharded = [name for name, _ in tables if SHARD_KEY in _columns(source, name)]
+        keys = colocated_keys(source, sharded, n_shards)
+    finally:
+        source.close()
+
+    os.makedirs(shard_dir, exist_ok=True)
+    for index in range(n_shards):
+        path = shard_path(shard_dir, index)
+        if os.path.exists(path):
+            os.remove(path)
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute("ATTACH DATABASE ? AS source", (db_path,))
+            for name, sql in tables:
+                conn.execute(sql)
+                where = f" WHERE {_shard_expression(n_shards)} = {index}" if name in sharded else ''
+                conn.execute(f'INSERT INTO main."{name}" SELECT * FROM source."{name}"{where}')
+            conn.commit()
+            conn.execute("DETACH DATABASE source")
+            for sql in indexes:
+                conn.execute(sql)
+            conn.execute("ANALYZE")
+            conn.commit()
+        finally:
+            conn.close()
+
+    stat = os.stat(db_path)
+    manifest = {
+        'n_shards': n_shards,
+        'source': os.path.abspath(db_path),
+        'source_mtime': stat.st_mtime,
+        'source_size': stat.st_size,
+        'sharded_tables': sorted(sharded),
+        'replicated_tables': sorted(name for name, _ in tables if name not in sharded),
+        'colocated_keys': keys
+    }
+    with open(os.path.join(shard_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+def load_manifest(shard_dir):
+    with open(os.path.join(shard_dir, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    manifest['sharded_tables'] = frozenset(manifest['sharded_tables'])
+    manifest['colocated_keys'] = frozenset(manifest['colocated_keys'])
+    return manifest
+
+def manifest_current(manifest, db_path):
+    """True when the shards were cut from db_path as it is now"""
+    if not os.path.exists(db_path):
+        return False
+    stat = os.stat(db_path)
+    return manifest['source_mtime'] == stat.st_mtime and manifest['source_size'] == stat.st_size
+
+# ---------------------------------------------------------------------------
+# Query planning
+
+def _words(sql):
+    """Non-space tokens as (index into tokenize(sql), kind, lowered text), plus the full token list"""
+    tokens = tokenize(sql)
+    return tokens, [(i, kind, text.lower()) for i, (kind, text) in enumerate(tokens) if kind != 'space']
+
+def _matching_parens(words):
+    match, stack = {}, []
+    for position, (_, _, text) in enumerate(words):
+        if text == '(':
+            stack.append(position)
+        elif text == ')' and stack:
+            match[stack.pop()] = position
+    return match
+
+def _parse_block(words, match, start, end):
+    """One SELECT block: words[start] is 'select', the block runs to `end` (exclusive)
+
+    Records the FROM sources (alias -> table name or derived block), subquery
+    children with the clause and the words before them, flags for clauses that
+    change how rows combine, the word span of each top-level clause and, per
+    clause, the positions of the words outside any parentheses.
+    """
+    block = {'sources': {}, 'children': [], 'flags': set(), 'spans': {}, 'level0': {}, 'start': start, 'end': end}
+    clause, clause_start = 'select', start + 1
+    level = 0
+    expect_table = False
+    position = start + 1
+    while position < end:
+        _, kind, text = words[position]
+        if text == '(' and position + 1 < end and words[position + 1][2] == 'select':
+            close = match.get(position, end)
+            child = _parse_block(words, match, position + 1, close)
+            child['clause'] = clause if level == 0 else 'expression'
+            child['before'] = [words[p][2] for p in (position - 1, position - 2, position - 3) if p >= start]
+            if clause == 'from' and level == 0:
+                alias = _alias(words, close + 1, end)
+                block['sources'][alias or f"_derived{len(block['sources'])}"] = child
+            else:
+                block['children'].append(child)
+            expect_table = False
+            position = close + 1
+            continue
+        if level == 0:
+            if text in _CLAUSES or text in _COMPOUND:
+                block['spans'].setdefault(clause, (clause_start, position))
+                clause, clause_start = text, position + 1
+                block['flags'].add(text if text in _CLAUSES else 'compound')
+                expect_table = text == 'from'
+                position += 1
+                continue
+            block['level0'].setdefault(clause, []).append(position)
+            if clause == 'from' and text in ('join', ','):
+                expect_table = True
+                if text == 'join':
+                    block['flags'].add('join')
+            elif clause == 'from' and text == 'on':
+                expect_table = False
+            elif expect_table:
+                expect_table = False
+                if kind != 'word':
+                    block['flags'].add('unparsed')
+                else:
+                    block['sources'][_alias(words, position + 1, end) or text] = text
+            elif clause == 'select' and text == 'distinct' and position == start + 1:
+                block['flags'].add('distinct')
+        if text == '(':
+            level += 1
+        elif text == ')':
+            level -= 1
+        position += 1
+    block['spans'].setdefault(clause, (clause_start, end))
+    return block
+
+def _alias(words, position, end):
+    if position < end and words[position][2] == 'as':
+        position += 1
+    if position < end and words[position][1] == 'word' and words[position][2] not in _NOT_ALIAS \
+            and '.' not in words[position][2]:
+        return words[position][2]
+    return None
+
+def _blocks(block):
+    """The block and every block nested in it"""
+    yield block
+    for child in list(block['children']) + [s for s in block['sources'].values() if isinstance(s, dict)]:
+        yield from _blocks(child)
+
+def _sharded_sources(block, manifest):
+    return [alias for alias, source in block['sources'].items()
+            if (isinstance(source, str) and source in manifest['sharded_tables'])
+            or (isinstance(source, dict) and _reads_sharded(source, manifest))]
+
+def _reads_sharded(block, manifest):
+    return any(_sharded_sources(b, manifest) for b in _blocks(block))
+
+def _is_column(word, column, aliases):
+    """word is `column`, bare or qualified by one of aliases"""
+    qualifier, _, name = word.rpartition('.')
+    return name == column and (not qualifier or qualifier in aliases)
+
+def _block_shards(words, block, manifest):
+    """Shards that hold every row a block reading one sharded source can see
+
+    A block is pinned by `<source>.subject_id = <number>` or by
+    `<source>.<co-located key> IN (<pinned block>)` in an all-AND WHERE, or by
+    reading a pinned derived table. Returns a set of shard indexes, or None
+    when the block may see rows from any shard.
+    """
+    sources = _sharded_sources(block, manifest)
+    if len(sources) != 1:
+        return None
+    source = block['sources'][sources[0]]
+    if isinstance(source, dict):
+        return _block_shards(words, source, manifest)
+    aliases = {sources[0], source}
+    where = block['level0'].get('where', [])
+    texts = [words[p][2] for p in where] + [None]
+    if 'or' in texts:
+        return None
+    shards = set()
+    for index, position in enumerate(where):
+        # <column> = <number>, as a whole conjunct of the WHERE clause
+        if _is_column(texts[index], SHARD_KEY, aliases) and (texts[index - 1] if index else 'and') == 'and' \
+                and texts[index + 1] == '=' and index + 2 < len(where) and words[where[index + 2]][1] == 'number' \
+                and '.' not in texts[index + 2] and texts[index + 3] in ('and', None):
+            shards.add(shard_of(texts[index + 2], manifest['n_shards']))
+    keys = manifest['colocated_keys'] | {SHARD_KEY}
+    for child in block['children']:
+        # <column> IN (<pinned block>), as a whole conjunct of the WHERE clause
+        before = child['before'] + [None, None]
+        if child['clause'] == 'where' and before[0] == 'in' and before[2] in ('where', 'and') \
+                and any(_is_column(before[1], key, aliases) for key in keys):
+            child_shards = _block_shards(words, child, manifest)
+            if child_shards is not None:
+                shards |= child_shards
+    # Rows of several shards would all have to match: keep the pin only if it names one shard
+    return shards if len(shards) == 1 else None
+
+def _select_items(words, span):
+    """(start, end) word spans of the comma-separated items of a select list"""
+    items, level, item_start = [], 0, span[0]
+    for position in range(*span):
+        text = words[position][2]
+        if text == '(':
+            level += 1
+        elif text == ')':
+            level -= 1
+        elif text == ',' and level == 0:
+            items.append((item_start, position))
+            item_start = position + 1
+    items.append((item_start, span[1]))
+    return items
+
+def _aggregate_item(words, match, item):
+    """(function, argument span, alias) if the item is exactly one supported aggregate call"""
+    start, end = item
+    if end - start < 3 or words[start][2] not in _AGGREGATES or words[start + 1][2] != '(':
+        return None
+    close = match.get(start + 1)
+    if close is None or words[start + 2][2] == 'distinct':
+        return None
+    argument = (start + 2, close)
+    if any(words[p][2] == ',' for p in range(*argument)):
+        return None
+    rest = [words[p] for p in range(close + 1, end)]
+    if not rest:
+        return words[start][2], argument, None
+    if len(rest) in (1, 2) and (len(rest) == 1 or rest[0][2] == 'as') and rest[-1][1] in ('word', 'ident'):
+        return words[start][2], argument, rest[-1]
+    return None
+
+def _text(tokens, words, start, end):
+    """Original text of words[start:end], with the spacing between them"""
+    if start >= end:
+        return ''
+    return ''.join(text for _, text in tokens[words[start][0]:words[end - 1][0] + 1])
+
+def _column_name(tokens, words, item, alias):
+    """Result column name SQLite gives a select item: its alias, else the expression as written"""
+    if alias is None:
+        return _text(tokens, words, *item)
+    text = tokens[alias[0]][1]
+    return text[1:-1] if alias[1] == 'ident' else text
+
+def plan_query(sql, manifest):
+    """How to run sql over the shards
+
+    {'kind': 'route', 'shard': i} when every block that reads sharded rows is
+    pinned to one subject's shard (or no block reads them); {'kind':
+    'scatter_rows'|'scatter_aggregate', 'sql': ...} for a single-source query
+    with no grouping, ordering, limit or DISTINCT (the aggregates being COUNT,
+    SUM, MIN, MAX and AVG); {'kind': 'full'} otherwise.
+    """
+    tokens, words = _words(sql)
+    if not words or words[0][2] != 'select':
+        return {'kind': 'full'}
+    match = _matching_parens(words)
+    top = _parse_block(words, match, 0, len(words))
+    blocks = list(_blocks(top))
+    if any('unparsed' in block['flags'] for block in blocks):
+        return {'kind': 'full'}
+
+    # Route: every block that reads a sharded table directly sees only one shard's rows
+    shards = set()
+    for block in blocks:
+        if not any(isinstance(block['sources'][alias], str) for alias in _sharded_sources(block, manifest)):
+            continue
+        block_shards = _block_shards(words, block, manifest)
+        if block_shards is None:
+            shards = None
+            break
+        shards |= block_shards
+    if shards is not None and len(shards) <= 1:
+        return {'kind': 'route', 'shard': shards.pop() if shards else 0}
+
+    # Scatter: one sharded table, subqueries over replicated tables only, rows combine by concatenation
+    sources = _sharded_sources(top, manifest)
+    if len(sources) != 1 or not isinstance(top['sources'][sources[0]], str) \
+            or top['flags'] & {'group', 'order', 'limit', 'having', 'window', 'distinct', 'compound'} \
+            or any(_reads_sharded(child, manifest) for child in top['children']) \
+            or any(isinstance(s, dict) for s in top['sources'].values()):
+        return {'kind': 'full'}
+    items = _select_items(words, top['spans']['select'])
+    aggregates = [_aggregate_item(words, match, item) for item in items]
+    if not any(aggregates):
+        if any(words[p][2] in _AGGREGATES and p + 1 < len(words) and words[p + 1][2] == '('
+               for item in items for p in range(*item)):
+            return {'kind': 'full'}
+        return {'kind': 'scatter_rows', 'sql': sql}
+    if not all(aggregates):
+        return {'kind': 'full'}
+
+    partials, merges = [], []
+    for number, ((function, argument, alias), item) in enumerate(zip(aggregates, items)):
+        argument_text = _text(tokens, words, *argument)
+        name = _column_name(tokens, words, item, alias).replace('"', '""')
+        if function == 'avg':
+            partials += [f"TOTAL({argument_text}) AS p{number}_sum", f"COUNT({argument_text}) AS p{number}_count"]
+            merges.append(f'SUM(p{number}_sum) / SUM(p{number}_count) AS "{name}"')
+        else:
+            partials.append(f"{function.upper()}({argument_text}) AS p{number}")
+            merge = 'SUM' if function in ('count', 'sum') else function.upper()
+            merges.append(f'{merge}(p{number}) AS "{name}"')
+    select_start, select_end = top['spans']['select']
+    shard_sql = (''.join(text for _, text in tokens[:words[select_start][0]]) + ', '.join(partials) + ' '
+                 + ''.join(text for _, text in tokens[words[select_end][0]:]))
+    return {'kind': 'scatter_aggregate', 'sql': shard_sql, 'merge': ', '.join(merges)}
+
+# ---------------------------------------------------------------------------
+# Execution
+
+_WORKER_PATHS = []
+_WORKER_CONNECTIONS = {}
+
+def _init_worker(paths):
+    global _WORKER_PATHS
+    _WORKER_PATHS = paths
+
+def _run_on_shard(task):
+    """(column names, rows, error) of one query on one shard, in a worker process"""
+    index, sql = task
+    conn = _WORKER_CONNECTIONS.get(index)
+    if conn is None:
+        conn = _WORKER_CONNECTIONS[index] = sqlite3.connect(f"file:{_WORKER_PATHS[index]}?mode=ro", uri=True)
+    try:
+        cursor = conn.execute(sql)
+        rows = cursor.fetchall()
+        return [column[0] for column in cursor.description], rows, None
+    except (sqlite3.Error, sqlite3.Warning) as e:
+        return None, None, str(e)
+
+def _merge_aggregates(columns, rows, merge):
+    """Combine per-shard partial aggregates with SQLite's own arithmetic and NULL rules"""
+    conn = sqlite3.connect(':memory:')
+    try:
+        conn.execute(f"CREATE TABLE partial ({', '.join(columns)})")
+        conn.executemany(f"INSERT INTO partial VALUES ({', '.join('?' * len(columns))})", rows)
+        return pd.read_sql_query(f"SELECT {merge} FROM partial", conn)
+    finally:
+        conn.close()
+
+class ShardedExecutor:
+    """Runs queries over subject-sharded copies of a database in worker processes
+
+    Queries pinned to one subject go to that subject's shard; supported
+    row-returning and COUNT/SUM/MIN/MAX/AVG queries run on every shard in
+    parallel and are merged; everything else (and any shard error) runs on
+    the full database. Shards cut from an older database file are not used.
+    """
+
+    def __init__(self, shard_dir, db_path='mimic_iv.sqlite', processes=None, metrics=PIPELINE_METRICS):
+        self.manifest = load_manifest(shard_dir)
+        self.db_path = db_path
+        self.n_shards = self.manifest['n_shards']
+        self.metrics = metrics
+        self.current = manifest_current(self.manifest, db_path)
+        if not self.current:
+            print(f"Shards in {shard_dir} were not cut from {db_path} as it is now; rerun db_shards.py --build. "
+                  "Queries run on the full database.")
+        paths = [shard_path(shard_dir, i) for i in range(self.n_shards)] + [db_path]
+        self._pool = Pool(processes or min(self.n_shards, os.cpu_count() or 1), initializer=_init_worker,
+                          initargs=(paths,))
+
+    def plan(self, sql_query):
+        return plan_query(sql_query, self.manifest) if self.current else {'kind': 'full'}
+
+    def _full(self, sql_query):
+        columns, rows, error = self._pool.apply(_run_on_shard, ((self.n_shards, sql_query),))
+        if error:
+            return {"success": False, "error": error}
+        return {"success": True, "data": pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)}
+
+    def execute(self, sql_query):
+        """Same contract as db_executor.execute_sql_query, plus the plan kind used"""
+        plan = self.plan(sql_query)
+        if plan['kind'] == 'route':
+            results = [self._pool.apply(_run_on_shard, ((plan['shard'], sql_query),))]
+        elif plan['kind'] in ('scatter_rows', 'scatter_aggregate'):
+            results = self._pool.map(_run_on_shard, [(i, plan['sql']) for i in range(self.n_shards)])
+        else:
+            results = None
+        if results is None or any(error for _, _, error in results):
+            # Unsupported shape, or a shard could not run it: answer from the full database
+            kind = 'full' if results is None else 'fallback'
+            self.metrics.increment(f"shard_plan_{kind}")
+            result = self._full(sql_query)
+            result['plan'] = kind
+            return result
+        self.metrics.increment(f"shard_plan_{plan['kind']}")
+        columns = results[0][0]
+        rows = [row for _, shard_rows, _ in results for row in shard_rows]
+        if plan['kind'] == 'scatter_aggregate':
+            data = _merge_aggregates(columns, rows, plan['merge'])
+        else:
+            data = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+        return {"success": True, "data": data, "plan": plan['kind']}
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+# ---------------------------------------------------------------------------
+# Verification against the unsharded database
+
+def _normalize(value):
+    # Partial sums are added in a different order than one full scan, so floats agree to ~1e-12
+    return float(f"{value:.9g}") if isinstance(value, float) else value
+
+def same_result(a, b):
+    """Identical columns and rows, ignoring row order and float rounding in the last digits"""
+    if a is None or b is None:
+        return a is None and b is None
+    if list(a.columns) != list(b.columns) or len(a) != len(b):
+        return False
+    if a.equals(b):
+        return True
+    key = lambda df: sorted(repr(tuple(map(_normalize, row))) for row in df.itertuples(index=False, name=None))
+    return key(a) == key(b)
+
+def verify_shards(executor, db_path, csv_paths, limit=None):
+    """Run each distinct gold query on the full database and through the shards; compare and time both"""
+    queries = pd.concat([pd.read_csv(path) for path in csv_paths])['query'].dropna().unique()
+    if limit:
+        queries = queries[:limit]
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    rows = []
+    try:
+        for sql in queries:
+            start_time = time.perf_counter()
+            try:
+                expected, expected_error = pd.read_sql_query(sql, conn), None
+            except Exception as e:
+                expected, expected_error = None, str(e.__cause__ or e)
+            full_seconds = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            result = executor.execute(sql)
+            sharded_seconds = time.perf_counter() - start_time
+            rows.append({
+                'query': sql,
+                'plan': result['plan'],
+                'identical': same_result(expected, result.get('data')) and bool(expected_error) != result['success'],
+                'full_ms': full_seconds * 1000,
+                'sharded_ms': sharded_seconds * 1000
+            })
+    finally:
+        conn.close()
+    return pd.DataFrame(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description='Split the database into subject_id shards and verify sharded execution')
+    parser.add_argument('--db', default='./mimic_iv.sqlite', help='Path to the full SQLite database')
+    parser.add_argument('--shard-dir', default='./shards', help='Directory for the shard files and manifest')
+    parser.add_argument('--build', type=int, metavar='N', help='(Re)build N shards from --db')
+    parser.add_argument('--processes', type=int, help='Worker processes (default: one per shard, up to the CPU count)')
+    parser.add_argument('--verify', nargs='*', help='CSV files whose gold queries are compared with the full database')
+    parser.add_argument('--limit', type=int, help='Verify at most N distinct queries')
+    parser.add_argument('--output', help='Write the per-query verification report (CSV)')
+    args = parser.parse_args()
+
+    if args.build:
+        manifest = shard_database(args.db, args.shard_dir, args.build)
+        sizes = [os.path.getsize(shard_path(args.shard_dir, i)) / 1e6 for i in range(args.build)]
+        print(f"Built {args.build} shards in {args.shard_dir} ({min(sizes):.1f}-{max(sizes):.1f} MB each)")
+        print(f"Sharded: {', '.join(sorted(manifest['sharded_tables']))}")
+        print(f"Replicated: {', '.join(manifest['replicated_tables']) or 'none'}")
+        print(f"Co-located keys: {', '.join(manifest['colocated_keys']) or 'none'}")
+
+    if args.verify:
+        executor = ShardedExecutor(args.shard_dir, args.db, args.processes)
+        try:
+            report = verify_shards(executor, args.db, args.verify, args.limit)
+        finally:
+            executor.close()
+        if args.output:
+            report.to_csv(args.output, index=False)
+        mismatches = int((~report['identical']).sum())
+        print(f"Queries: {len(report)}, identical results: {len(report) - mismatches}")
+        for plan, group in report.groupby('plan'):
+            print(f"  {plan:<18}{len(group):>6} queries, median {group['full_ms'].median():.1f} ms full -> "
+                  f"{group['sharded_ms'].median():.1f} ms sharded")
+        if mismatches:
+            print(f"{mismatches} queries returned different results through the shards")
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import os
+import re
+import glob
+import hashlib
+import argparse
+import numpy as np
+from mmap_store import save_array
+
+DEFAULT_MODEL_NAME = 'all-MiniLM-L6-v2'
+# Directory of the store inside a vector DB dir
+STORE_DIR_NAME = 'embedding_store'
+KEY_DTYPE = 'S16'
+
+def text_keys(model_name, texts):
+    """Content address of each text: a 128-bit hash of (model name, text)"""
+    prefix = f"{model_name}\0".encode()
+    return np.array([hashlib.blake2b(prefix + text.encode(), digest_size=16).digest() for text in texts],
+                    dtype=KEY_DTYPE)
+
+def store_dir(vector_db_dir):
+    return os.path.join(vector_db_dir, STORE_DIR_NAME)
+
+class EmbeddingStore:
+    """Embeddings of one model, keyed by text_keys, shared by every vectorizer
+
+    On disk: one memory-mapped .npy of (key, float32 vector) entries sorted by
+    key, replaced atomically, plus one refs_<consumer>.npy per vectorizer with
+    the keys its last build used. encode() returns stored vectors and encodes only the misses
+    (loading the model only if there are any); save() merges new vectors and
+    drops entries no consumer references anymore.
+    """
+
+    def __init__(self, directory, model_name=DEFAULT_MODEL_NAME):
+        self.directory = directory
+        self.model_name = model_name
+        slug = re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name)
+        self.prefix = os.path.join(directory, slug)
+        self.pending = {}
+        self.refs = {}
+        self.last_stats = {}
+        self._load()
+
+    def _path(self, name):
+        return f"{self.prefix}_{name}.npy"
+
+    def _load(self):
+        self.keys = np.zeros(0, dtype=KEY_DTYPE)
+        self.vectors = None
+        if os.path.exists(self._path('entries')):
+            entries = np.load(self._path('entries'), mmap_mode='r')
+            self.keys, self.vectors = entries['key'], entries['vector']
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, keys):
+        """Row of each key in the store, -1 where it is missing"""
+        positions = np.searchsorted(self.keys, keys)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == keys[found]
+        return np.where(found, positions, -1)
+
+    def encode(self, texts, model=None, consumer=None, show_progress_bar=True):
+        """Embeddings of texts (a new float32 array), encoding only texts not stored yet
+
+        model is loaded by name on the first miss when not given. consumer names
+        the caller whose references keep these entries alive through gc.
+        """
+        keys = text_keys(self.model_name, texts)
+        positions = self.lookup(keys)
+        misses = {}
+        for i in np.flatnonzero(positions < 0):
+            if keys[i] not in self.pending:
+                misses.setdefault(keys[i], texts[i])
+        if misses:
+            if model is None:
+                from sentence_transformers import SentenceTransformer
+                model = SentenceTransformer(self.model_name)
+            fresh = np.asarray(model.encode(list(misses.values()), show_progress_bar=show_progress_bar),
+                               dtype=np.float32)
+            if self.vectors is not None and len(self.vectors) and fresh.shape[1] != self.vectors.shape[1]:
+                raise ValueError(f"{self.model_name} now returns {fresh.shape[1]}-dim embeddings but "
+                                 f"{self.directory} stores {self.vectors.shape[1]}-dim ones; delete the store")
+            self.pending.update(zip(misses, fresh))
+        if self.pending:
+            dimension = len(next(iter(self.pending.values())))
+        else:
+            dimension = self.vectors.shape[1] if self.vectors is not None else 0
+        embeddings = np.empty((len(texts), dimension), dtype=np.float32)
+        hits = positions >= 0
+        if hits.any():
+            embeddings[hits] = self.vectors[positions[hits]]
+        for i in np.flatnonzero(~hits):
+            embeddings[i] = self.pending[keys[i]]
+        if consumer:
+            self.refs[consumer] = np.unique(keys)
+        reused = int((positions >= 0).sum())
+        self.last_stats = {'texts': len(texts), 'reused': reused, 'encoded': len(misses),
+                           'reuse_ratio': reused / len(texts) if len(texts) else 1.0}
+        print(f"Embedding store{f' ({consumer})' if consumer else ''}: {reused}/{len(texts)} embeddings reused "
+              f"({self.last_stats['reuse_ratio']:.1%}), {len(misses)} encoded")
+        return embeddings
+
+    def _ref_paths(self):
+        """Consumer name -> path of its saved refs"""
+        start = len(os.path.basename(self.prefix)) + len('_refs_')
+        return {os.path.basename(path)[start:-len('.npy')]: path for path in glob.glob(self._path('refs_*'))}
+
+    def referenced_keys(self):
+        """Keys referenced by any consumer (unsaved refs of this instance included), None if there are no consumers"""
+        refs = dict(self.refs)
+        for consumer, path in self._ref_paths().items():
+            if consumer not in refs:
+                refs[consumer] = np.load(path)
+        if not refs:
+            return None
+        return np.unique(np.concatenate(list(refs.values())))
+
+    def drop_consumer(self, consumer):
+        """Forget a vectorizer's refs, so the next gc can drop entries only it used"""
+        self.refs.pop(consumer, None)
+        path = self._ref_paths().get(consumer)
+        if path:
+            os.remove(path)
+
+    def save(self, gc=True):
+        """Write new vectors and consumer refs; with gc, drop entries no consumer references
+
+        Returns the number of entries dropped.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        for consumer, keys in self.refs.items():
+            save_array(self._path(f"refs_{consumer}"), keys)
+        keys = np.concatenate([np.asarray(self.keys), np.array(list(self.pending), dtype=KEY_DTYPE)])
+        if not len(keys):
+            return 0
+        parts = [np.asarray(self.vectors)] if self.vectors is not None and len(self.vectors) else []
+        if self.pending:
+            parts.append(np.stack(list(self.pending.values())))
+        vectors = np.concatenate(parts)
+        referenced = self.referenced_keys() if gc else None
+        keep = np.isin(keys, referenced) if referenced is not None else np.ones(len(keys), dtype=bool)
+        dropped = int((~keep).sum())
+        if not self.pending and not dropped:
+            return 0
+        order = np.argsort(keys[keep], kind='stable')
+        entries = np.empty(len(order), dtype=[('key', KEY_DTYPE), ('vector', np.float32, vectors.shape[1])])
+        entries['key'] = keys[keep][order]
+        entries['vector'] = vectors[keep][order]
+        save_array(self._path('entries'), entries)
+        self.pending = {}
+        self._load()
+        return dropped
+
+    def stats(self):
+        referenced = self.referenced_keys()
+        return {
+            'model': self.model_name,
+            'entries': len(self),
+            'dimension': int(self.vectors.shape[1]) if self.vectors is not None and len(self.vectors) else None,
+            'bytes': os.path.getsize(self._path('entries')) if self.vectors is not None else 0,
+            'consumers': sorted(self._ref_paths()),
+            'unreferenced': int((~np.isin(self.keys, referenced)).sum()) if referenced is not None else 0
+        }
+
+def encode_with_store(texts, vector_db_dir, consumer, model_name=DEFAULT_MODEL_NAME, model=None,
+                      show_progress_bar=True):
+    """Encode through the vector DB's embedding store, then save it (collecting unreferenced entries)"""
+    store = EmbeddingStore(store_dir(vector_db_dir), model_name)
+    embeddings = store.encode(texts, model=model, consumer=consumer, show_progress_bar=show_progress_bar)
+    store.save()
+    return embeddings
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or garbage-collect the content-addressed embedding store')
+    parser.add_argument('--vector-db', default='vector_db', help='Vector DB directory holding the store')
+    parser.add_argument('--model', default=DEFAULT_MODEL_NAME, help='Embedding model name')
+    parser.add_argument('--gc', action='store_true', help='Drop entries that no vectorizer references anymore')
+    parser.add_argument('--drop-consumer', action='append', default=[],
+                        help='Forget the references of a vectorizer that is no longer built (e.g. schema_tables)')
+    args = parser.parse_args()
+
+    store = EmbeddingStore(store_dir(args.vector_db), args.model)
+    for consumer in args.drop_consumer:
+        store.drop_consumer(consumer)
+    if args.gc:
+        print(f"Dropped {store.save(gc=True)} unreferenced embeddings")
+    stats = store.stats()
+    print(f"{stats['model']}: {stats['entries']} embeddings ({stats['bytes'] / 1e6:.1f} MB, dim {stats['dimension']}), "
+          f"{stats['unreferenced']} unreferenced; consumers: {', '.join(stats['consumers']) or 'none'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import numpy as np
+import pandas as pd
+from sql_canonical import canonical_tokens
+
+# SQL functions whose presence marks a time filter
+_TIME_FUNCTIONS = {'strftime', 'datetime', 'date', 'julianday', 'current_time'}
+# Strata of rows without a template, split by whether they have gold SQL
+UNANSWERABLE = 'unanswerable'
+NO_TEMPLATE = 'no_template'
+
+def sql_shape(sql):
+    """Coarse shape of a gold query: which of joins, window functions, time filters and subqueries it uses"""
+    if not isinstance(sql, str) or not sql.strip():
+        return 'none'
+    tokens = canonical_tokens(sql, parameterize=True)
+    flags = [
+        ('join', 'join' in tokens),
+        ('window', any(t == 'over' and nxt == '(' for t, nxt in zip(tokens, tokens[1:]))),
+        ('time', any(t in _TIME_FUNCTIONS for t in tokens)),
+        ('nested', tokens.count('select') > 1)
+    ]
+    return '+'.join(name for name, present in flags if present) or 'simple'
+
+def stratum_keys(df, by_shape=False):
+    """Stratum of each row: its template (and SQL shape with by_shape)"""
+    keys = []
+    queries = df['query'] if 'query' in df.columns else pd.Series(None, index=df.index)
+    templates = df['template'] if 'template' in df.columns else pd.Series(None, index=df.index)
+    for template, query in zip(templates, queries):
+        if isinstance(template, str) and template:
+            key = template
+        else:
+            key = NO_TEMPLATE if isinstance(query, str) else UNANSWERABLE
+        if by_shape and isinstance(query, str):
+            key = f"{key} | {sql_shape(query)}"
+        keys.append(key)
+    return pd.Series(keys, index=df.index)
+
+def allocate(stratum_sizes, size):
+    """Rows to draw per stratum: one each, the rest proportional to stratum size (largest remainder)"""
+    sizes = np.asarray(stratum_sizes, dtype=np.int64)
+    counts = np.minimum(sizes, 1)
+    while counts.sum() < min(size, sizes.sum()):
+        room = sizes - counts
+        extra = min(size, sizes.sum()) - counts.sum()
+        share = extra * np.where(room > 0, sizes, 0) / sizes[room > 0].sum()
+        add = np.minimum(np.floor(share).astype(np.int64), room)
+        if add.sum() == 0:
+            # Hand out the remainder one row at a time, largest fractional share first
+            order = np.argsort(-(share - np.floor(share)), kind='stable')
+            add[[i for i in order if room[i] > 0][:extra]] = 1
+        counts += add
+    return counts
+
+def stratified_sample(df, size, seed=0, by_shape=False):
+    """Fixed-seed subset of about `size` rows that covers every stratum
+
+    Each stratum contributes at least one row (so size is raised to the number of
+    strata), the rest is spread in proportion to stratum size. The returned rows
+    keep the file order and carry their stratum, stratum_size (rows of the stratum
+    in df) and sample_weight (stratum_size / rows drawn from it).
+    """
+    strata = stratum_keys(df, by_shape)
+    groups = {key: rows for key, rows in strata.groupby(strata, sort=True).groups.items()}
+    keys = sorted(groups)
+    counts = allocate([len(groups[key]) for key in keys], size)
+    rng = np.random.default_rng(seed)
+    chosen, stratum_size, weight = [], {}, {}
+    for key, count in zip(keys, counts):
+        rows = groups[key]
+        picked = rng.choice(len(rows), count, replace=False)
+        chosen.extend(rows[picked])
+        stratum_size[key] = len(rows)
+        weight[key] = len(rows) / count
+    sample = df.loc[sorted(chosen, key=df.index.get_loc)].copy()
+    sample['stratum'] = strata.loc[sample.index]
+    sample['stratum_size'] = sample['stratum'].map(stratum_size)
+    sample['sample_weight'] = sample['stratum'].map(weight)
+    return sample
+
+def weighted_quantile(values, weights, q):
+    values, weights = np.asarray(values, dtype=float), np.asarray(weights, dtype=float)
+    order = np.argsort(values)
+    cumulative = np.cumsum(weights[order])
+    return float(values[order][np.searchsorted(cumulative, q * cumulative[-1])])
+
+def weighted_metrics(results, columns, latency_column=None):
+    """Estimate full-distribution means of `columns` from evaluated sample rows
+
+    results needs the stratum and stratum_size columns of stratified_sample.
+    Each stratum's mean is weighted by its share of the population (strata
+    without evaluated rows are left out and reported as missing). The standard
+    error is the stratified one; strata with a single row borrow the variance
+    of the whole sample. With latency_column, weighted p50/p95 are added too.
+    """
+    covered = results.groupby('stratum')
+    population = covered['stratum_size'].first()
+    shares = population / population.sum()
+    estimates = {}
+    for column in columns:
+        values = results[column].astype(float)
+        means = values.groupby(results['stratum']).mean()
+        counts = values.groupby(results['stratum']).count()
+        fallback = values.var(ddof=1) if len(values) > 1 else 0.0
+        variances = values.groupby(results['stratum']).var(ddof=1).fillna(fallback)
+        finite = 1 - counts / population
+        estimates[column] = {
+            'estimate': float((shares * means).sum()),
+            'stderr': float(np.sqrt((shares ** 2 * finite * variances / counts).sum())),
+            'unweighted': float(values.mean())
+        }
+    summary = {
+        'metrics': estimates,
+        'sampled_rows': len(results),
+        'strata_evaluated': len(population),
+        'population_covered': int(population.sum())
+    }
+    if latency_column is not None and results[latency_column].notna().any():
+        timed = results[results[latency_column].notna()]
+        weights = timed['stratum_size'] / timed.groupby('stratum')[latency_column].transform('count')
+        summary['latency'] = {
+            'mean': float(np.average(timed[latency_column], weights=weights)),
+            'p50': weighted_quantile(timed[latency_column], weights, 0.5),
+            'p95': weighted_quantile(timed[latency_column], weights, 0.95)
+        }
+    return summary
+
+def print_weighted_metrics(summary, total_strata=None):
+    strata = f"{summary['strata_evaluated']}" + (f"/{total_strata}" if total_strata else "")
+    print(f"Weighted to the full distribution ({summary['sampled_rows']} sampled rows, {strata} strata, "
+          f"{summary['population_covered']} rows represented):")
+    for column, figures in summary['metrics'].items():
+        print(f"  {column}: {figures['estimate']:.2%} +/- {1.96 * figures['stderr']:.2%} "
+              f"(unweighted {figures['unweighted']:.2%})")
+    if 'latency' in summary:
+        latency = summary['latency']
+        print(f"  latency: mean {latency['mean']:.2f}s, p50 {latency['p50']:.2f}s, p95 {latency['p95']:.2f}s")
+
+def add_sampling_arguments(parser):
+    """Add the --sample/--sample-seed/--stratify-shape CLI flags"""
+    parser.add_argument('--sample', type=int,
+                        help='Evaluate a stratified sample of about N rows covering every template, '
+                             'with metrics weighted back to the full test set')
+    parser.add_argument('--sample-seed', type=int, default=0, help='Seed of the stratified sample')
+    parser.add_argument('--stratify-shape', action='store_true',
+                        help='Also stratify by SQL shape (joins, window functions, time filters, subqueries)')
@@ -1,10 +1,15 @@
+import argparse
 import pandas as pd
 import time
 import logging
 import sys
 from tqdm import tqdm
-from main_v1 import process_user_query, clean_sql, evaluate_sql_match
+from main import process_user_query
+from sql_canonical import clean_sql
+from sql_structure import CLAUSES, score_frame, score_results_file, summarize_scores
 from query_processor import load_embedding_model
+from llm_backend import add_backend_arguments, configure_backend_from_args
+from eval_sampling import add_sampling_arguments, stratified_sample, weighted_metrics, print_weighted_metrics
 
 # Configure logging
 logging.basicConfig(
@@ -19,37 +24,22 @@ class StructuralSQLEvaluator:
         self.model = model
         self.metrics = {
             'total': 0,
-            'perfect_structural': 0,
-            'avg_select_f1': 0,
-            'avg_from_f1': 0,
-            'avg_where_f1': 0,
             'latency': []
         }
 
     def evaluate_row(self, row):
+        """Generate SQL for one row; scoring happens for the whole dataset afterwards"""
         start_time = time.time()
         try:
             gen_result = process_user_query(row['question'], self.model)
             generated_sql = clean_sql(gen_result['sql_query'])
-            ground_truth_sql = clean_sql(row['query'])
-            scores = evaluate_sql_match(generated_sql, ground_truth_sql)
             elapsed = time.time() - start_time
             self.metrics['latency'].append(elapsed)
-            perfect = all(scores[k]['f1'] == 1 for k in scores)
-            if perfect:
-                self.metrics['perfect_structural'] += 1
-            self.metrics['avg_select_f1'] += scores['select']['f1']
-            self.metrics['avg_from_f1'] += scores['from']['f1']
-            self.metrics['avg_where_f1'] += scores['where']['f1']
             return {
                 'id': row.get('id', 'unknown'),
                 'question': row['question'],
                 'generated_sql': generated_sql,
-                'ground_truth_sql': ground_truth_sql,
-                'select_f1': scores['select']['f1'],
-                'from_f1': scores['from']['f1'],
-                'where_f1': scores['where']['f1'],
-                'structural_match': perfect,
+                'ground_truth_sql': clean_sql(row['query']),
                 'latency': elapsed
             }
         except Exception as e:
@@ -57,43 +47,71 @@ class StructuralSQLEvaluator:
             return {
                 'id': row.get('id', 'unknown'),
                 'question': row['question'],
-                'generated_sql': "ERROR",
+                'generated_sql': None,
                 'ground_truth_sql': row.get('query', ""),
-                'select_f1': 0,
-                'from_f1': 0,
-                'where_f1': 0,
-                'structural_match': False,
                 'latency': 0,
                 'error': str(e)
             }
 
-    def evaluate_dataset(self, test_path):
+    def evaluate_dataset(self, test_path, limit=10, sample=None, sample_seed=0, stratify_shape=False):
+        """Score the first `limit` rows, or a stratified `sample` with metrics weighted to the whole file"""
         test_df = pd.read_csv(test_path)
-        test_df = test_df.dropna(subset=['question', 'query']).head(10)
+        test_df = test_df.dropna(subset=['question', 'query'])
+        if sample is not None:
+            test_df = stratified_sample(test_df, sample, seed=sample_seed, by_shape=stratify_shape)
+        else:
+            test_df = test_df.head(limit)
         results = []
         for i, row in tqdm(test_df.iterrows(), total=len(test_df), desc="Evaluating (structural)"):
             self.metrics['total'] += 1
             results.append(self.evaluate_row(row))
+        scored = score_frame(pd.DataFrame(results), 'generated_sql', 'ground_truth_sql')
         n = self.metrics['total']
-        self.metrics['avg_select_f1'] /= n
-        self.metrics['avg_from_f1'] /= n
-        self.metrics['avg_where_f1'] /= n
+        self.metrics.update(summarize_scores(scored))
         self.metrics['avg_latency'] = sum(self.metrics['latency']) / n if n else 0
-        self.metrics['structural_accuracy'] = self.metrics['perfect_structural'] / n if n else 0
-        return pd.DataFrame(results), self.metrics
+        if sample is not None and n:
+            scored[['stratum', 'stratum_size']] = test_df[['stratum', 'stratum_size']].to_numpy()
+            columns = ['structural_match'] + [f'{clause}_f1' for clause in CLAUSES]
+            self.metrics['sample'] = dict(weighted_metrics(scored, columns, 'latency'),
+                                          strata=int(test_df['stratum'].nunique()))
+        return scored, self.metrics
+
+def print_metrics(metrics):
+    print(f"\nStructural Evaluation Metrics ({metrics['total']} test cases):")
+    print(f"Perfect Structural Match: {metrics['structural_accuracy']:.2%}")
+    for clause in CLAUSES:
+        print(f"Avg {clause.replace('_', ' ').upper()} F1: {metrics[f'avg_{clause}_f1']:.2f}")
+    if 'avg_latency' in metrics:
+        print(f"Average Latency: {metrics['avg_latency']:.2f}s")
+    if 'sample' in metrics:
+        print_weighted_metrics(metrics['sample'], metrics['sample']['strata'])
 
 def main():
+    parser = argparse.ArgumentParser(description='Structural SQL evaluation')
+    parser.add_argument('--test', default='./schema/test.csv', help='Path to test CSV file')
+    parser.add_argument('--limit', type=int, default=10, help='Number of test rows to generate SQL for')
+    add_sampling_arguments(parser)
+    parser.add_argument('--results', help='Score an existing detailed_results.csv offline instead of generating SQL')
+    parser.add_argument('--processes', type=int, help='Worker processes for offline scoring (default: CPU count)')
+    parser.add_argument('--output', default='structural_evaluation_results.csv', help='Where to write scored rows')
+    add_backend_arguments(parser)
+    args = parser.parse_args()
+
+    if args.results:
+        scored = score_results_file(args.results, processes=args.processes)
+        scored.to_csv(args.output, index=False)
+        print_metrics(summarize_scores(scored))
+        return
+
+    configure_backend_from_args(args)
     model = load_embedding_model()
     evaluator = StructuralSQLEvaluator(model)
     try:
-        results_df, metrics = evaluator.evaluate_dataset('./schema/test.csv')
-        results_df.to_csv('structural_evaluation_results.csv', index=False)
-        print(f"\nStructural Evaluation Metrics ({metrics['total']} test cases):")
-        print(f"Perfect Structural Match: {metrics['structural_accuracy']:.2%}")
-        print(f"Avg SELECT F1: {metrics['avg_select_f1']:.2f}")
-        print(f"Avg FROM F1: {metrics['avg_from_f1']:.2f}")
-        print(f"Avg WHERE F1: {metrics['avg_where_f1']:.2f}")
-        print(f"Average Latency: {metrics['avg_latency']:.2f}s")
+        results_df, metrics = evaluator.evaluate_dataset(args.test, args.limit, sample=args.sample,
+                                                         sample_seed=args.sample_seed,
+                                                         stratify_shape=args.stratify_shape)
+        results_df.to_csv(args.output, index=False)
+        print_metrics(metrics)
     except Exception as e:
         logger.critical(f"Evaluation failed: {e}")
         raise
@@ -0,0 +1,288 @@
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from metrics import PIPELINE_METRICS, StageHistogram
+
+DEFAULT_MODEL_NAME = 'gemini-1.5-pro'
+
+def prompt_hash(prompt, model_name=DEFAULT_MODEL_NAME, generation_config=None):
+    """Stable hash of a generation request (model, config and prompt text)"""
+    payload = json.dumps([model_name, generation_config or {}, prompt], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class CassetteMissError(KeyError):
+    """Raised in replay mode when a prompt was never recorded"""
+
+class GeminiBackend:
+    """Live backend calling the Gemini API"""
+    mode = 'live'
+    needs_api_key = True
+
+    def __init__(self, model_name=DEFAULT_MODEL_NAME, api_key=None):
+        self.model_name = model_name
+        self.api_key = api_key or os.getenv("GEMINI_API_KEY")
+
+    def generate(self, prompt, generation_config=None):
+        """Send the prompt to Gemini and return the response text"""
+        import google.generativeai as genai
+        genai.configure(api_key=self.api_key)
+        model = genai.GenerativeModel(self.model_name)
+        response = model.generate_content(prompt, generation_config=generation_config)
+        return response.text
+
+class Cassette:
+    """Append-only JSONL store of recorded responses keyed by prompt hash"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A crash mid-write leaves at most one truncated last line
+                        continue
+                    self.entries[entry['prompt_hash']] = entry
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def append(self, entry):
+        """Persist one recorded response"""
+        with self._lock:
+            self.entries[entry['prompt_hash']] = entry
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+
+class RecordingBackend:
+    """Calls an inner backend and records every response with its latency"""
+    mode = 'record'
+
+    def __init__(self, inner, cassette_path):
+        self.inner = inner
+        self.model_name = inner.model_name
+        self.needs_api_key = inner.needs_api_key
+        self.api_key = getattr(inner, 'api_key', None)
+        self.cassette = Cassette(cassette_path)
+
+    def generate(self, prompt, generation_config=None):
+        start_time = time.perf_counter()
+        text = self.inner.generate(prompt, generation_config)
+        latency = time.perf_counter() - start_time
+        self.cassette.append({
+            'prompt_hash': prompt_hash(prompt, self.model_name, generation_config),
+            'model': self.model_name,
+            'response': text,
+            'latency': latency
+        })
+        return text
+
+class ReplayBackend:
+    """Serves recorded responses from a cassette without network access"""
+    mode = 'replay'
+    needs_api_key = False
+    api_key = None
+
+    def __init__(self, cassette_path, model_name=DEFAULT_MODEL_NAME, replay_latency=False, latency_scale=1.0):
+        if not os.path.exists(cassette_path):
+            raise FileNotFoundError(f"Cassette not found: {cassette_path}")
+        self.model_name = model_name
+        self.replay_latency = replay_latency
+        self.latency_scale = latency_scale
+        self.cassette = Cassette(cassette_path)
+
+    def generate(self, prompt, generation_config=None):
+        entry = self.cassette.get(prompt_hash(prompt, self.model_name, generation_config))
+        if entry is None:
+            raise CassetteMissError(f"No recorded response for this prompt in {self.cassette.path}")
+        if self.replay_latency:
+            time.sleep(entry['latency'] * self.latency_scale)
+        return entry['response']
+
+class StubBackend:
+    """Offline backend answering from a callable (prompt -> text), for benchmarks and tests
+
+    With tail_probability, that share of calls (at random) takes tail_multiplier
+    times the latency, to imitate a long-tailed API.
+    """
+    mode = 'stub'
+    needs_api_key = False
+    api_key = None
+
+    def __init__(self, responder=None, latency=0.0, model_name='stub', tail_probability=0.0, tail_multiplier=1.0):
+        self.responder = responder or (lambda prompt: "SELECT 1")
+        self.latency = latency
+        self.model_name = model_name
+        self.tail_probability = tail_probability
+        self.tail_multiplier = tail_multiplier
+
+    def generate(self, prompt, generation_config=None):
+        latency = self.latency
+        if self.tail_probability and random.random() < self.tail_probability:
+            latency *= self.tail_multiplier
+        if latency:
+            time.sleep(latency)
+        return self.responder(prompt)
+
+class HedgedBackend:
+    """Issues a second identical request when the first is slower than usual
+
+    When the first request has not returned after the `percentile` of recently
+    observed request latencies, a hedge request is sent and whichever answers
+    first is used; the other is cancelled if still queued, otherwise left to
+    finish in the background (a blocking client call cannot be interrupted).
+    Hedges are capped at `budget` times the number of requests. Metrics:
+    llm_request (effective latency) and llm_unhedged (latency of the first
+    request alone, i.e. without hedging) histograms, and hedge_fired /
+    hedge_won / hedge_skipped_budget counters.
+    """
+
+    def __init__(self, inner, percentile=95, budget=0.05, min_samples=20, window=256, max_workers=32,
+                 metrics=PIPELINE_METRICS):
+        self.inner = inner
+        self.model_name = inner.model_name
+        self.needs_api_key = inner.needs_api_key
+        self.api_key = getattr(inner, 'api_key', None)
+        self.mode = inner.mode
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.metrics = metrics
+        self.latencies = StageHistogram(window)
+        self.requests = 0
+        self.hedges = 0
+        self.won = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='llm-hedge')
+
+    def hedge_delay(self):
+        """Seconds to wait before hedging, or None while there are too few observations"""
+        with self._lock:
+            if len(self.latencies.samples) < self.min_samples:
+                return None
+            return self.latencies.percentile(self.percentile)
+
+    def summary(self):
+        """Hedge counts, and p95/p99 with hedging against the first requests alone"""
+        latency = self.metrics.summary()
+        effective, unhedged = latency.get('llm_request'), latency.get('llm_unhedged')
+        with self._lock:
+            summary = {'requests': self.requests, 'hedges': self.hedges, 'hedges_won': self.won,
+                       'hedge_rate': self.hedges / self.requests if self.requests else 0.0}
+        if effective and unhedged:
+            for p in ('p95', 'p99'):
+                summary.update({p: effective[p], f"unhedged_{p}": unhedged[p],
+                                f"{p}_improvement": 1 - effective[p] / unhedged[p] if unhedged[p] else 0.0})
+        return summary
+
+    def _timed(self, prompt, generation_config, record):
+        start_time = time.perf_counter()
+        try:
+            return self.inner.generate(prompt, generation_config)
+        finally:
+            if record:
+                elapsed = time.perf_counter() - start_time
+                with self._lock:
+                    self.latencies.observe(elapsed)
+                self.metrics.observe('llm_unhedged', elapsed)
+
+    def generate(self, prompt, generation_config=None):
+        start_time = time.perf_counter()
+        with self._lock:
+            self.requests += 1
+        # Only first requests feed the delay estimate, so hedging does not hide the tail it reacts to
+        first = self._executor.submit(self._timed, prompt, generation_config, True)
+        pending = {first}
+        done, _ = wait(pending, timeout=self.hedge_delay())
+        hedge = None
+        if not done:
+            with self._lock:
+                allowed = self.hedges + 1 <= self.budget * self.requests
+                if allowed:
+                    self.hedges += 1
+            if allowed:
+                self.metrics.increment('hedge_fired')
+                hedge = self._executor.submit(self._timed, prompt, generation_config, False)
+                pending.add(hedge)
+            else:
+                self.metrics.increment('hedge_skipped_budget')
+        try:
+            while True:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                winner = next((future for future in done if future.exception() is None), next(iter(done)))
+                # A failed request only decides the call when nothing else is left
+                if winner.exception() is None or not pending:
+                    break
+            if winner is hedge and winner.exception() is None:
+                with self._lock:
+                    self.won += 1
+                self.metrics.increment('hedge_won')
+            return winner.result()
+        finally:
+            for future in pending:
+                future.cancel()
+            self.metrics.observe('llm_request', time.perf_counter() - start_time)
+
+def create_backend(mode='live', cassette_path=None, replay_latency=False, model_name=DEFAULT_MODEL_NAME):
+    """Create an LLM backend: 'live', 'record' (live + cassette) or 'replay' (cassette only)"""
+    if mode == 'live':
+        return GeminiBackend(model_name)
+    if not cassette_path:
+        raise ValueError(f"LLM mode '{mode}' requires a cassette path")
+    if mode == 'record':
+        return RecordingBackend(GeminiBackend(model_name), cassette_path)
+    if mode == 'replay':
+        return ReplayBackend(cassette_path, model_name, replay_latency=replay_latency)
+    raise ValueError(f"Unknown LLM mode: {mode}")
+
+_default_backend = None
+
+def get_backend():
+    """Process-wide backend, configured from LLM_MODE / LLM_CASSETTE / LLM_REPLAY_LATENCY"""
+    global _default_backend
+    if _default_backend is None:
+        _default_backend = create_backend(
+            os.getenv("LLM_MODE", "live"),
+            os.getenv("LLM_CASSETTE"),
+            replay_latency=os.getenv("LLM_REPLAY_LATENCY", "0") == "1"
+        )
+    return _default_backend
+
+def set_backend(backend):
+    """Replace the process-wide backend (e.g. from CLI flags)"""
+    global _default_backend
+    _default_backend = backend
+
+def add_backend_arguments(parser):
+    """Add the shared --llm-mode/--cassette/--replay-latency CLI flags"""
+    parser.add_argument('--llm-mode', choices=['live', 'record', 'replay'], default=os.getenv("LLM_MODE", "live"),
+                        help='Call Gemini live, record responses to a cassette, or replay them offline')
+    parser.add_argument('--cassette', default=os.getenv("LLM_CASSETTE"), help='Path to the LLM cassette (JSONL)')
+    parser.add_argument('--replay-latency', action='store_true', help='Sleep for the recorded latency when replaying')
+    parser.add_argument('--hedge-percentile', type=float,
+                        help='Send a second identical LLM request once the first is slower than this latency percentile')
+    parser.add_argument('--hedge-budget', type=float, default=0.05,
+                        help='Maximum hedge requests as a fraction of all LLM requests')
+
+def hedge_from_args(backend, args):
+    """Wrap a backend in HedgedBackend when --hedge-percentile is set"""
+    if args.hedge_percentile is None:
+        return backend
+    return HedgedBackend(backend, percentile=args.hedge_percentile, budget=args.hedge_budget)
+
+def configure_backend_from_args(args):
+    """Install the backend selected by add_backend_arguments flags"""
+    set_backend(hedge_from_args(create_backend(args.llm_mode, args.cassette, replay_latency=args.replay_latency), args))
@@ -0,0 +1,126 @@
+import time
+import threading
+from llm_backend import create_backend, get_backend, hedge_from_args
+from metrics import PIPELINE_METRICS
+from sql_generator import generate_sql_query
+
+FAST_MODEL_NAME = 'gemini-1.5-flash'
+ROUTES = ('fast', 'strong')
+
+def routing_signals(query_text, search_results, retrieval_mode='dense', medical_score=None, medical_threshold=None):
+    """Difficulty signals available before generation
+
+    top_score and template_margin (best minus second-best training example
+    score) are cosine similarities, so they are only set for dense retrieval.
+    """
+    scores = [r['score'] for r in search_results['train_results'] if 'score' in r]
+    dense = retrieval_mode == 'dense'
+    return {
+        'top_score': scores[0] if dense and scores else None,
+        'template_margin': scores[0] - scores[1] if dense and len(scores) > 1 else None,
+        'question_words': len(query_text.split()),
+        'abstain_margin': medical_score - medical_threshold if medical_score is not None else None
+    }
+
+class LLMRouter:
+    """Send easy questions to a fast model and everything else to the strong one
+
+    A question is easy when its nearest training example is very close
+    (top_score), clearly ahead of the next one (template_margin), the question is
+    short, and it is clearly medical (abstain_margin). The pipeline escalates a
+    fast answer to the strong model when it fails validation or execution.
+    """
+
+    def __init__(self, fast, strong, min_top_score=0.8, min_template_margin=0.02, max_question_words=30,
+                 min_abstain_margin=2.0, metrics=PIPELINE_METRICS):
+        self.backends = {'fast': fast, 'strong': strong}
+        self.min_top_score = min_top_score
+        self.min_template_margin = min_template_margin
+        self.max_question_words = max_question_words
+        self.min_abstain_margin = min_abstain_margin
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self.reset()
+
+    def choose(self, signals):
+        """'fast' or 'strong' for a question's routing_signals"""
+        easy = (signals['top_score'] is not None and signals['top_score'] >= self.min_top_score
+                and (signals['template_margin'] is None or signals['template_margin'] >= self.min_template_margin)
+                and signals['question_words'] <= self.max_question_words
+                and (signals['abstain_margin'] is None or signals['abstain_margin'] >= self.min_abstain_margin))
+        return 'fast' if easy else 'strong'
+
+    def policy(self):
+        """The settings that decide routes, and the fast model"""
+        return {
+            'fast_model': self.backends['fast'].model_name,
+            'min_top_score': self.min_top_score,
+            'min_template_margin': self.min_template_margin,
+            'max_question_words': self.max_question_words,
+            'min_abstain_margin': self.min_abstain_margin
+        }
+
+    def generate(self, route, user_query, formatted_context, feedback=None, fallback=True):
+        """Generate SQL on one route, timing the call as stage llm_<route>
+
+        The fast route gets no pattern-based fallback, so a failed call comes
+        back as an SQL comment and is escalated instead of executed; fallback=False
+        turns it off on the strong route too.
+        """
+        start_time = time.perf_counter()
+        try:
+            return generate_sql_query(user_query, formatted_context, backend=self.backends[route],
+                                      check_abstain=False, fallback=fallback and route == 'strong', feedback=feedback)
+        finally:
+            self.metrics.observe(f"llm_{route}", time.perf_counter() - start_time)
+            with self._lock:
+                self.counts[route]['calls'] += 1
+
+    def record(self, route, success, escalated=False):
+        """Count the outcome of a question answered on `route`"""
+        with self._lock:
+            self.counts[route]['answered'] += 1
+            self.counts[route]['successes'] += int(success)
+            self.counts[route]['escalations'] += int(escalated)
+        self.metrics.increment(f"route_{route}_{'success' if success else 'failure'}")
+        if escalated:
+            self.metrics.increment(f"route_{route}_escalated")
+
+    def reset(self):
+        with self._lock:
+            self.counts = {route: {'calls': 0, 'answered': 0, 'successes': 0, 'escalations': 0} for route in ROUTES}
+
+    def summary(self):
+        """Per route: LLM calls, answered questions, success rate, escalations and call latency"""
+        latency = self.metrics.summary()
+        summary = {}
+        with self._lock:
+            for route, counts in self.counts.items():
+                summary[route] = dict(counts, latency=latency.get(f"llm_{route}"),
+                                      success_rate=counts['successes'] / counts['answered'] if counts['answered'] else None)
+        return summary
+
+_default_router = None
+
+def get_router():
+    """Process-wide router, or None when every question goes to the default backend"""
+    return _default_router
+
+def set_router(router):
+    global _default_router
+    _default_router = router
+
+def add_router_arguments(parser):
+    """Add the --route/--fast-model/--route-min-score CLI flags"""
+    parser.add_argument('--route', action='store_true',
+                        help='Route easy questions to a fast model, escalating to the strong model on failure')
+    parser.add_argument('--fast-model', default=FAST_MODEL_NAME, help='Model name of the fast route')
+    parser.add_argument('--route-min-score', type=float, default=0.8,
+                        help='Minimum top training-example similarity for the fast route')
+
+def configure_router_from_args(args):
+    """Install a router over the configured backend (strong) and a fast backend of the same mode"""
+    if args.route:
+        fast = hedge_from_args(create_backend(args.llm_mode, args.cassette, replay_latency=args.replay_latency,
+                                              model_name=args.fast_model), args)
+        set_router(LLMRouter(fast, get_backend(), min_top_score=args.route_min_score))
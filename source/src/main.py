@@ -1,14 +1,34 @@
 import os
+import time
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from abstain import medical_relevance
 from schema_parser import vectorize_schema_from_sql
 from train_vectorizer import vectorize_training_data
 from query_processor import load_embedding_model, vectorize_user_query
-from similarity_search import search_context
-from sql_generator import format_context, generate_sql_query
-from db_executor import execute_sql_query, format_results
+from similarity_search import search_context, clear_store_cache, RETRIEVAL_MODES
+from bm25_index import build_bm25_indices, bm25_index_current
+from template_index import build_template_index, template_index_exists
+from table_index import build_table_index, table_index_exists
+from schema_catalog import load_catalog
+from sql_validator import load_validator, format_validation_errors
+from sql_generator import (format_context, generate_sql_query, build_prompt, estimate_tokens,
+                           DEFAULT_CONTEXT_TOKEN_BUDGET, ABSTAIN_MESSAGE)
+from db_executor import execute_sql_query, format_results, InMemoryDatabase
+from db_shards import ShardedExecutor
+from llm_backend import add_backend_arguments, configure_backend_from_args, get_backend, HedgedBackend
+from llm_router import routing_signals, get_router, add_router_arguments, configure_router_from_args
+from metrics import PIPELINE_METRICS
+from memory_profile import MEMORY_PROFILER, memory_stage
+from sql_canonical import clean_sql
 
-def setup_vectors(schema_path, train_path, vector_db_dir='vector_db', force_rebuild=False):
-    """Set up the vector database by vectorizing schema and training data"""
+def setup_vectors(schema_path, train_path, vector_db_dir='vector_db', force_rebuild=False, template_medoids=None):
+    """Set up the vector database by vectorizing schema and training data
+
+    template_medoids builds the template-clustered training index with that many
+    medoids per template; an existing one is rebuilt whenever training data is.
+    """
     os.makedirs(vector_db_dir, exist_ok=True)
     
     # Check if indices already exist
@@ -18,61 +38,244 @@ def setup_vectors(schema_path, train_path, vector_db_dir='vector_db', force_rebu
     # Vectorize schema if needed
     if not schema_index_exists or force_rebuild:
         print("Vectorizing schema from SQL file...")
-        vectorize_schema_from_sql(schema_path, vector_db_dir)
+        with memory_stage('setup_schema'):
+            vectorize_schema_from_sql(schema_path, vector_db_dir)
+        schema_rebuilt = True
     else:
         print("Schema index already exists, skipping vectorization.")
+        schema_rebuilt = False
+    
+    # Compiled schema catalog (reused from cache when the DDL hash is unchanged)
+    if os.path.exists(schema_path):
+        with memory_stage('setup_catalog'):
+            load_catalog(schema_path, vector_db_dir)
+        load_validator.cache_clear()
     
     # Vectorize training data if needed
     if not train_index_exists or force_rebuild:
         print("Vectorizing training data...")
-        vectorize_training_data(train_path, vector_db_dir)
+        with memory_stage('setup_train'):
+            vectorize_training_data(train_path, vector_db_dir)
+        train_rebuilt = True
     else:
         print("Training index already exists, skipping vectorization.")
+        train_rebuilt = False
+    
+    # Lexical (BM25) indices over the same texts, for embedding-free retrieval; their doc ids are
+    # metadata rows, so they follow every rebuild of either index (or metadata change)
+    if not bm25_index_current(vector_db_dir) or force_rebuild or schema_rebuilt or train_rebuilt:
+        print("Building BM25 indices...")
+        with memory_stage('setup_bm25'):
+            build_bm25_indices(vector_db_dir)
+    
+    # Template-clustered training index: a few medoids per template instead of every example
+    if template_medoids or (train_rebuilt and template_index_exists(vector_db_dir)):
+        print("Building template-clustered training index...")
+        with memory_stage('setup_templates'):
+            build_template_index(vector_db_dir, medoids_per_template=template_medoids or 2)
+    
+    # Table-level schema index: tables are picked first, then only their columns are searched
+    if not table_index_exists(vector_db_dir) or schema_rebuilt or train_rebuilt:
+        print("Building table-level schema index...")
+        with memory_stage('setup_tables'):
+            build_table_index(vector_db_dir)
+    
+    # Drop any indices already loaded from a previous build
+    clear_store_cache()
 
-def clean_sql(sql):
-    """Remove markdown and formatting from SQL response"""
-    import re
-    # Remove opening code fence and optional 'sql' language tag
-    sql = re.sub(r"^```sql\s*", "", sql, flags=re.IGNORECASE)
-    # Remove opening code fence without language tag
-    sql = re.sub(r"^```\s*", "", sql)
-    # Remove closing code fence at the end
-    sql = re.sub(r"\s*```\s*$", "", sql)
-    # Remove any leading/trailing backticks or whitespace
-    sql = sql.strip("` \n")
-    # Remove any leading 'sql ' or 'SQL '
-    sql = re.sub(r"^\s*sql\s+", "", sql, flags=re.IGNORECASE)
-    # Remove inline SQL comments
-    sql = re.sub(r"--.*", "", sql)
-    # Collapse multiple spaces and remove trailing semicolons
-    sql = re.sub(r"\s+", " ", sql).strip().rstrip(';')
-    return sql
-
+# Shared threads that run embedding/retrieval alongside the abstention check
+_RETRIEVAL_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix='retrieval')
 
-def process_user_query(query_text, model, vector_db_dir='vector_db', db_path='mimic_iv.sqlite', api_key=None):
-    """Process a user query through the entire pipeline"""
-    # 1. Vectorize user query
-    query_embedding = vectorize_user_query(query_text, model)
+def _retrieve_context(query_text, model, vector_db_dir, query_embedding, cancelled, metrics, timings,
+                      retrieval_mode='dense'):
+    """Embed the query and search both indices, giving up early once `cancelled` is set"""
+    # 1. Vectorize user query (BM25-only retrieval needs no embedding)
+    if query_embedding is None and retrieval_mode != 'bm25':
+        with metrics.stage('embed', timings):
+            query_embedding = vectorize_user_query(query_text, model)
+    if cancelled.is_set():
+        return None
     # 2. Perform similarity search
-    search_results = search_context(query_embedding, vector_db_dir)
+    with metrics.stage('search', timings):
+        return search_context(query_embedding, vector_db_dir, mode=retrieval_mode, query_text=query_text)
+
+def abstention_result(query_text, timings):
+    """Pipeline result for a question rejected by the abstention check"""
+    return {
+        "user_query": query_text,
+        "sql_query": ABSTAIN_MESSAGE,
+        "execution_success": False,
+        "abstained": True,
+        "route": None,
+        "escalated": False,
+        "results": ABSTAIN_MESSAGE,
+        "prompt_tokens": 0,
+        "context_tokens": {},
+        "timings": timings
+    }
+
+def process_user_query(query_text, model, vector_db_dir='vector_db', db_path='mimic_iv.sqlite', api_key=None,
+                       token_budget=DEFAULT_CONTEXT_TOKEN_BUDGET, metrics=PIPELINE_METRICS,
+                       query_embedding=None, pool=None, concurrent=True, retrieval_mode='dense', validate=True,
+                       max_repairs=1, shards=None, router=None, fallback=True):
+    """Process a user query through the entire pipeline, timing each stage
+
+    The cheap abstention check runs first; with `concurrent` it overlaps with
+    embedding/retrieval, whose result is discarded (and search skipped if not yet
+    started) when the question is rejected. A precomputed `query_embedding`
+    (e.g. from a batched encode) skips the embed stage, and a `pool` of SQLite
+    connections replaces per-query connects (`shards`, a ShardedExecutor, runs
+    the SQL over subject-sharded database copies instead). `retrieval_mode`
+    selects dense, bm25 (no embedding model; `model` may be None) or hybrid
+    retrieval. With `validate`, generated SQL is checked against the schema
+    catalog before it reaches the database; invalid SQL is regenerated with the
+    errors as feedback up to `max_repairs` times, then reported without being
+    executed. A `router` (default: the one installed by --route) picks the fast
+    or strong model per question; a fast answer that abstains, fails validation
+    or fails to execute is regenerated once by the strong model. With
+    fallback=False a failed LLM call yields empty SQL instead of a pattern-based
+    guess. The result carries the executed DataFrame (`data`) or the error.
+    """
+    start_time = time.perf_counter()
+    timings = {}
+    cancelled = threading.Event()
+    retrieval = None
+    if concurrent:
+        retrieval = _RETRIEVAL_EXECUTOR.submit(_retrieve_context, query_text, model, vector_db_dir,
+                                               query_embedding, cancelled, metrics, timings, retrieval_mode)
+    # 0. Reject off-topic questions before paying for retrieval and generation
+    with metrics.stage('abstain', timings):
+        medical_score, medical_threshold = medical_relevance(query_text)
+    if medical_score < medical_threshold:
+        cancelled.set()
+        if retrieval is not None:
+            retrieval.cancel()
+        timings['total'] = time.perf_counter() - start_time
+        metrics.observe('path_abstained', timings['total'])
+        return abstention_result(query_text, timings)
+
+    # 1-2. Embedding and similarity search
+    if retrieval is not None:
+        search_results = retrieval.result()
+    else:
+        search_results = _retrieve_context(query_text, model, vector_db_dir, query_embedding, cancelled, metrics,
+                                           timings, retrieval_mode)
     # 3. Format context for language model
-    formatted_context = format_context(search_results)
-    # 4. Generate SQL query
-    sql_query = generate_sql_query(query_text, formatted_context)
-    #5. Clean SQL query
-    sql_query = clean_sql(sql_query)
-    # 6. Execute SQL query
-    execution_results = execute_sql_query(sql_query, db_path)
-    # 7. Format results
-    results = format_results(execution_results)
+    with metrics.stage('format', timings):
+        formatted_context = format_context(search_results, token_budget)
+        prompt_tokens = estimate_tokens(build_prompt(query_text, formatted_context))
+    # 4-7. Generate, validate and execute SQL, on the routed model when a router is configured
+    router = router if router is not None else get_router()
+    route, escalated = None, False
+    if router is not None:
+        route = router.choose(routing_signals(query_text, search_results, retrieval_mode, medical_score,
+                                              medical_threshold))
+
+    def answer(route, stage):
+        # 4. Generate SQL query
+        with metrics.stage(stage, timings):
+            if route is None:
+                sql_query = generate_sql_query(query_text, formatted_context, check_abstain=False,
+                                               fallback=fallback)
+            else:
+                sql_query = router.generate(route, query_text, formatted_context, fallback=fallback)
+        #5. Clean SQL query
+        with metrics.stage('clean', timings):
+            sql_query = clean_sql(sql_query)
+        abstained = sql_query.startswith("ABSTAIN:")
+        # 6. Validate against the schema catalog, retrying generation with the errors
+        # (fast-route answers are escalated instead of repaired)
+        validation = None
+        validator = load_validator(vector_db_dir, db_path) if validate and not abstained else None
+        if validator is not None:
+            with metrics.stage('validate', timings):
+                validation = validator.validate(sql_query)
+            repairs = 0
+            while not validation['valid'] and repairs < max_repairs and route != 'fast':
+                repairs += 1
+                metrics.increment('validation_repairs')
+                feedback = f"{sql_query}\n    Errors: {format_validation_errors(validation['errors'])}"
+                with metrics.stage('repair', timings):
+                    if route is None:
+                        sql_query = generate_sql_query(query_text, formatted_context, check_abstain=False,
+                                                       fallback=fallback, feedback=feedback)
+                    else:
+                        sql_query = router.generate(route, query_text, formatted_context, feedback=feedback,
+                                                    fallback=fallback)
+                    sql_query = clean_sql(sql_query)
+                    validation = validator.validate(sql_query)
+            if not validation['valid'] and route != 'fast':
+                metrics.increment('validation_rejected')
+        # 7. Execute SQL query (nothing to run if the model abstained or the SQL is invalid)
+        with metrics.stage('execute', timings):
+            if abstained:
+                execution_results = {"success": False, "error": sql_query}
+            elif validation is not None and not validation['valid']:
+                execution_results = {"success": False,
+                                     "error": f"Invalid SQL: {format_validation_errors(validation['errors'])}"}
+            else:
+                execution_results = execute_sql_query(sql_query, db_path, pool=pool, shards=shards)
+        return sql_query, abstained, validation, execution_results
+
+    sql_query, abstained, validation, execution_results = answer(route, 'generate')
+    if route == 'fast' and not execution_results["success"]:
+        # The strong model gets the original prompt (not the failed attempt), so its
+        # answer is the one an unrouted run would have produced
+        router.record('fast', False, escalated=True)
+        route, escalated = 'strong', True
+        sql_query, abstained, validation, execution_results = answer(route, 'escalate')
+    if router is not None:
+        router.record(route, execution_results["success"])
+    # 8. Format results
+    with metrics.stage('format_results', timings):
+        results = format_results(execution_results)
     
+    timings['total'] = time.perf_counter() - start_time
+    metrics.observe('path_answered', timings['total'])
     return {
         "user_query": query_text,
         "sql_query": sql_query,
         "execution_success": execution_results["success"],
-        "results": results
+        "abstained": abstained,
+        "validation": validation,
+        "route": route,
+        "escalated": escalated,
+        "results": results,
+        "data": execution_results.get("data"),
+        "error": execution_results.get("error"),
+        "prompt_tokens": prompt_tokens,
+        "context_tokens": formatted_context["token_counts"],
+        "timings": timings
     }
 
+def report_metrics(args, metrics=PIPELINE_METRICS):
+    """Print and/or export stage metrics as requested by --profile/--metrics-out"""
+    if args.profile:
+        print("\nStage latency profile:")
+        print(metrics.format_summary())
+    if args.metrics_out:
+        metrics.write(args.metrics_out)
+        print(f"Stage metrics written to {args.metrics_out}")
+    router = get_router()
+    if router is not None and (args.profile or args.metrics_out):
+        print("\nLLM routes:")
+        for route, stats in router.summary().items():
+            p50 = f"{stats['latency']['p50'] * 1000:.0f} ms" if stats['latency'] else "n/a"
+            success = f"{stats['success_rate']:.1%}" if stats['success_rate'] is not None else "n/a"
+            print(f"  {route:<7} questions {stats['answered']}, success {success}, "
+                  f"escalated {stats['escalations']}, LLM p50 {p50}")
+    backend = get_backend()
+    if isinstance(backend, HedgedBackend) and (args.profile or args.metrics_out):
+        hedging = backend.summary()
+        line = f"\nHedged LLM requests: {hedging['hedges']} of {hedging['requests']} ({hedging['hedges_won']} won)"
+        if 'p99' in hedging:
+            line += (f", p99 {hedging['unhedged_p99'] * 1000:.0f} ms unhedged -> {hedging['p99'] * 1000:.0f} ms "
+                     f"({hedging['p99_improvement']:.1%} lower)")
+        print(line)
+    if MEMORY_PROFILER.enabled:
+        print("\nStage memory profile:")
+        print(MEMORY_PROFILER.format_summary())
+
 def main():
     """Main function to run the application"""
     parser = argparse.ArgumentParser(description='RAG-based Text-to-SQL System')
@@ -81,22 +284,51 @@ def main():
     parser.add_argument('--train', default='./schema/train.csv', help='Path to training data CSV file')
     parser.add_argument('--db', default='./schema/mimic_iv.sqlite', help='Path to SQLite database')
     parser.add_argument('--query', help='Run a single query and exit')
+    parser.add_argument('--token-budget', type=int, default=DEFAULT_CONTEXT_TOKEN_BUDGET, help='Token budget for the retrieved prompt context')
+    parser.add_argument('--retrieval', choices=RETRIEVAL_MODES, default='dense',
+                        help='Dense (FAISS), embedding-free BM25, or hybrid (rank fusion) retrieval')
+    parser.add_argument('--max-repairs', type=int, default=1,
+                        help='Regenerations allowed when SQL fails schema validation (0 = report invalid SQL as is)')
+    parser.add_argument('--template-medoids', type=int, help='With --setup, index this many medoids per SQL template')
+    parser.add_argument('--shards', help='Run SQL over the subject shards in this directory (see db_shards.py)')
+    parser.add_argument('--in-memory', action='store_true',
+                        help='Run SQL on an in-memory copy of the database (reloaded when the file changes)')
+    parser.add_argument('--profile', action='store_true', help='Print per-stage latency percentiles on exit')
+    parser.add_argument('--metrics-out', help='Write stage metrics on exit (.json, otherwise Prometheus text)')
+    parser.add_argument('--memory-profile', metavar='PATH',
+                        help='Trace memory per setup/pipeline stage and write the report (JSON) on exit')
+    
+    add_backend_arguments(parser)
+    add_router_arguments(parser)
     
     args = parser.parse_args()
+    configure_backend_from_args(args)
+    configure_router_from_args(args)
+    if args.memory_profile:
+        MEMORY_PROFILER.enable(args.memory_profile)
     
     # Set up vectors if requested
     if args.setup:
-        setup_vectors(args.schema, args.train)
+        setup_vectors(args.schema, args.train, template_medoids=args.template_medoids)
     
-    # Load embedding model
-    model = load_embedding_model()
+    # Shard workers are forked before the embedding model is loaded
+    shards = ShardedExecutor(args.shards, args.db) if args.shards else None
+    pool = InMemoryDatabase(args.db) if args.in_memory else None
+    # Load embedding model (not needed for BM25-only retrieval)
+    model = load_embedding_model() if args.retrieval != 'bm25' else None
     
     # Process a single query if provided
     if args.query:
-        results = process_user_query(args.query, model, db_path=args.db)
+        results = process_user_query(args.query, model, db_path=args.db, token_budget=args.token_budget,
+                                     retrieval_mode=args.retrieval, max_repairs=args.max_repairs,
+                                     shards=shards, pool=pool)
         print(f"SQL query: {results['sql_query']}")
+        print(f"Prompt tokens: {results['prompt_tokens']}")
         print("Results:")
         print(results['results'])
+        report_metrics(args)
+        if shards is not None:
+            shards.close()
         return
     
     # Interactive mode
@@ -108,10 +340,16 @@ def main():
         if query.lower() == 'exit':
             break
         
-        results = process_user_query(query, model, db_path=args.db)
+        results = process_user_query(query, model, db_path=args.db, token_budget=args.token_budget,
+                                     retrieval_mode=args.retrieval, max_repairs=args.max_repairs,
+                                     shards=shards, pool=pool)
         print(f"\nGenerated SQL: {results['sql_query']}")
         print("\nResults:")
         print(results['results'])
+    
+    report_metrics(args)
+    if shards is not None:
+        shards.close()
 
 if __name__ == "__main__":
     main()
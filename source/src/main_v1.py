@@ -1,81 +1,25 @@
 import os
+import glob
+import hashlib
+import time
 import argparse
 import pandas as pd
 import json
 import sqlite3
 from tqdm import tqdm
-from schema_parser import vectorize_schema_from_sql
-from train_vectorizer import vectorize_training_data
-from query_processor import load_embedding_model, vectorize_user_query
-from similarity_search import search_context
-from sql_generator import format_context, generate_sql_query
-from db_executor import execute_sql_query, format_results
-
-def setup_vectors(schema_path, train_path, vector_db_dir='vector_db', force_rebuild=False):
-    """Set up the vector database by vectorizing schema and training data"""
-    os.makedirs(vector_db_dir, exist_ok=True)
-    
-    # Check if indices already exist
-    schema_index_exists = os.path.exists(os.path.join(vector_db_dir, 'schema_index.faiss'))
-    train_index_exists = os.path.exists(os.path.join(vector_db_dir, 'train_index.faiss'))
-    
-    # Vectorize schema if needed
-    if not schema_index_exists or force_rebuild:
-        print("Vectorizing schema from SQL file...")
-        vectorize_schema_from_sql(schema_path, vector_db_dir)
-    else:
-        print("Schema index already exists, skipping vectorization.")
-    
-    # Vectorize training data if needed
-    if not train_index_exists or force_rebuild:
-        print("Vectorizing training data...")
-        vectorize_training_data(train_path, vector_db_dir)
-    else:
-        print("Training index already exists, skipping vectorization.")
-
-def clean_sql(sql):
-    """Remove markdown and formatting from SQL response"""
-    import re
-    # Remove opening code fence and optional 'sql' language tag
-    sql = re.sub(r"^```sql\s*", "", sql, flags=re.IGNORECASE)
-    # Remove opening code fence without language tag
-    sql = re.sub(r"^```\s*", "", sql)
-    # Remove closing code fence at the end
-    sql = re.sub(r"\s*```\s*$", "", sql)
-    # Remove any leading/trailing backticks or whitespace
-    sql = sql.strip("` \n")
-    # Remove any leading 'sql ' or 'SQL '
-    sql = re.sub(r"^\s*sql\s+", "", sql, flags=re.IGNORECASE)
-    # Remove inline SQL comments
-    sql = re.sub(r"--.*", "", sql)
-    # Collapse multiple spaces and remove trailing semicolons
-    sql = re.sub(r"\s+", " ", sql).strip().rstrip(';')
-    return sql
-
-def process_user_query(query_text, model, vector_db_dir='vector_db', db_path='mimic_iv.sqlite', api_key=None):
-    """Process a user query through the entire pipeline"""
-    # 1. Vectorize user query
-    query_embedding = vectorize_user_query(query_text, model)
-    # 2. Perform similarity search
-    search_results = search_context(query_embedding, vector_db_dir)
-    # 3. Format context for language model
-    formatted_context = format_context(search_results)
-    # 4. Generate SQL query
-    sql_query = generate_sql_query(query_text, formatted_context)
-    #5. Clean SQL query
-    sql_query = clean_sql(sql_query)
-    # 6. Execute SQL query
-    execution_results = execute_sql_query(sql_query, db_path)
-    # 7. Format results
-    results = format_results(execution_results)
-    
-    
-    return {
-        "user_query": query_text,
-        "sql_query": sql_query,
-        "execution_success": execution_results["success"],
-        "results": results
-    }
+from query_processor import load_embedding_model
+from similarity_search import RETRIEVAL_MODES
+from sql_generator import DEFAULT_CONTEXT_TOKEN_BUDGET
+from db_executor import InMemoryDatabase
+from llm_backend import add_backend_arguments, configure_backend_from_args, get_backend
+from llm_router import add_router_arguments, configure_router_from_args, get_router
+from metrics import PIPELINE_METRICS
+from memory_profile import MEMORY_PROFILER
+from main import setup_vectors, process_user_query, report_metrics
+from sql_canonical import clean_sql
+from schema_catalog import load_catalog
+from sql_rewrite import prepare_sql
+from eval_sampling import add_sampling_arguments, stratified_sample, weighted_metrics, print_weighted_metrics
 
 def compare_results(gold_df, pred_df):
     """Compare the results of gold and predicted SQL queries"""
@@ -105,11 +49,17 @@ def compare_results(gold_df, pred_df):
     
     return False, "Results do not match"
 
-def execute_test_sql(sql, db_path):
-    """Execute SQL query and return results as DataFrame"""
+def execute_test_sql(sql, db_path, pool=None):
+    """Execute SQL query and return results as DataFrame (on a pooled connection if given)"""
+    if pool is not None:
+        try:
+            with pool.connection() as conn:
+                return pd.read_sql_query(prepare_sql(sql, db_path), conn), None
+        except Exception as e:
+            return None, str(e)
     try:
         conn = sqlite3.connect(db_path)
-        result = pd.read_sql_query(sql, conn)
+        result = pd.read_sql_query(prepare_sql(sql, db_path), conn)
         return result, None
     except Exception as e:
         return None, str(e)
@@ -117,93 +67,194 @@ def execute_test_sql(sql, db_path):
         if 'conn' in locals():
             conn.close()
 
-def evaluate_model(test_csv_path, model, db_path, vector_db_dir='vector_db', output_dir='evaluation_results'):
-    """Evaluate model performance on test set"""
+def row_keys(test_df):
+    """Checkpoint key per test row: the id, suffixed with #n for repeated ids"""
+    seen = {}
+    keys = []
+    for row_id in (test_df['id'] if 'id' in test_df.columns else test_df.index):
+        row_id = str(row_id)
+        count = seen.get(row_id, 0)
+        seen[row_id] = count + 1
+        keys.append(row_id if count == 0 else f"{row_id}#{count}")
+    return keys
+
+def parse_shard(shard):
+    """Parse 'i/n' (0-based shard i of n); None means the whole test set"""
+    if not shard:
+        return 0, 1
+    index, count = (int(part) for part in shard.split('/'))
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard {shard}: expected i/n with 0 <= i < n")
+    return index, count
+
+def evaluation_config(test_csv_path, db_path, vector_db_dir, token_budget, retrieval_mode, max_repairs=1):
+    """Settings that change evaluation results; runs with the same config share a checkpoint"""
+    with open(test_csv_path, 'rb') as f:
+        test_sha = hashlib.sha256(f.read()).hexdigest()
+    # Without a schema catalog nothing is validated (or repaired)
+    try:
+        catalog_sha = load_catalog(cache_dir=vector_db_dir).ddl_sha256
+    except FileNotFoundError:
+        catalog_sha = None
+    router = get_router()
+    return {
+        'test_sha256': test_sha,
+        'db': os.path.basename(db_path),
+        'vector_db': os.path.basename(os.path.normpath(vector_db_dir)),
+        'model': get_backend().model_name,
+        'llm_mode': get_backend().mode,
+        'token_budget': token_budget,
+        'retrieval_mode': retrieval_mode,
+        'schema_catalog': catalog_sha,
+        'max_repairs': max_repairs,
+        'route_policy': router.policy() if router is not None else None
+    }
+
+def config_hash(config):
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:12]
+
+def load_checkpoints(output_dir, run_hash):
+    """Read every checkpoint (all shards) of a run; a torn last line from a crash is ignored"""
+    records = {}
+    for path in sorted(glob.glob(os.path.join(output_dir, f"checkpoint_{run_hash}*.jsonl"))):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                records[record['key']] = record
+    return records
+
+def append_checkpoint(f, record):
+    """Append one result durably, so an interrupted run loses at most the row in progress"""
+    f.write(json.dumps(record, default=str) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+def is_retryable(result):
+    """Rows that failed before producing SQL (e.g. LLM quota errors) are retried on rerun"""
+    return result.get('pred_sql') is None
+
+def evaluate_row(row, idx, model, db_path, vector_db_dir, token_budget, metrics, retrieval_mode, pool=None,
+                 max_repairs=1):
+    """Answer one test row through the pipeline (validation and repairs included), then compare with the gold result"""
+    question = row['question']
+    # Unanswerable questions have no gold SQL
+    gold_sql = clean_sql(row['query']) if isinstance(row['query'], str) else None
+    record = {
+        'id': row.get('id', idx),
+        'question': question,
+        'gold_sql': gold_sql,
+        'pred_sql': None,
+        'abstained': False,
+        'is_correct': False,
+        'syntactically_valid': False
+    }
+    
+    # Generate and execute SQL with the pipeline (no pattern-based guess when the LLM call fails)
+    try:
+        result = process_user_query(question, model, vector_db_dir=vector_db_dir, db_path=db_path,
+                                    token_budget=token_budget, metrics=metrics, pool=pool,
+                                    retrieval_mode=retrieval_mode, validate=True, max_repairs=max_repairs,
+                                    fallback=False)
+    except Exception as e:
+        return dict(record, error=f"Generation error: {str(e)}")
+    if result['abstained']:
+        return dict(record, pred_sql=result['sql_query'], abstained=True, error="Model abstained")
+    if not result['sql_query']:
+        # LLM call failed (quota, network, missing key)
+        return dict(record, error="Generation error: the LLM call returned no SQL")
+    record.update({
+        'pred_sql': result['sql_query'],
+        'route': result['route'],
+        'escalated': result['escalated'],
+        'prompt_tokens': result['prompt_tokens']
+    })
+    if result['validation'] is not None and not result['validation']['valid']:
+        record['validation_errors'] = result['validation']['errors']
+    
+    # Execute gold SQL
+    gold_result, gold_error = None, "No gold SQL"
+    if gold_sql is not None:
+        with metrics.stage('execute_gold'):
+            gold_result, gold_error = execute_test_sql(gold_sql, db_path, pool)
+    
+    # Compare results
+    is_correct = False
+    comparison_note = ""
+    if gold_result is not None and result['execution_success']:
+        is_correct, comparison_note = compare_results(gold_result, result['data'])
+    
+    record.update({
+        'is_correct': bool(is_correct),
+        'syntactically_valid': bool(result['execution_success']),
+        'gold_error': gold_error,
+        'pred_error': result['error'],
+        'comparison_note': comparison_note
+    })
+    return record
+
+def evaluate_model(test_csv_path, model, db_path, vector_db_dir='vector_db', output_dir='evaluation_results',
+                   token_budget=DEFAULT_CONTEXT_TOKEN_BUDGET, metrics=PIPELINE_METRICS, retrieval_mode='dense',
+                   shard=None, limit=None, pool=None, sample=None, sample_seed=0, stratify_shape=False,
+                   max_repairs=1):
+    """Evaluate model performance on test set
+
+    Each finished row is appended to checkpoint_<config hash>[_shard].jsonl in
+    output_dir. Rerunning with the same config skips rows already in any checkpoint
+    of that config, and the summary is always recomputed from the checkpoints, so
+    shards written on several machines can be merged by copying them into one dir.
+    A `pool` (e.g. an InMemoryDatabase) runs the gold and generated SQL on its
+    connections instead of opening the database file per query. Rows go through
+    process_user_query, so invalid SQL is regenerated up to `max_repairs` times.
+    With `sample`, only a fixed-seed stratified sample of about that many rows
+    (every template covered) is evaluated, and the summary adds accuracy and
+    latency weighted back to the whole test set.
+    """
     os.makedirs(output_dir, exist_ok=True)
+    shard_index, shard_count = parse_shard(shard)
     
     # Read test data
     test_df = pd.read_csv(test_csv_path)
+    if sample is not None:
+        test_df = stratified_sample(test_df, sample, seed=sample_seed, by_shape=stratify_shape)
+        print(f"Stratified sample: {len(test_df)} rows over {test_df['stratum'].nunique()} strata (seed {sample_seed})")
+    elif limit is not None:
+        test_df = test_df.head(limit)
+    keys = row_keys(test_df)
     
-    results = []
-    correct = 0
-    syntactic_correct = 0
-    total = len(test_df.head(10))
+    config = evaluation_config(test_csv_path, db_path, vector_db_dir, token_budget, retrieval_mode, max_repairs)
+    run_hash = config_hash(config)
+    records = load_checkpoints(output_dir, run_hash)
+    suffix = f"_shard{shard_index}of{shard_count}" if shard_count > 1 else ""
+    checkpoint_path = os.path.join(output_dir, f"checkpoint_{run_hash}{suffix}.jsonl")
     
-    for idx, row in tqdm(test_df.iterrows(), total=total, desc="Evaluating"):
-        question = row['question']
-        gold_sql = clean_sql(row['query'])
-        
-        # Generate SQL from model
-        try:
-            # Use the existing pipeline to generate SQL
-            query_embedding = vectorize_user_query(question, model)
-            search_results = search_context(query_embedding, vector_db_dir)
-            formatted_context = format_context(search_results)
-            pred_sql = generate_sql_query(question, formatted_context)
-            pred_sql = clean_sql(pred_sql)
-            
-            # Check if model abstained
-            if pred_sql.startswith("ABSTAIN:"):
-                result = {
-                    'id': row.get('id', idx),
-                    'question': question,
-                    'gold_sql': gold_sql,
-                    'pred_sql': pred_sql,
-                    'abstained': True,
-                    'is_correct': False,
-                    'syntactically_valid': False,
-                    'error': "Model abstained"
-                }
-                results.append(result)
+    # This shard's rows that no checkpoint has finished yet
+    pending = [(position, idx) for position, idx in enumerate(test_df.index)
+               if position % shard_count == shard_index and keys[position] not in records]
+    shard_size = sum(1 for position in range(len(test_df)) if position % shard_count == shard_index)
+    print(f"Run {run_hash}: {shard_size - len(pending)} of {shard_size} rows already checkpointed")
+    
+    retry_later = 0
+    with open(checkpoint_path, 'a') as checkpoint:
+        for position, idx in tqdm(pending, desc="Evaluating"):
+            start_time = time.perf_counter()
+            result = evaluate_row(test_df.loc[idx], idx, model, db_path, vector_db_dir, token_budget, metrics,
+                                  retrieval_mode, pool, max_repairs)
+            result['latency'] = time.perf_counter() - start_time
+            result['key'] = keys[position]
+            if is_retryable(result):
+                retry_later += 1
                 continue
-        except Exception as e:
-            result = {
-                'id': row.get('id', idx),
-                'question': question,
-                'gold_sql': gold_sql,
-                'pred_sql': None,
-                'abstained': False,
-                'is_correct': False,
-                'syntactically_valid': False,
-                'error': f"Generation error: {str(e)}"
-            }
-            results.append(result)
-            continue
-        
-        # Execute gold SQL
-        gold_result, gold_error = execute_test_sql(gold_sql, db_path)
-        
-        # Execute predicted SQL
-        pred_result, pred_error = execute_test_sql(pred_sql, db_path)
-        
-        # Check if query is syntactically valid
-        is_syntactically_valid = pred_error is None
-        if is_syntactically_valid:
-            syntactic_correct += 1
-        
-        # Compare results
-        is_correct = False
-        comparison_note = ""
-        
-        if gold_result is not None and pred_result is not None:
-            is_correct, comparison_note = compare_results(gold_result, pred_result)
-            if is_correct:
-                correct += 1
-        
-        # Store result
-        result = {
-            'id': row.get('id', idx),
-            'question': question,
-            'gold_sql': gold_sql,
-            'pred_sql': pred_sql,
-            'abstained': False,
-            'is_correct': is_correct,
-            'syntactically_valid': is_syntactically_valid,
-            'gold_error': gold_error,
-            'pred_error': pred_error,
-            'comparison_note': comparison_note
-        }
-        results.append(result)
+            append_checkpoint(checkpoint, result)
+            records[result['key']] = result
+    
+    # Summarize every checkpointed row of this test set, in test set order
+    results = [records[key] for key in keys if key in records]
+    total = len(results)
+    correct = sum(1 for r in results if r['is_correct'])
+    syntactic_correct = sum(1 for r in results if r['syntactically_valid'])
     
     # Calculate metrics
     accuracy = correct / total if total > 0 else 0
@@ -216,12 +267,23 @@ def evaluate_model(test_csv_path, model, db_path, vector_db_dir='vector_db', out
     # Generate summary
     summary = {
         'total_examples': total,
+        'test_examples': len(test_df),
         'correct': correct,
         'accuracy': accuracy,
         'syntactically_valid': syntactic_correct,
         'syntactic_accuracy': syntactic_accuracy,
+        'config': config,
+        'config_hash': run_hash,
         'timestamp': pd.Timestamp.now().isoformat()
     }
+    if sample is not None and results:
+        strata = test_df.set_index(pd.Index(keys))[['stratum', 'stratum_size']]
+        evaluated = results_df.join(strata, on='key')
+        if 'latency' not in evaluated.columns:
+            evaluated['latency'] = None
+        summary['sample'] = dict(weighted_metrics(evaluated, ['is_correct', 'syntactically_valid'], 'latency'),
+                                 seed=sample_seed, stratify_shape=stratify_shape,
+                                 strata=int(test_df['stratum'].nunique()))
     
     with open(f"{output_dir}/summary.json", 'w') as f:
         json.dump(summary, f, indent=2)
@@ -229,6 +291,12 @@ def evaluate_model(test_csv_path, model, db_path, vector_db_dir='vector_db', out
     # Print summary
     print(f"Evaluation complete: {correct}/{total} correct ({accuracy:.2%})")
     print(f"Syntactically valid: {syntactic_correct}/{total} ({syntactic_accuracy:.2%})")
+    if retry_later:
+        print(f"{retry_later} rows failed before producing SQL and were not checkpointed; rerun to retry them")
+    if total < len(test_df):
+        print(f"{len(test_df) - total} rows not evaluated yet (other shards, interrupted or failed rows)")
+    if 'sample' in summary:
+        print_weighted_metrics(summary['sample'], summary['sample']['strata'])
     
     return summary, results
 
@@ -242,31 +310,61 @@ def main():
     parser.add_argument('--query', help='Run a single query and exit')
     parser.add_argument('--evaluate', help='Path to test CSV file for evaluation')
     parser.add_argument('--output-dir', default='./output', help='Directory to save evaluation results')
+    parser.add_argument('--shard', help='Evaluate only shard i/n of the test set (0-based), e.g. 0/4')
+    parser.add_argument('--limit', type=int, help='Evaluate only the first N test rows')
+    add_sampling_arguments(parser)
+    parser.add_argument('--in-memory', action='store_true',
+                        help='Run gold and generated SQL on an in-memory copy of the database')
+    parser.add_argument('--token-budget', type=int, default=DEFAULT_CONTEXT_TOKEN_BUDGET, help='Token budget for the retrieved prompt context')
+    parser.add_argument('--retrieval', choices=RETRIEVAL_MODES, default='dense',
+                        help='Dense (FAISS), embedding-free BM25, or hybrid (rank fusion) retrieval')
+    parser.add_argument('--max-repairs', type=int, default=1,
+                        help='Regenerations allowed when SQL fails schema validation (0 = report invalid SQL as is)')
+    parser.add_argument('--profile', action='store_true', help='Print per-stage latency percentiles on exit')
+    parser.add_argument('--metrics-out', help='Write stage metrics on exit (.json, otherwise Prometheus text)')
+    parser.add_argument('--memory-profile', metavar='PATH',
+                        help='Trace memory per setup/pipeline stage and write the report (JSON) on exit')
+    
+    add_backend_arguments(parser)
+    add_router_arguments(parser)
     
     args = parser.parse_args()
+    configure_backend_from_args(args)
+    configure_router_from_args(args)
+    if args.memory_profile:
+        MEMORY_PROFILER.enable(args.memory_profile)
     
     # Set up vectors if requested
     if args.setup:
         setup_vectors(args.schema, args.train)
     
-    # Load embedding model
-    model = load_embedding_model()
+    # Load embedding model (not needed for BM25-only retrieval)
+    model = load_embedding_model() if args.retrieval != 'bm25' else None
     
     # Run evaluation if requested
     if args.evaluate:
         print(f"Evaluating model on {args.evaluate}...")
-        summary, _ = evaluate_model(args.evaluate, model, args.db, output_dir=args.output_dir)
+        summary, _ = evaluate_model(args.evaluate, model, args.db, output_dir=args.output_dir,
+                                    token_budget=args.token_budget, retrieval_mode=args.retrieval,
+                                    shard=args.shard, limit=args.limit,
+                                    pool=InMemoryDatabase(args.db) if args.in_memory else None,
+                                    sample=args.sample, sample_seed=args.sample_seed,
+                                    stratify_shape=args.stratify_shape, max_repairs=args.max_repairs)
         print("Evaluation summary:")
         print(f"Accuracy: {summary['accuracy']:.2%}")
         print(f"Syntactic accuracy: {summary['syntactic_accuracy']:.2%}")
+        report_metrics(args)
         return
     
     # Process a single query if provided
     if args.query:
-        results = process_user_query(args.query, model, db_path=args.db)
+        results = process_user_query(args.query, model, db_path=args.db, token_budget=args.token_budget,
+                                     retrieval_mode=args.retrieval, max_repairs=args.max_repairs)
         print(f"SQL query: {results['sql_query']}")
+        print(f"Prompt tokens: {results['prompt_tokens']}")
         print("Results:")
         print(results['results'])
+        report_metrics(args)
         return
     
     # Interactive mode
@@ -278,10 +376,13 @@ def main():
         if query.lower() == 'exit':
             break
         
-        results = process_user_query(query, model, db_path=args.db)
+        results = process_user_query(query, model, db_path=args.db, token_budget=args.token_budget,
+                                     retrieval_mode=args.retrieval, max_repairs=args.max_repairs)
         print(f"\nGenerated SQL: {results['sql_query']}")
         print("\nResults:")
         print(results['results'])
+    
+    report_metrics(args)
 
 if __name__ == "__main__":
     main()
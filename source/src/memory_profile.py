@@ -0,0 +1,165 @@
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# Set to a report path (e.g. memory.json) to profile any entry point without a CLI flag
+MEMORY_PROFILE_ENV = 'CLINICALAI_MEMORY_PROFILE'
+TOP_SITES = 10
+
+_SITE_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>')
+)
+
+def _mb(n_bytes):
+    return n_bytes / (1024 * 1024)
+
+def current_rss_mb():
+    """Resident set size of this process now (Linux /proc), else the peak"""
+    try:
+        with open('/proc/self/statm') as f:
+            return _mb(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE'))
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+class StageMemory:
+    """Memory figures of one stage, accumulated over its calls"""
+
+    def __init__(self):
+        self.calls = 0
+        self.peak_traced = 0
+        self.net_traced = 0
+        self.rss = 0.0
+        self.peak_rss_growth = 0.0
+        self.sites = {}
+
+    def summary(self, top=TOP_SITES):
+        sites = sorted(self.sites.items(), key=lambda item: -item[1][0])[:top]
+        return {
+            'calls': self.calls,
+            'peak_traced_mb': _mb(self.peak_traced),
+            'mean_net_traced_mb': _mb(self.net_traced / self.calls) if self.calls else 0.0,
+            'rss_mb': self.rss,
+            'peak_rss_growth_mb': self.peak_rss_growth,
+            'top_sites': [{'site': site, 'net_mb': _mb(size), 'blocks': count} for site, (size, count) in sites]
+        }
+
+class MemoryProfiler:
+    """tracemalloc snapshots and RSS around named stages (nested stages are allowed)
+
+    Per stage: peak traced Python memory above the level at entry, net memory
+    still held at exit, RSS at exit, growth of the process peak RSS, and the
+    source lines whose allocations grew the most. tracemalloc is process-wide,
+    so figures are exact for one query at a time and approximate when stages
+    of concurrent queries overlap.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.report_path = None
+        self.stages = {}
+        self._frames = []
+        self._lock = threading.RLock()
+
+    def enable(self, report_path=None, frames=1):
+        """Start tracing; with report_path, write the report when the process exits"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.enabled = True
+        if report_path and self.report_path is None:
+            atexit.register(self._write_at_exit)
+        self.report_path = report_path or self.report_path
+
+    def _write_at_exit(self):
+        self.write(self.report_path)
+        print(f"Memory profile written to {self.report_path}")
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        with self._lock:
+            current, peak = tracemalloc.get_traced_memory()
+            # Nested stages reset the peak, so the enclosing stages keep what they have seen so far
+            for frame in self._frames:
+                frame['peak'] = max(frame['peak'], peak)
+            tracemalloc.reset_peak()
+            frame = {'start': current, 'peak': current, 'snapshot': tracemalloc.take_snapshot().filter_traces(_SITE_FILTERS),
+                     'peak_rss': peak_rss_mb()}
+            self._frames.append(frame)
+        try:
+            yield
+        finally:
+            with self._lock:
+                current, peak = tracemalloc.get_traced_memory()
+                self._frames.remove(frame)
+                frame['peak'] = max(frame['peak'], peak)
+                for outer in self._frames:
+                    outer['peak'] = max(outer['peak'], frame['peak'])
+                snapshot = tracemalloc.take_snapshot().filter_traces(_SITE_FILTERS)
+                stats = self.stages.setdefault(name, StageMemory())
+                stats.calls += 1
+                stats.peak_traced = max(stats.peak_traced, frame['peak'] - frame['start'])
+                stats.net_traced += current - frame['start']
+                stats.rss = max(stats.rss, current_rss_mb())
+                stats.peak_rss_growth = max(stats.peak_rss_growth, peak_rss_mb() - frame['peak_rss'])
+                for diff in snapshot.compare_to(frame['snapshot'], 'lineno')[:TOP_SITES * 2]:
+                    if diff.size_diff <= 0:
+                        continue
+                    where = diff.traceback[0]
+                    site = f"{where.filename}:{where.lineno}"
+                    size, count = stats.sites.get(site, (0, 0))
+                    stats.sites[site] = (size + diff.size_diff, count + diff.count_diff)
+
+    def report(self):
+        with self._lock:
+            return {
+                'stages': {name: stats.summary() for name, stats in self.stages.items()},
+                'peak_rss_mb': peak_rss_mb(),
+                'traced_peak_mb': _mb(tracemalloc.get_traced_memory()[1]) if tracemalloc.is_tracing() else None,
+                'timestamp': time.time()
+            }
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def format_summary(self):
+        """Human-readable per-stage table, largest peak first"""
+        report = self.report()
+        lines = [f"{'stage':<20}{'calls':>7}{'peak MB':>10}{'net MB':>10}{'RSS MB':>10}"]
+        stages = sorted(report['stages'].items(), key=lambda item: -item[1]['peak_traced_mb'])
+        for name, stats in stages:
+            lines.append(f"{name:<20}{stats['calls']:>7}{stats['peak_traced_mb']:>10.1f}"
+                         f"{stats['mean_net_traced_mb']:>10.1f}{stats['rss_mb']:>10.0f}")
+            for site in stats['top_sites'][:3]:
+                lines.append(f"    {site['net_mb']:>8.2f} MB  {site['site']}")
+        return "\n".join(lines)
+
+# Process-wide profiler; stages are free no-ops until it is enabled
+MEMORY_PROFILER = MemoryProfiler()
+
+def memory_stage(name):
+    return MEMORY_PROFILER.stage(name)
+
+if os.environ.get(MEMORY_PROFILE_ENV):
+    MEMORY_PROFILER.enable(os.environ[MEMORY_PROFILE_ENV])
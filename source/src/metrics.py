@@ -0,0 +1,139 @@
+import json
+import math
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from memory_profile import memory_stage
+
+# Stages of process_user_query, in pipeline order (execute_gold is the evaluator's run of the gold query)
+PIPELINE_STAGES = ['abstain', 'embed', 'search', 'format', 'generate', 'clean', 'validate', 'repair', 'escalate',
+                   'execute_gold', 'execute', 'format_results']
+
+def prometheus_counter(name, value, help_text):
+    """One counter family in the Prometheus text format: HELP and TYPE lines, then its sample"""
+    metric = f"clinicalai_{name}_total"
+    return [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter", f"{metric} {value}"]
+
+class StageHistogram:
+    """Rolling window of latencies (seconds) for one stage, plus lifetime totals"""
+
+    def __init__(self, window=1024):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, p):
+        """Nearest-rank percentile over the rolling window"""
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        rank = max(0, min(len(ordered) - 1, math.ceil(p / 100.0 * len(ordered)) - 1))
+        return ordered[rank]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': max(self.samples) if self.samples else 0.0
+        }
+
+class PipelineMetrics:
+    """Per-stage latency histograms for the query pipeline"""
+
+    def __init__(self, window=1024):
+        self.window = window
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = StageHistogram(self.window)
+            histogram.observe(seconds)
+
+    def increment(self, counter, value=1):
+        """Add to a named event counter (e.g. coalesced requests)"""
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def counters_snapshot(self):
+        """Copy of the event counters, taken under the lock"""
+        with self._lock:
+            return dict(self.counters)
+
+    @contextmanager
+    def stage(self, name, timings=None):
+        """Time a block as pipeline stage `name`, optionally recording it into `timings`
+
+        Also profiles the block's memory when memory profiling is enabled.
+        """
+        start_time = time.perf_counter()
+        try:
+            with memory_stage(name):
+                yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            self.observe(name, elapsed)
+            if timings is not None:
+                timings[name] = elapsed
+
+    def summary(self):
+        """Stage -> {count, mean, p50, p95, p99, max}, pipeline stages first"""
+        with self._lock:
+            names = [s for s in PIPELINE_STAGES if s in self.histograms]
+            names += sorted(s for s in self.histograms if s not in PIPELINE_STAGES)
+            return {name: self.histograms[name].summary() for name in names}
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def to_json(self):
+        return json.dumps({'stages': self.summary(), 'counters': self.counters_snapshot(), 'timestamp': time.time()},
+                          indent=2)
+
+    def to_prometheus(self):
+        """Render the histograms (summary type) and event counters in the Prometheus text exposition format"""
+        lines = [
+            "# HELP clinicalai_stage_latency_seconds Latency of query pipeline stages",
+            "# TYPE clinicalai_stage_latency_seconds summary"
+        ]
+        for name, stats in self.summary().items():
+            for quantile, key in (("0.5", 'p50'), ("0.95", 'p95'), ("0.99", 'p99')):
+                lines.append(f'clinicalai_stage_latency_seconds{{stage="{name}",quantile="{quantile}"}} {stats[key]:.6f}')
+            lines.append(f'clinicalai_stage_latency_seconds_sum{{stage="{name}"}} {stats["mean"] * stats["count"]:.6f}')
+            lines.append(f'clinicalai_stage_latency_seconds_count{{stage="{name}"}} {stats["count"]}')
+        for counter, value in sorted(self.counters_snapshot().items()):
+            lines.extend(prometheus_counter(counter, value, f"Pipeline events: {counter.replace('_', ' ')}"))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write metrics to a file: JSON for *.json, Prometheus text otherwise"""
+        content = self.to_json() if path.endswith('.json') else self.to_prometheus()
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def format_summary(self):
+        """Human-readable per-stage table for --profile"""
+        lines = [f"{'stage':<16}{'count':>7}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"]
+        for name, stats in self.summary().items():
+            lines.append(f"{name:<16}{stats['count']:>7}{stats['mean'] * 1000:>10.1f}{stats['p50'] * 1000:>10.1f}"
+                         f"{stats['p95'] * 1000:>10.1f}{stats['p99'] * 1000:>10.1f}")
+        for counter, value in sorted(self.counters_snapshot().items()):
+            lines.append(f"{counter}: {value}")
+        return "\n".join(lines)
+
+# Process-wide metrics shared by the pipeline entry points
+PIPELINE_METRICS = PipelineMetrics()
@@ -0,0 +1,96 @@
+import os
+import json
+import mmap
+import struct
+import faiss
+import numpy as np
+import pandas as pd
+
+# Flags for reading a FAISS index without copying its vectors into the heap: flat
+# indexes map their codes (IO_FLAG_MMAP_IFC, FAISS >= 1.10), IVF indexes their lists
+MMAP_READ_FLAGS = getattr(faiss, 'IO_FLAG_MMAP_IFC', 0) | faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+RECORDS_SUFFIX = '.records'
+
+def replace_atomically(path, write):
+    """Call write(tmp_path), then move the file over path in one step
+
+    Readers that mapped the old file keep their (now unlinked) copy; truncating
+    a mapped file in place would crash them with SIGBUS instead.
+    """
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def write_faiss_index(index, path):
+    replace_atomically(path, lambda tmp_path: faiss.write_index(index, tmp_path))
+
+def save_array(path, array):
+    """np.save through replace_atomically, for arrays that readers memory-map"""
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+    replace_atomically(path, write)
+
+def read_faiss_index(path, mmap=True):
+    """Read a FAISS index, memory-mapped read-only when the index type allows it
+
+    Mapped vectors live in the page cache, so every process that maps the same
+    file shares one copy. Falls back to a private in-memory copy otherwise.
+    """
+    if mmap:
+        try:
+            return faiss.read_index(path, MMAP_READ_FLAGS)
+        except RuntimeError:
+            pass
+    return faiss.read_index(path)
+
+def write_records(records, path):
+    """Write dict records as one file: record count, byte offsets, then one JSON document each"""
+    blobs = [json.dumps(record).encode() for record in records]
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    np.cumsum([len(blob) for blob in blobs], out=offsets[1:])
+
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            f.write(struct.pack('<q', len(blobs)))
+            f.write(offsets.tobytes())
+            for blob in blobs:
+                f.write(blob)
+    replace_atomically(path, write)
+
+class MappedRecords:
+    """Read-only sequence of dict records decoded on access from a memory-mapped file"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        count = struct.unpack_from('<q', self._map)[0]
+        self._offsets = np.frombuffer(self._map, dtype=np.int64, count=count + 1, offset=8)
+        self._data_start = 8 + 8 * (count + 1)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        start = self._data_start + int(self._offsets[i])
+        end = self._data_start + int(self._offsets[i + 1])
+        return json.loads(self._map[start:end])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+def load_records(csv_path, mmap=True):
+    """Metadata records of a CSV file, memory-mapped from a sidecar rebuilt whenever the CSV is newer"""
+    if not mmap:
+        return pd.read_csv(csv_path).to_dict('records')
+    path = csv_path[:-len('.csv')] + RECORDS_SUFFIX if csv_path.endswith('.csv') else csv_path + RECORDS_SUFFIX
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(csv_path):
+        write_records(pd.read_csv(csv_path).to_dict('records'), path)
+    return MappedRecords(path)
@@ -15,3 +15,10 @@ def vectorize_user_query(query_text, model):
     faiss.normalize_L2(query_embedding)
     
     return query_embedding
+
+
+def vectorize_user_queries(query_texts, model):
+    """Generate normalized embeddings for several queries in one encode call"""
+    query_embeddings = model.encode(list(query_texts))
+    faiss.normalize_L2(query_embeddings)
+    return query_embeddings
@@ -0,0 +1,208 @@
+import os
+import re
+import json
+import hashlib
+import argparse
+from functools import lru_cache
+
+# Bump when the serialized layout changes, so stale caches are rebuilt
+CATALOG_VERSION = 1
+CATALOG_FILE = 'schema_catalog.json'
+
+_CREATE_TABLE = re.compile(r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?[`"\[]?(\w+)[`"\]]?\s*\((.*?)\)\s*;',
+                           re.DOTALL | re.IGNORECASE)
+_COLUMN = re.compile(r'[`"\[]?(\w+)[`"\]]?\s+(\w+(?:\s*\([\d\s,]+\))?)\s*(.*)', re.DOTALL)
+_TABLE_PRIMARY_KEY = re.compile(r'PRIMARY\s+KEY\s*\(([^)]*)\)', re.IGNORECASE)
+_FOREIGN_KEY = re.compile(r'FOREIGN\s+KEY\s*\(\s*(\w+)\s*\)\s*REFERENCES\s+(\w+)\s*\(\s*(\w+)\s*\)', re.IGNORECASE)
+_JOIN_COMMENT = re.compile(r'--\s*(\w+)\.(\w+)\s+can\s+be\s+joined\s+with\s+(\w+)\.(\w+)', re.IGNORECASE)
+_CONSTRAINT_WORDS = ('PRIMARY', 'FOREIGN', 'UNIQUE', 'CHECK', 'CONSTRAINT')
+
+def parse_ddl(sql_content):
+    """Parse CREATE TABLE statements and join comments into a catalog dict"""
+    tables = {}
+    relationships = []
+    for table_name, columns_block in _CREATE_TABLE.findall(sql_content):
+        columns = []
+        primary_key = []
+        for line in columns_block.split('\n'):
+            # Column definition and its trailing -- description
+            definition, _, comment = line.partition('--')
+            definition = definition.strip().rstrip(',').strip()
+            if not definition:
+                continue
+            if definition.upper().startswith(_CONSTRAINT_WORDS):
+                match = _TABLE_PRIMARY_KEY.search(definition)
+                if match:
+                    primary_key.extend(col.strip(' `"[]') for col in match.group(1).split(','))
+                match = _FOREIGN_KEY.search(definition)
+                if match:
+                    relationships.append((table_name, match.group(1), match.group(2), match.group(3)))
+                continue
+            match = _COLUMN.match(definition)
+            if not match:
+                continue
+            name, column_type, constraints = match.groups()
+            constraints = re.sub(r'\s+', ' ', constraints).strip()
+            if re.search(r'PRIMARY\s+KEY', constraints, re.IGNORECASE):
+                primary_key.append(name)
+            columns.append({
+                'name': name,
+                'type': column_type,
+                'constraints': constraints,
+                'description': comment.strip()
+            })
+        tables[table_name] = {'columns': columns, 'primary_key': primary_key}
+
+    relationships.extend(_JOIN_COMMENT.findall(sql_content))
+    return {
+        'version': CATALOG_VERSION,
+        'tables': tables,
+        'relationships': [
+            {'left_table': a, 'left_column': x, 'right_table': b, 'right_column': y}
+            for a, x, b, y in relationships
+        ]
+    }
+
+class SchemaCatalog:
+    """Typed view of the schema: tables -> columns -> types, primary keys and join graph"""
+
+    def __init__(self, data):
+        self.data = data
+        self.ddl_sha256 = data.get('ddl_sha256')
+        self.tables = data['tables']
+        self.relationships = data['relationships']
+        self._columns = {
+            table.lower(): {column['name'].lower(): column for column in info['columns']}
+            for table, info in self.tables.items()
+        }
+        # Undirected join graph over the relationships whose columns exist in both tables
+        self.join_graph = {}
+        for rel in self.relationships:
+            if not (self.has_column(rel['left_table'], rel['left_column'])
+                    and self.has_column(rel['right_table'], rel['right_column'])):
+                continue
+            left, right = rel['left_table'].lower(), rel['right_table'].lower()
+            self.join_graph.setdefault(left, []).append((rel['left_column'], right, rel['right_column']))
+            self.join_graph.setdefault(right, []).append((rel['right_column'], left, rel['left_column']))
+
+    def table_names(self):
+        return list(self.tables)
+
+    def has_table(self, table):
+        return table.lower() in self._columns
+
+    def has_column(self, table, column):
+        return column.lower() in self._columns.get(table.lower(), {})
+
+    def columns(self, table):
+        """Column dicts (name, type, constraints, description) of a table, in DDL order"""
+        return list(self._columns.get(table.lower(), {}).values())
+
+    def column_type(self, table, column):
+        column = self._columns.get(table.lower(), {}).get(column.lower())
+        return column['type'] if column else None
+
+    def primary_key(self, table):
+        for name, info in self.tables.items():
+            if name.lower() == table.lower():
+                return info['primary_key']
+        return []
+
+    def tables_with_column(self, column):
+        return [table for table in self.tables if self.has_column(table, column)]
+
+    def joins_between(self, left, right):
+        """(left column, right column) pairs that join two tables directly"""
+        return [(col, other_col) for col, other, other_col in self.join_graph.get(left.lower(), [])
+                if other == right.lower()]
+
+    def ddl(self):
+        """Clean CREATE TABLE statements (no comments, no trailing commas) for SQLite"""
+        statements = []
+        for table, info in self.tables.items():
+            columns = ', '.join(f"{c['name']} {c['type']} {c['constraints']}".strip() for c in info['columns'])
+            statements.append(f"CREATE TABLE {table} ({columns});")
+        return '\n'.join(statements)
+
+    def records(self):
+        """Flat column and relationship records in the layout used for schema embeddings"""
+        records = []
+        for table, info in self.tables.items():
+            for column in info['columns']:
+                column_type = f"{column['type']} {column['constraints']}".strip()
+                text_representation = f"""
+            Table: {table}
+            Column: {column['name']}
+            Type: {column_type}
+            Description: {column['description']}
+            """
+                records.append({
+                    'table_name': table,
+                    'column_name': column['name'],
+                    'column_type': column_type,
+                    'description': column['description'],
+                    'text_for_embedding': text_representation.strip()
+                })
+        for rel in self.relationships:
+            relationship = f"{rel['left_table']}.{rel['left_column']} can be joined with {rel['right_table']}.{rel['right_column']}"
+            records.append({
+                'relationship': relationship,
+                'text_for_embedding': f"Relationship: {relationship}"
+            })
+        return records
+
+def _file_sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def build_catalog(ddl_path, cache_dir='vector_db'):
+    """Parse the DDL and write <cache_dir>/schema_catalog_<hash>.json (and schema_catalog.json)"""
+    with open(ddl_path, 'rb') as f:
+        raw = f.read()
+    data = parse_ddl(raw.decode())
+    data['ddl_sha256'] = hashlib.sha256(raw).hexdigest()
+    data['ddl_path'] = os.path.abspath(ddl_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    for path in (os.path.join(cache_dir, f"schema_catalog_{data['ddl_sha256'][:16]}.json"),
+                 os.path.join(cache_dir, CATALOG_FILE)):
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=1)
+    return SchemaCatalog(data)
+
+@lru_cache(maxsize=None)
+def _load_catalog_file(path, mtime):
+    with open(path) as f:
+        data = json.load(f)
+    return SchemaCatalog(data) if data.get('version') == CATALOG_VERSION else None
+
+def load_catalog(ddl_path=None, cache_dir='vector_db'):
+    """Load the catalog for a DDL file, parsing it only when no cache matches its hash
+
+    Without ddl_path, the most recently built catalog in cache_dir is loaded.
+    """
+    if ddl_path is None:
+        path = os.path.join(cache_dir, CATALOG_FILE)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No schema catalog in {cache_dir}; run schema_catalog.py --schema <ddl>")
+        return _load_catalog_file(path, os.path.getmtime(path))
+    path = os.path.join(cache_dir, f"schema_catalog_{_file_sha256(ddl_path)[:16]}.json")
+    if os.path.exists(path):
+        catalog = _load_catalog_file(path, os.path.getmtime(path))
+        if catalog is not None:
+            return catalog
+    return build_catalog(ddl_path, cache_dir)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile the DDL into a cached schema catalog')
+    parser.add_argument('--schema', default='./schema/medical_schema.sql', help='Path to SQL schema file')
+    parser.add_argument('--cache-dir', default='vector_db', help='Directory for the serialized catalog')
+    args = parser.parse_args()
+
+    catalog = build_catalog(args.schema, args.cache_dir)
+    columns = sum(len(info['columns']) for info in catalog.tables.values())
+    edges = sum(len(neighbours) for neighbours in catalog.join_graph.values()) // 2
+    print(f"Catalog {catalog.ddl_sha256[:16]}: {len(catalog.tables)} tables, {columns} columns, "
+          f"{len(catalog.relationships)} relationships ({edges} resolvable join edges)")
+
+if __name__ == "__main__":
+    main()
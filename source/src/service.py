@@ -0,0 +1,320 @@
+import json
+import time
+import signal
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from query_processor import load_embedding_model, vectorize_user_queries
+from similarity_search import load_vector_store, load_bm25_store, RETRIEVAL_MODES
+from sql_generator import DEFAULT_CONTEXT_TOKEN_BUDGET
+from db_executor import open_pool
+from db_shards import ShardedExecutor
+from llm_backend import add_backend_arguments, configure_backend_from_args
+from llm_router import add_router_arguments, configure_router_from_args
+from metrics import PIPELINE_METRICS, prometheus_counter
+from abstain import is_medical_query
+from main import process_user_query, abstention_result
+from singleflight import AsyncSingleFlight, normalize_question
+
+MAX_BODY_BYTES = 1024 * 1024
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+class EmbeddingBatcher:
+    """Collects questions from concurrent requests and embeds them in a single encode call"""
+
+    def __init__(self, model, executor, max_batch_size=32, max_wait_ms=5.0, metrics=PIPELINE_METRICS):
+        self.model = model
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.metrics = metrics
+        self.queue = asyncio.Queue()
+        self.batches = 0
+        self.batched_queries = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def embed(self, text):
+        """Return the (1, dim) normalized embedding for one question"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            # Wait briefly for more questions, up to the batch size
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = [text for text, _ in batch]
+            try:
+                start_time = time.perf_counter()
+                embeddings = await loop.run_in_executor(self.executor, vectorize_user_queries, texts, self.model)
+                self.metrics.observe('embed_batch', time.perf_counter() - start_time)
+                self.batches += 1
+                self.batched_queries += len(batch)
+                for i, (_, future) in enumerate(batch):
+                    if not future.done():
+                        future.set_result(embeddings[i:i + 1])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        while not self.queue.empty():
+            _, future = self.queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Service is shutting down"))
+
+class QueryService:
+    """Local HTTP/JSON service keeping the model, indices and DB connections warm"""
+
+    def __init__(self, vector_db_dir='vector_db', db_path='mimic_iv.sqlite', workers=8, pool_size=4,
+                 max_batch_size=32, max_wait_ms=5.0, token_budget=DEFAULT_CONTEXT_TOKEN_BUDGET,
+                 shutdown_timeout=30.0, retrieval_mode='dense', shard_dir=None, in_memory=False):
+        self.vector_db_dir = vector_db_dir
+        self.retrieval_mode = retrieval_mode
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self.in_memory = in_memory
+        self.shard_dir = shard_dir
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.token_budget = token_budget
+        self.shutdown_timeout = shutdown_timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pipeline')
+        self.embed_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='embed')
+        self.model = None
+        self.pool = None
+        self.shards = None
+        self.batcher = None
+        self.ready = False
+        self.load_error = None
+        self.inflight = 0
+        self.flights = AsyncSingleFlight()
+        self.server = None
+        self._stop = None
+
+    async def load(self):
+        """Load the embedding model, vector indices and connection pool once"""
+        loop = asyncio.get_running_loop()
+        try:
+            start_time = time.perf_counter()
+            if self.shard_dir:
+                # Fork the shard workers before the model and its threads are loaded
+                self.shards = ShardedExecutor(self.shard_dir, self.db_path)
+            if self.retrieval_mode != 'bm25':
+                self.model = await loop.run_in_executor(self.executor, load_embedding_model)
+                await loop.run_in_executor(self.executor, load_vector_store, self.vector_db_dir)
+                self.batcher = EmbeddingBatcher(self.model, self.embed_executor, self.max_batch_size, self.max_wait_ms)
+                self.batcher.start()
+            if self.retrieval_mode != 'dense':
+                await loop.run_in_executor(self.executor, load_bm25_store, self.vector_db_dir)
+            self.pool = open_pool(self.db_path, self.pool_size, self.in_memory)
+            self.ready = True
+            print(f"Service ready in {time.perf_counter() - start_time:.2f}s")
+        except Exception as e:
+            self.load_error = str(e)
+            print(f"Service failed to load: {e}")
+
+    async def answer(self, question):
+        """Run one question through the pipeline, sharing work with identical in-flight questions"""
+        start_time = time.perf_counter()
+        # Off-topic questions never reach the embedding batcher
+        if not is_medical_query(question):
+            timings = {'total': time.perf_counter() - start_time}
+            PIPELINE_METRICS.observe('path_abstained', timings['total'])
+            return abstention_result(question, timings)
+
+        # Everything else that shapes the answer (retrieval mode, budget, pool, shards) is fixed per service
+        key = (normalize_question(question), self.db_path)
+        result, shared = await self.flights.do(key, lambda: self._run_pipeline(question))
+        PIPELINE_METRICS.increment('coalesced_requests' if shared else 'leader_requests')
+        return dict(result, user_query=question, timings=dict(result['timings']), coalesced=shared)
+
+    async def _run_pipeline(self, question):
+        """Batched embedding, then the rest of the pipeline on a worker thread"""
+        query_embedding = None
+        embed_seconds = 0.0
+        if self.batcher is not None:
+            embed_start = time.perf_counter()
+            query_embedding = await self.batcher.embed(question)
+            embed_seconds = time.perf_counter() - embed_start
+            PIPELINE_METRICS.observe('embed', embed_seconds)
+
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(
+            self.executor,
+            lambda: process_user_query(question, self.model, vector_db_dir=self.vector_db_dir, db_path=self.db_path,
+                                       token_budget=self.token_budget, query_embedding=query_embedding,
+                                       pool=self.pool, retrieval_mode=self.retrieval_mode, shards=self.shards)
+        )
+        if self.batcher is not None:
+            result['timings']['embed'] = embed_seconds
+        # The rows are returned once, as JSON records under 'results'
+        result.pop('data', None)
+        results = result['results']
+        if hasattr(results, 'to_json'):
+            result['results'] = json.loads(results.to_json(orient='records', date_format='iso'))
+        return result
+
+    async def route(self, method, path, body):
+        """Dispatch a request, returning (status, content type, payload)"""
+        if path == '/healthz':
+            return 200, 'application/json', {'status': 'ok'}
+        if path == '/readyz':
+            if self.ready:
+                return 200, 'application/json', {'status': 'ready'}
+            return 503, 'application/json', {'status': 'not ready', 'error': self.load_error}
+        if path == '/metrics':
+            summary = PIPELINE_METRICS.to_prometheus()
+            if self.batcher is not None:
+                lines = prometheus_counter('embedding_batches', self.batcher.batches, "Embedding batches encoded")
+                lines += prometheus_counter('embedding_batched_queries', self.batcher.batched_queries,
+                                            "Queries embedded in batches")
+                summary += "\n".join(lines) + "\n"
+            return 200, 'text/plain; version=0.0.4', summary
+        if path != '/query':
+            return 404, 'application/json', {'error': f"Unknown path {path}"}
+        if method != 'POST':
+            return 405, 'application/json', {'error': "Use POST /query"}
+        if not self.ready:
+            return 503, 'application/json', {'error': "Service is not ready"}
+        try:
+            question = json.loads(body or b'{}').get('question')
+        except (ValueError, AttributeError):
+            question = None
+        if not isinstance(question, str) or not question.strip():
+            return 400, 'application/json', {'error': "Body must be JSON with a non-empty 'question'"}
+        return 200, 'application/json', await self.answer(question)
+
+    async def handle_connection(self, reader, writer):
+        """Minimal HTTP/1.1 handling: one request per connection"""
+        self.inflight += 1
+        try:
+            request_line = (await reader.readline()).decode('latin-1').strip()
+            parts = request_line.split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            try:
+                length = int(headers.get('content-length', 0) or 0)
+            except ValueError:
+                length = -1
+            if len(parts) < 2:
+                status, content_type, payload = 400, 'application/json', {'error': "Malformed request line"}
+            elif length < 0:
+                status, content_type, payload = 400, 'application/json', {'error': "Invalid Content-Length"}
+            else:
+                if length > MAX_BODY_BYTES:
+                    status, content_type, payload = 413, 'application/json', {'error': "Request body too large"}
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    try:
+                        status, content_type, payload = await self.route(parts[0].upper(), parts[1].split('?')[0], body)
+                    except Exception as e:
+                        status, content_type, payload = 500, 'application/json', {'error': str(e)}
+
+            data = payload if isinstance(payload, str) else json.dumps(payload, default=str)
+            data = data.encode('utf-8')
+            writer.write(
+                f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                f"Content-Type: {content_type}\r\nContent-Length: {len(data)}\r\nConnection: close\r\n\r\n"
+                .encode('latin-1') + data
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.inflight -= 1
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        """Serve until SIGINT/SIGTERM, then drain in-flight requests and release resources"""
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._stop.set)
+            except NotImplementedError:
+                pass
+
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving on http://{host}:{port} (POST /query, GET /healthz, /readyz, /metrics)")
+        loader = loop.create_task(self.load())
+        await self._stop.wait()
+        await self.shutdown(loader)
+
+    async def shutdown(self, loader=None):
+        """Graceful shutdown: stop accepting, wait for in-flight requests, release resources"""
+        print("Shutting down...")
+        self.ready = False
+        self.server.close()
+        deadline = time.monotonic() + self.shutdown_timeout
+        while self.inflight > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if loader is not None and not loader.done():
+            loader.cancel()
+        if self.batcher is not None:
+            await self.batcher.stop()
+        self.executor.shutdown(wait=True)
+        self.embed_executor.shutdown(wait=True)
+        if self.pool is not None:
+            self.pool.close()
+        if self.shards is not None:
+            self.shards.close()
+        print("Shutdown complete")
+
+def main():
+    parser = argparse.ArgumentParser(description='RAG-based Text-to-SQL query service')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to bind')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--db', default='./mimic_iv.sqlite', help='Path to SQLite database')
+    parser.add_argument('--vector-db', default='vector_db', help='Vector database directory')
+    parser.add_argument('--workers', type=int, default=8, help='Pipeline worker threads')
+    parser.add_argument('--pool-size', type=int, default=4, help='SQLite connections in the pool')
+    parser.add_argument('--shards', help='Run SQL over the subject shards in this directory (see db_shards.py)')
+    parser.add_argument('--in-memory', action='store_true',
+                        help='Serve queries from an in-memory copy of the database (reloaded when the file changes)')
+    parser.add_argument('--max-batch-size', type=int, default=32, help='Maximum questions per embedding batch')
+    parser.add_argument('--max-wait-ms', type=float, default=5.0, help='How long to wait to fill an embedding batch')
+    parser.add_argument('--token-budget', type=int, default=DEFAULT_CONTEXT_TOKEN_BUDGET, help='Token budget for the retrieved prompt context')
+    parser.add_argument('--retrieval', choices=RETRIEVAL_MODES, default='dense',
+                        help='Dense (FAISS), embedding-free BM25, or hybrid (rank fusion) retrieval')
+    add_backend_arguments(parser)
+    add_router_arguments(parser)
+    args = parser.parse_args()
+    configure_backend_from_args(args)
+    configure_router_from_args(args)
+
+    service = QueryService(args.vector_db, args.db, workers=args.workers, pool_size=args.pool_size,
+                           max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                           token_budget=args.token_budget, retrieval_mode=args.retrieval,
+                           shard_dir=args.shards, in_memory=args.in_memory)
+    asyncio.run(service.serve(args.host, args.port))
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,32 @@
-import faiss
 import numpy as np
-import pandas as pd
 import os
+from functools import lru_cache
+from bm25_index import BM25Index
+from mmap_store import read_faiss_index, load_records
+from template_index import template_index_exists, load_template_store, search_templates
+from table_index import table_index_exists, load_table_store, search_columns
 
-def load_faiss_index(index_path):
-    """Load a FAISS index from disk"""
-    return faiss.read_index(index_path)
+RETRIEVAL_MODES = ('dense', 'bm25', 'hybrid')
+# Rank offset for reciprocal rank fusion
+RRF_K = 60
 
-def load_metadata(metadata_path):
-    """Load metadata from CSV file"""
-    metadata_df = pd.read_csv(metadata_path)
-    return metadata_df.to_dict('records')
+def load_faiss_index(index_path, mmap=True):
+    """Load a FAISS index from disk (memory-mapped, shared between processes, by default)"""
+    return read_faiss_index(index_path, mmap)
+
+def load_metadata(metadata_path, mmap=True):
+    """Load metadata records from a CSV file (through a memory-mapped sidecar by default)"""
+    return load_records(metadata_path, mmap)
+
+def _results_from_ids(ids, scores, metadata):
+    """Attach scores to copies of the metadata records for the given ids"""
+    results = []
+    for idx, score in zip(ids, scores):
+        if 0 <= idx < len(metadata):
+            result = metadata[idx].copy()
+            result['score'] = float(score)
+            results.append(result)
+    return results
 
 def search_similar(query_embedding, index, metadata, top_k=5):
     """Search for similar vectors in a FAISS index"""
@@ -18,30 +34,128 @@ def search_similar(query_embedding, index, metadata, top_k=5):
     distances, indices = index.search(query_embedding, top_k)
     
     # Get the metadata for the search results
-    results = []
-    for i, idx in enumerate(indices[0]):
-        if idx < len(metadata):
-            result = metadata[idx].copy()
-            result['score'] = float(distances[0][i])
-            results.append(result)
-    
-    return results
+    return _results_from_ids(indices[0], distances[0], metadata)
 
-def search_context(query_embedding, vector_db_dir='vector_db', top_k=5):
-    """Search for relevant context from schema and training data"""
-    # Load schema index and metadata
-    schema_index = load_faiss_index(os.path.join(vector_db_dir, 'schema_index.faiss'))
-    schema_metadata = load_metadata(os.path.join(vector_db_dir, 'schema_metadata.csv'))
-    
-    # Load training index and metadata
-    train_index = load_faiss_index(os.path.join(vector_db_dir, 'train_index.faiss'))
-    train_metadata = load_metadata(os.path.join(vector_db_dir, 'train_metadata.csv'))
+def search_lexical(query_text, bm25, metadata, top_k=5):
+    """Search a BM25 index with the raw query text (no embedding model needed)"""
+    ids, scores = bm25.search(query_text, top_k)
+    return _results_from_ids(ids, scores, metadata)
+
+def search_fused(query_embedding, query_text, index, bm25, metadata, top_k=5, candidates=20):
+    """Reciprocal rank fusion of dense (FAISS) and lexical (BM25) rankings"""
+    _, dense_ids = index.search(query_embedding, candidates)
+    lexical_ids, _ = bm25.search(query_text, candidates)
+    fused = {}
+    for ranking in (dense_ids[0], lexical_ids):
+        for rank, idx in enumerate(ranking):
+            if idx >= 0:
+                fused[int(idx)] = fused.get(int(idx), 0.0) + 1.0 / (RRF_K + rank + 1)
+    ranked = sorted(fused.items(), key=lambda item: -item[1])[:top_k]
+    return _results_from_ids([idx for idx, _ in ranked], [score for _, score in ranked], metadata)
+
+@lru_cache(maxsize=None)
+def load_metadata_store(vector_db_dir='vector_db', mmap=True):
+    """Load schema and training metadata once per process"""
+    schema_metadata = load_metadata(os.path.join(vector_db_dir, 'schema_metadata.csv'), mmap)
+    return {
+        'schema_metadata': schema_metadata,
+        'train_metadata': load_metadata(os.path.join(vector_db_dir, 'train_metadata.csv'), mmap),
+        # Parsed relationships, so the context builder can add the join keys it needs
+        'relationships': [r['relationship'] for r in schema_metadata if isinstance(r.get('relationship'), str)]
+    }
+
+@lru_cache(maxsize=None)
+def load_vector_store(vector_db_dir='vector_db', mmap=True):
+    """Load schema and training indices with their metadata once per process
+
+    When a template-clustered index was built, dense training search uses it
+    instead of the flat index (loaded lazily, only for hybrid retrieval); when a
+    table index was built, dense schema search first picks tables. With
+    `mmap`, indices and metadata are mapped read-only, so worker processes on
+    one machine share a single page-cache copy.
+    """
+    store = dict(load_metadata_store(vector_db_dir, mmap),
+                 schema_index=load_faiss_index(os.path.join(vector_db_dir, 'schema_index.faiss'), mmap))
+    if table_index_exists(vector_db_dir):
+        store['schema_tables'] = load_table_store(vector_db_dir, mmap)
+    if template_index_exists(vector_db_dir):
+        store['train_templates'] = load_template_store(vector_db_dir, mmap)
+    else:
+        store['train_index'] = load_faiss_index(os.path.join(vector_db_dir, 'train_index.faiss'), mmap)
+    return store
+
+@lru_cache(maxsize=None)
+def load_train_index(vector_db_dir='vector_db', mmap=True):
+    """Flat training index, for rank fusion over every example"""
+    store = load_vector_store(vector_db_dir, mmap)
+    if 'train_index' in store:
+        return store['train_index']
+    return load_faiss_index(os.path.join(vector_db_dir, 'train_index.faiss'), mmap)
+
+@lru_cache(maxsize=None)
+def load_bm25_store(vector_db_dir='vector_db'):
+    """Load the memory-mapped BM25 indices with their metadata once per process"""
+    store = dict(load_metadata_store(vector_db_dir),
+                 schema_bm25=BM25Index.load(os.path.join(vector_db_dir, 'schema_bm25')),
+                 train_bm25=BM25Index.load(os.path.join(vector_db_dir, 'train_bm25')))
+    for name in ('schema', 'train'):
+        # Doc ids are metadata row numbers; an index over other metadata would return unrelated rows
+        if store[f'{name}_bm25'].n_docs != len(store[f'{name}_metadata']):
+            raise ValueError(f"{name} BM25 index has {store[f'{name}_bm25'].n_docs} documents but "
+                             f"{name}_metadata.csv has {len(store[f'{name}_metadata'])} rows; rerun setup")
+    return store
+
+def clear_store_cache():
+    """Forget loaded indices, e.g. after setup_vectors rebuilt them"""
+    load_metadata_store.cache_clear()
+    load_vector_store.cache_clear()
+    load_train_index.cache_clear()
+    load_bm25_store.cache_clear()
+
+def search_context(query_embedding, vector_db_dir='vector_db', top_k=5, mode='dense', query_text=None):
+    """Search for relevant context from schema and training data
+
+    mode is 'dense' (FAISS), 'bm25' (lexical, query_embedding may be None) or
+    'hybrid' (reciprocal rank fusion of both; needs query_text too).
+    """
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode: {mode}")
+    # Indices and metadata are loaded on first use and kept warm
+    metadata = load_metadata_store(vector_db_dir)
+    schema_metadata = metadata['schema_metadata']
+    train_metadata = metadata['train_metadata']
     
     # Search both indices
-    schema_results = search_similar(query_embedding, schema_index, schema_metadata, top_k)
-    train_results = search_similar(query_embedding, train_index, train_metadata, top_k)
+    if mode == 'dense':
+        store = load_vector_store(vector_db_dir)
+        if 'schema_tables' in store:
+            # Columns of the best-matching tables only, instead of every column in the schema
+            matches = search_columns(query_embedding, store['schema_tables'], store['schema_index'], top_k)
+            schema_results = _results_from_ids([row for row, _ in matches], [score for _, score in matches],
+                                               schema_metadata)
+        else:
+            schema_results = search_similar(query_embedding, store['schema_index'], schema_metadata, top_k)
+        if 'train_templates' in store:
+            # One example per distinct template, searched over the medoids only
+            matches = search_templates(query_embedding, store['train_templates'], top_k)
+            train_results = _results_from_ids([row for row, _ in matches], [score for _, score in matches],
+                                              train_metadata)
+        else:
+            train_results = search_similar(query_embedding, store['train_index'], train_metadata, top_k)
+    elif mode == 'bm25':
+        store = load_bm25_store(vector_db_dir)
+        schema_results = search_lexical(query_text, store['schema_bm25'], schema_metadata, top_k)
+        train_results = search_lexical(query_text, store['train_bm25'], train_metadata, top_k)
+    else:
+        dense = load_vector_store(vector_db_dir)
+        lexical = load_bm25_store(vector_db_dir)
+        schema_results = search_fused(query_embedding, query_text, dense['schema_index'], lexical['schema_bm25'],
+                                      schema_metadata, top_k)
+        train_results = search_fused(query_embedding, query_text, load_train_index(vector_db_dir), lexical['train_bm25'],
+                                     train_metadata, top_k)
     
     return {
         'schema_results': schema_results,
-        'train_results': train_results
+        'train_results': train_results,
+        'relationships': metadata['relationships']
     }
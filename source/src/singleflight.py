@@ -0,0 +1,31 @@
+import re
+import asyncio
+
+def normalize_question(question):
+    """Normalize a question for coalescing: case, whitespace and trailing punctuation"""
+    return re.sub(r"\s+", " ", question).strip().rstrip("?.! ").lower()
+
+class AsyncSingleFlight:
+    """Coalesces concurrent coroutine calls with the same key (single event loop)"""
+
+    def __init__(self):
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key, factory):
+        """Await factory() once per key at a time; returns (result, shared)"""
+        task = self._calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+            # shield: a cancelled follower must not cancel the shared computation
+            return await asyncio.shield(task), True
+
+        self.leaders += 1
+        task = asyncio.ensure_future(factory())
+        self._calls[key] = task
+        task.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(task), False
+
+    def stats(self):
+        return {'leaders': self.leaders, 'coalesced': self.coalesced, 'in_flight': len(self._calls)}
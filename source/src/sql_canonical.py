@@ -0,0 +1,89 @@
+import re
+import hashlib
+from functools import lru_cache
+
+# One alternation, scanned once: literals are matched whole, so '--' or '```'
+# inside a string is never mistaken for a comment or a code fence
+_TOKEN_PATTERN = re.compile(r"""
+    (?P<string>'(?:[^']|'')*'?)
+  | (?P<fence>```[A-Za-z]*)
+  | (?P<comment>--[^\n]*|/\*.*?(?:\*/|$))
+  | (?P<ident>"(?:[^"]|"")*"?|`[^`]*`|\[[^\]]*\])
+  | (?P<number>\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+  | (?P<word>[A-Za-z_][\w$]*(?:\.[A-Za-z_*][\w$]*)*)
+  | (?P<op><=|>=|<>|!=|==|\|\||\S)
+  | (?P<space>\s+)
+""", re.VERBOSE | re.DOTALL)
+
+# Equivalent operator spellings, folded in the canonical form
+_OPERATOR_ALIASES = {'!=': '<>', '==': '='}
+
+def tokenize(sql):
+    """Split SQL into (kind, text) tokens in a single pass
+
+    Kinds: string, ident (quoted identifier), number, word, op, space. Code fences
+    are dropped; comments and whitespace runs become a single ' ' space token.
+    """
+    tokens = []
+    for match in _TOKEN_PATTERN.finditer(sql):
+        kind = match.lastgroup
+        if kind == 'fence':
+            continue
+        if kind in ('comment', 'space'):
+            kind, text = 'space', ' '
+        else:
+            text = match.group()
+        if kind == 'space' and tokens and tokens[-1][0] == 'space':
+            continue
+        tokens.append((kind, text))
+    return tokens
+
+def clean_sql(sql, require_select=False):
+    """Remove markdown, comments and formatting from an SQL response
+
+    Keeps the query's own casing and literals; whitespace runs become one space and
+    trailing semicolons are dropped. With require_select, text before the first
+    SELECT/WITH is discarded and a ValueError is raised if there is none.
+    """
+    # Stray backticks around the whole answer are markdown, not identifier quotes
+    tokens = [token for token in tokenize(sql.strip().strip('`')) if token != ('op', '`')]
+    if require_select:
+        start = next((i for i, (kind, text) in enumerate(tokens)
+                      if kind == 'word' and text.lower() in ('select', 'with')), None)
+        if start is None:
+            raise ValueError("No SELECT statement found in input.")
+        tokens = tokens[start:]
+    # A leading 'sql' language tag left over from a fence like ``` sql
+    while tokens and tokens[0][0] == 'space':
+        tokens = tokens[1:]
+    if len(tokens) > 1 and tokens[0][0] == 'word' and tokens[0][1].lower() == 'sql' and tokens[1][0] == 'space':
+        tokens = tokens[2:]
+    while tokens and (tokens[-1][0] == 'space' or tokens[-1][1] == ';'):
+        tokens = tokens[:-1]
+    return ''.join(text for _, text in tokens).strip()
+
+@lru_cache(maxsize=65536)
+def canonical_tokens(sql, parameterize=False):
+    """Tokens of the canonical form: lowercased outside string literals, no whitespace
+
+    With parameterize, string and numeric literals become '?'.
+    """
+    canonical = []
+    for kind, text in tokenize(clean_sql(sql)):
+        if kind == 'space':
+            continue
+        if kind in ('string', 'number'):
+            canonical.append('?' if parameterize else text)
+        elif kind == 'op':
+            canonical.append(_OPERATOR_ALIASES.get(text, text))
+        else:
+            canonical.append(text.lower())
+    return tuple(canonical)
+
+def canonical_sql(sql, parameterize=False):
+    """Whitespace- and case-normalized SQL, stable enough to compare or key caches on"""
+    return ' '.join(canonical_tokens(sql, parameterize))
+
+def sql_fingerprint(sql, parameterize=False):
+    """Short stable hash of the canonical form (of its shape, with parameterize)"""
+    return hashlib.sha1(canonical_sql(sql, parameterize).encode()).hexdigest()[:16]
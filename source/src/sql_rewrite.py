@@ -0,0 +1,317 @@
+import os
+import re
+import json
+import calendar
+from datetime import date, timedelta
+from functools import lru_cache
+from sql_canonical import tokenize, sql_fingerprint
+
+# strftime formats that are prefixes of 'YYYY-MM-DD HH:MM:SS', with the literal shape they produce
+_PREFIX_FORMATS = {'%Y': r'\d{4}', '%Y-%m': r'\d{4}-\d{2}', '%Y-%m-%d': r'\d{4}-\d{2}-\d{2}'}
+_COMPARISONS = ('=', '>=', '>', '<=', '<')
+# Tokens after which a comparison starts a new operand (nothing binds tighter on the left)
+_BOUNDARY_BEFORE = {None, '(', ',', 'and', 'or', 'not', 'where', 'on', 'having', 'when', 'then', 'else'}
+# Tokens that may follow a complete comparison
+_BOUNDARY_AFTER = {None, ')', ',', 'and', 'or', 'group', 'order', 'limit', 'having', 'union', 'intersect',
+                   'except', 'then', 'else', 'end', 'when', 'window'}
+_START_OF = re.compile(r"^'start of (year|month|day)'$", re.IGNORECASE)
+_SHIFT = re.compile(r"^'[+-]\d+ (year|month|day)s?'$", re.IGNORECASE)
+# Words allowed in a constant time expression (anything else is a column reference)
+_CONSTANT_WORDS = {'current_time', 'current_timestamp', 'current_date', 'datetime', 'date', 'time', 'strftime',
+                   'julianday'}
+
+def _next(tokens, i):
+    """Index of the next non-space token after i (len(tokens) if none)"""
+    i += 1
+    while i < len(tokens) and tokens[i][0] == 'space':
+        i += 1
+    return i
+
+def _prev(tokens, i):
+    i -= 1
+    while i >= 0 and tokens[i][0] == 'space':
+        i -= 1
+    return i
+
+def _lower(tokens, i):
+    return tokens[i][1].lower() if 0 <= i < len(tokens) else None
+
+def _call(tokens, i):
+    """Parse name(args) at tokens[i]: (end index of ')', list of argument texts) or None"""
+    open_paren = _next(tokens, i)
+    if _lower(tokens, open_paren) != '(':
+        return None
+    args, current, depth = [], [], 0
+    for j in range(open_paren + 1, len(tokens)):
+        text = tokens[j][1]
+        if text == '(':
+            depth += 1
+        elif text == ')':
+            if depth == 0:
+                args.append(''.join(current).strip())
+                return j, args
+            depth -= 1
+        elif text == ',' and depth == 0:
+            args.append(''.join(current).strip())
+            current = []
+            continue
+        current.append(text)
+    return None
+
+def _time_column(arg, time_columns):
+    """The argument if it is a bare or qualified column known to hold canonical timestamps"""
+    if re.fullmatch(r'[A-Za-z_][\w$]*(\.[A-Za-z_][\w$]*)?', arg) and arg.split('.')[-1].lower() in time_columns:
+        return arg
+    return None
+
+def _prefix_bounds(fmt, literal):
+    """[lower, upper) timestamps of the values whose strftime(fmt) equals literal, or None"""
+    if not re.fullmatch(_PREFIX_FORMATS[fmt], literal):
+        return None
+    parts = [int(p) for p in literal.split('-')]
+    try:
+        if fmt == '%Y':
+            lower, upper = date(parts[0], 1, 1), date(parts[0] + 1, 1, 1)
+        elif fmt == '%Y-%m':
+            lower = date(parts[0], parts[1], 1)
+            upper = lower + timedelta(days=calendar.monthrange(parts[0], parts[1])[1])
+        else:
+            lower = date(*parts)
+            upper = lower + timedelta(days=1)
+    except ValueError:
+        return None
+    return f"{lower.isoformat()} 00:00:00", f"{upper.isoformat()} 00:00:00"
+
+def _constant(expression):
+    """Whether an expression reads no column: literals, 'now' and current_time, possibly in time functions"""
+    for kind, text in tokenize(expression):
+        if kind == 'ident' or (kind == 'word' and text.lower() not in _CONSTANT_WORDS):
+            return False
+    return True
+
+def _aligned_rhs(tokens, i, unit):
+    """If tokens[i] starts datetime(x, 'start of <unit>'[, '±N <unit>']) with a constant x, return (end, text)
+
+    A range on the column only helps when its bounds are fixed for the whole
+    query; bounds that depend on another row's column cannot use the index.
+    """
+    if _lower(tokens, i) != 'datetime':
+        return None
+    call = _call(tokens, i)
+    if call is None:
+        return None
+    end, args = call
+    if len(args) not in (2, 3) or not _constant(args[0]):
+        return None
+    start = _START_OF.match(args[1])
+    if not start or start.group(1).lower() != unit:
+        return None
+    if len(args) == 3:
+        shift = _SHIFT.match(args[2])
+        if not shift or shift.group(1).lower() != unit:
+            return None
+    return end, ''.join(text for _, text in tokens[i:end + 1])
+
+def _rewrite_at(tokens, i, time_columns):
+    """Try each rewrite at the function call starting at tokens[i]: (replacement, last index) or None"""
+    name = _lower(tokens, i)
+    call = _call(tokens, i)
+    if call is None:
+        return None
+    end, args = call
+    op_index = _next(tokens, end)
+    op = _lower(tokens, op_index)
+    operand = _next(tokens, op_index)
+    before = _lower(tokens, _prev(tokens, i))
+
+    # strftime('%Y', c) <op> 'YYYY'  ->  range on c
+    if name == 'strftime' and len(args) == 2 and op in _COMPARISONS and before in _BOUNDARY_BEFORE:
+        fmt = args[0].strip("'")
+        column = _time_column(args[1], time_columns)
+        if fmt in _PREFIX_FORMATS and column and operand < len(tokens) and tokens[operand][0] == 'string' \
+                and _lower(tokens, _next(tokens, operand)) in _BOUNDARY_AFTER:
+            bounds = _prefix_bounds(fmt, tokens[operand][1].strip("'"))
+            if bounds:
+                lower, upper = bounds
+                replacement = {
+                    '=': f"({column} >= '{lower}' AND {column} < '{upper}')",
+                    '>=': f"{column} >= '{lower}'",
+                    '>': f"{column} >= '{upper}'",
+                    '<': f"{column} < '{lower}'",
+                    '<=': f"{column} < '{upper}'"
+                }[op]
+                return replacement, operand
+
+    # datetime(c, 'start of X') = datetime(..., 'start of X'[, '±N X'])  ->  c in [rhs, rhs + 1 X)
+    if name == 'datetime' and len(args) == 2 and op == '=' and before in _BOUNDARY_BEFORE:
+        column = _time_column(args[0], time_columns)
+        start = _START_OF.match(args[1])
+        if column and start:
+            unit = start.group(1).lower()
+            rhs = _aligned_rhs(tokens, operand, unit)
+            if rhs and _lower(tokens, _next(tokens, rhs[0])) in _BOUNDARY_AFTER:
+                rhs_end, rhs_text = rhs
+                return f"({column} >= {rhs_text} AND {column} < datetime({rhs_text}, '+1 {unit}'))", rhs_end
+
+    # datetime(c) <op> datetime(...)  ->  c <op> datetime(...); also BETWEEN datetime(...) AND datetime(...)
+    if name == 'datetime' and len(args) == 1 and before in _BOUNDARY_BEFORE:
+        column = _time_column(args[0], time_columns)
+        if column and op in _COMPARISONS + ('between',) and _lower(tokens, operand) == 'datetime':
+            if op == 'between':
+                # Both bounds must be datetime() values, or the comparison affinity changes
+                first = _call(tokens, operand)
+                second = _next(tokens, _next(tokens, first[0])) if first else len(tokens)
+                if not first or _lower(tokens, _next(tokens, first[0])) != 'and' or _lower(tokens, second) != 'datetime':
+                    return None
+            return column, end
+    return None
+
+def _result_column_spans(tokens):
+    """Indices inside the outermost SELECT lists, whose text becomes the result column names"""
+    inside = set()
+    depth = 0
+    in_list = False
+    for i, (_, text) in enumerate(tokens):
+        lowered = text.lower()
+        if text == '(':
+            depth += 1
+        elif text == ')':
+            depth -= 1
+        elif depth == 0 and lowered == 'select':
+            in_list = True
+            continue
+        elif depth == 0 and lowered == 'from':
+            in_list = False
+        if in_list:
+            inside.add(i)
+    return inside
+
+def rewrite_sargable(sql, time_columns):
+    """Rewrite function-wrapped time filters into range predicates on the raw column
+
+    Valid only for columns whose non-NULL values are all TEXT in canonical
+    'YYYY-MM-DD HH:MM:SS' form (see db_prepare.py); NULL rows behave as before
+    because every rewritten comparison is NULL exactly when the original is.
+    Expressions in the outermost SELECT list are left alone so result column
+    names do not change. Returns (sql, number of rewrites).
+    """
+    if not time_columns:
+        return sql, 0
+    tokens = tokenize(sql)
+    result_columns = _result_column_spans(tokens)
+    out = []
+    rewrites = 0
+    i = 0
+    while i < len(tokens):
+        kind, text = tokens[i]
+        rewritten = None
+        if kind == 'word' and text.lower() in ('strftime', 'datetime') and i not in result_columns:
+            rewritten = _rewrite_at(tokens, i, time_columns)
+        if rewritten:
+            replacement, last = rewritten
+            out.append(replacement)
+            rewrites += 1
+            i = last + 1
+        else:
+            out.append(text)
+            i += 1
+    return (''.join(out), rewrites) if rewrites else (sql, 0)
+
+# Compact copy of the admission keys and times (built by db_prepare.py --admission-lookup)
+ADMISSION_LOOKUP_TABLE = 'admission_lookup'
+ADMISSION_LOOKUP_COLUMNS = ('subject_id', 'hadm_id', 'admittime', 'dischtime')
+# Words a patient-scoping subquery may contain besides admissions.<lookup column>
+_LOOKUP_WORDS = {'select', 'distinct', 'from', 'where', 'and', 'or', 'not', 'is', 'null', 'order', 'by', 'asc',
+                 'desc', 'limit', 'admissions'}
+
+def _lookup_subquery(tokens, i):
+    """If tokens[i] is '(' opening SELECT ... FROM admissions WHERE admissions.<key> = ..., the index of
+    the 'admissions' table token when every column it uses is in the lookup, else None"""
+    words = []
+    for j in range(_next(tokens, i), len(tokens)):
+        kind, text = tokens[j]
+        if text == ')':
+            break
+        if text == '(' or kind == 'ident':
+            return None
+        if kind == 'word':
+            words.append((j, text.lower()))
+    else:
+        return None
+    if [w for _, w in words[:1]] != ['select']:
+        return None
+    for index, (_, word) in enumerate(words):
+        table, _, column = word.partition('.')
+        if column:
+            if table != 'admissions' or column not in ADMISSION_LOOKUP_COLUMNS:
+                return None
+        elif word not in _LOOKUP_WORDS:
+            return None
+        if word == 'from':
+            following = [w for _, w in words[index + 1:index + 4]]
+            if following[:2] != ['admissions', 'where'] or following[2:] not in (['admissions.subject_id'],
+                                                                                ['admissions.hadm_id']):
+                return None
+            return words[index + 1][0]
+    return None
+
+def rewrite_admission_lookup(sql):
+    """Point patient-scoping subqueries on admissions at the indexed lookup table
+
+    Only subqueries that read nothing but the lookup columns are rewritten; the
+    table is aliased back to admissions so every column reference stays valid,
+    and the outermost SELECT list is left alone. Returns (sql, number of rewrites).
+    """
+    tokens = tokenize(sql)
+    result_columns = _result_column_spans(tokens)
+    targets = {j for j in (_lookup_subquery(tokens, i) for i, (_, text) in enumerate(tokens)
+                           if text == '(' and i not in result_columns) if j is not None}
+    if not targets:
+        return sql, 0
+    out = [f"{ADMISSION_LOOKUP_TABLE} AS admissions" if i in targets else text for i, (_, text) in enumerate(tokens)]
+    return ''.join(out), len(targets)
+
+def rewrite_sql(sql, profile):
+    """Apply every rewrite the database profile allows: (sql, {rewrite: count})
+
+    Query shapes whose rewrite measured slower on this database (slower_shapes,
+    recorded by db_prepare.py --verify) are left as written.
+    """
+    if profile.get('slower_shapes') and sql_fingerprint(sql, parameterize=True) in profile['slower_shapes']:
+        return sql, {'time_range': 0, 'admission_lookup': 0}
+    sql, time_rewrites = rewrite_sargable(sql, profile.get('columns', frozenset()))
+    lookup_rewrites = 0
+    if profile.get('admission_lookup'):
+        sql, lookup_rewrites = rewrite_admission_lookup(sql)
+    return sql, {'time_range': time_rewrites, 'admission_lookup': lookup_rewrites}
+
+def profile_path(db_path):
+    return f"{db_path}.prepared.json"
+
+@lru_cache(maxsize=None)
+def _read_profile(path, db_mtime, db_size):
+    with open(path) as f:
+        profile = json.load(f)
+    # A profile describes one exact database file; any later write invalidates it
+    if profile.get('db_mtime') != db_mtime or profile.get('db_size') != db_size:
+        print(f"Database profile {path} is stale; rerun db_prepare.py. Query rewrites disabled.")
+        return {}
+    profile['columns'] = frozenset(profile['columns'])
+    profile['slower_shapes'] = frozenset(profile.get('slower_shapes', ()))
+    return profile
+
+def load_profile(db_path):
+    """What db_prepare.py verified on db_path: time columns and lookup tables ({} if not profiled)"""
+    path = profile_path(db_path)
+    if not db_path or not os.path.exists(path) or not os.path.exists(db_path):
+        return {}
+    stat = os.stat(db_path)
+    return _read_profile(path, stat.st_mtime, stat.st_size)
+
+def load_time_columns(db_path):
+    """Column names verified to hold canonical timestamps in db_path (empty if not profiled)"""
+    return load_profile(db_path).get('columns', frozenset())
+
+def prepare_sql(sql, db_path):
+    """The SQL to send to db_path, with the rewrites its profile allows"""
+    return rewrite_sql(sql, load_profile(db_path))[0]
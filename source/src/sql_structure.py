@@ -0,0 +1,175 @@
+import os
+from collections import Counter
+from functools import lru_cache
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from sql_canonical import canonical_tokens
+
+CLAUSES = ('select', 'from', 'where', 'group_by', 'having', 'order_by', 'limit')
+
+# Keywords that open a clause; two-word ones are matched on their first word
+_CLAUSE_STARTS = {'select': 'select', 'from': 'from', 'where': 'where', 'group': 'group_by',
+                  'having': 'having', 'order': 'order_by', 'limit': 'limit'}
+_JOINS = {'join', 'inner', 'left', 'right', 'full', 'cross', 'outer', 'natural'}
+_SET_OPERATORS = {'union', 'intersect', 'except'}
+
+def _parse_select(tokens, i, buckets):
+    """Parse one (possibly compound) SELECT starting at tokens[i] into buckets
+
+    Returns the index after the statement: the end of input or the ')' closing a subquery.
+    Subqueries are parsed into the same buckets and stand as '(subquery)' in the enclosing item.
+    """
+    clause = None
+    item = []
+    depth = 0
+    between = False
+
+    def flush():
+        if clause and item:
+            buckets[clause].append(' '.join(item))
+        item.clear()
+
+    while i < len(tokens):
+        token = tokens[i]
+        if token == '(' and i + 1 < len(tokens) and tokens[i + 1] == 'select':
+            i = _parse_select(tokens, i + 1, buckets)
+            item.append('(subquery)')
+        elif token == '(':
+            depth += 1
+            item.append(token)
+        elif token == ')':
+            if depth == 0:
+                flush()
+                return i
+            depth -= 1
+            item.append(token)
+        elif depth > 0:
+            item.append(token)
+        elif token in _CLAUSE_STARTS:
+            flush()
+            clause = _CLAUSE_STARTS[token]
+            if token in ('group', 'order') and i + 1 < len(tokens) and tokens[i + 1] == 'by':
+                i += 1
+        elif token in _SET_OPERATORS:
+            flush()
+            clause = None
+            if i + 1 < len(tokens) and tokens[i + 1] == 'all':
+                i += 1
+        elif token == ',' and clause in ('select', 'from', 'group_by', 'order_by'):
+            flush()
+        elif clause == 'from' and token in _JOINS:
+            # JOIN variants separate FROM items; ON conditions become their own items
+            if item and item[-1] not in _JOINS:
+                flush()
+        elif clause == 'from' and token == 'on':
+            flush()
+            item.append('on')
+        elif clause in ('where', 'having', 'from') and token in ('and', 'or') and not between:
+            flush()
+        else:
+            # The AND of BETWEEN x AND y belongs to the current condition
+            if token == 'between':
+                between = True
+            elif token == 'and':
+                between = False
+            item.append(token)
+        i += 1
+    flush()
+    return i
+
+@lru_cache(maxsize=65536)
+def parse_sql_structure(sql):
+    """Clause components of a SQL string, including those of nested subqueries
+
+    Returns {clause: tuple of normalized items}. Cached, so gold SQL repeated
+    across rows and runs is parsed once per process.
+    """
+    buckets = {clause: [] for clause in CLAUSES}
+    if isinstance(sql, str):
+        tokens = canonical_tokens(sql)
+        i = 0
+        while i < len(tokens):
+            i = _parse_select(tokens, i, buckets) + 1
+    return {clause: tuple(sorted(items)) for clause, items in buckets.items()}
+
+def clause_counts(pred_sql, gold_sql):
+    """Per-clause (predicted items, gold items, overlapping items) as multiset counts"""
+    pred = parse_sql_structure(pred_sql)
+    gold = parse_sql_structure(gold_sql)
+    counts = {}
+    for clause in CLAUSES:
+        overlap = Counter(pred[clause]) & Counter(gold[clause])
+        counts[clause] = (len(pred[clause]), len(gold[clause]), sum(overlap.values()))
+    return counts
+
+def _f1_arrays(pred_n, gold_n, overlap):
+    """Precision/recall/F1 over whole columns; a clause absent from both sides scores 1"""
+    pred_n, gold_n, overlap = (np.asarray(a, dtype=np.float64) for a in (pred_n, gold_n, overlap))
+    both_empty = (pred_n == 0) & (gold_n == 0)
+    precision = np.divide(overlap, pred_n, out=np.zeros_like(overlap), where=pred_n > 0)
+    recall = np.divide(overlap, gold_n, out=np.zeros_like(overlap), where=gold_n > 0)
+    total = precision + recall
+    f1 = np.divide(2 * precision * recall, total, out=np.zeros_like(overlap), where=total > 0)
+    return (np.where(both_empty, 1.0, precision), np.where(both_empty, 1.0, recall),
+            np.where(both_empty, 1.0, f1))
+
+def evaluate_sql_match(generated_sql, ground_truth_sql):
+    """Clause-level precision/recall/F1 of one generated query against the gold query"""
+    counts = clause_counts(generated_sql, ground_truth_sql)
+    scores = {}
+    for clause, (pred_n, gold_n, overlap) in counts.items():
+        precision, recall, f1 = _f1_arrays([pred_n], [gold_n], [overlap])
+        scores[clause] = {'precision': float(precision[0]), 'recall': float(recall[0]), 'f1': float(f1[0])}
+    return scores
+
+def score_frame(df, pred_col='pred_sql', gold_col='gold_sql'):
+    """Add <clause>_f1 columns and structural_match to a results frame
+
+    Each distinct (predicted, gold) pair is parsed and counted once; the F1
+    arithmetic then runs column-wise over the whole frame.
+    """
+    pairs = list(zip(df[pred_col].where(df[pred_col].notna(), None), df[gold_col].where(df[gold_col].notna(), None)))
+    unique_counts = {pair: clause_counts(*pair) for pair in set(pairs)}
+    scored = df.copy()
+    match = np.ones(len(df), dtype=bool)
+    for clause in CLAUSES:
+        pred_n, gold_n, overlap = np.array([unique_counts[pair][clause] for pair in pairs]).reshape(-1, 3).T
+        _, _, f1 = _f1_arrays(pred_n, gold_n, overlap)
+        scored[f'{clause}_f1'] = f1
+        match &= f1 == 1.0
+    scored['structural_match'] = match
+    return scored
+
+def _detect_columns(df):
+    """Column names of detailed_results.csv or structural_evaluation_results.csv"""
+    for pred_col, gold_col in (('pred_sql', 'gold_sql'), ('generated_sql', 'ground_truth_sql')):
+        if pred_col in df.columns and gold_col in df.columns:
+            return pred_col, gold_col
+    raise ValueError(f"No predicted/gold SQL columns in {list(df.columns)}")
+
+def _score_chunk(args):
+    df, pred_col, gold_col = args
+    return score_frame(df, pred_col, gold_col)
+
+def score_results_file(path, processes=None, pred_col=None, gold_col=None, min_rows_per_process=500):
+    """Score an existing results CSV offline (no model, no LLM), split across processes"""
+    df = pd.read_csv(path)
+    if pred_col is None or gold_col is None:
+        pred_col, gold_col = _detect_columns(df)
+    processes = min(processes or os.cpu_count() or 1, max(1, len(df) // min_rows_per_process))
+    if processes <= 1:
+        return score_frame(df, pred_col, gold_col)
+    # Split by row position: np.array_split on a DataFrame is deprecated and yields ndarrays on newer pandas
+    bounds = [(part[0], part[-1] + 1) for part in np.array_split(np.arange(len(df)), processes)]
+    chunks = [(df.iloc[start:end], pred_col, gold_col) for start, end in bounds]
+    with Pool(processes) as pool:
+        return pd.concat(pool.map(_score_chunk, chunks))
+
+def summarize_scores(scored):
+    """Mean clause F1 and structural accuracy over a scored frame"""
+    summary = {'total': len(scored)}
+    for clause in CLAUSES:
+        summary[f'avg_{clause}_f1'] = float(scored[f'{clause}_f1'].mean()) if len(scored) else 0.0
+    summary['structural_accuracy'] = float(scored['structural_match'].mean()) if len(scored) else 0.0
+    return summary
@@ -0,0 +1,173 @@
+import os
+import sqlite3
+import difflib
+import threading
+from functools import lru_cache
+from sql_canonical import canonical_tokens
+from schema_catalog import load_catalog
+
+# Words that end a FROM item, so they are never taken for a table alias
+_RESERVED = {
+    'where', 'group', 'order', 'limit', 'having', 'union', 'intersect', 'except', 'join', 'inner', 'left',
+    'right', 'full', 'cross', 'outer', 'natural', 'on', 'using', 'as', 'select', 'from', 'and', 'or', 'not',
+    'window', 'offset', 'with'
+}
+
+def _error(kind, message, identifier=None, suggestion=None):
+    return {'kind': kind, 'message': message, 'identifier': identifier, 'suggestion': suggestion}
+
+def _suggest(name, candidates):
+    matches = difflib.get_close_matches(name, list(candidates), n=1, cutoff=0.6)
+    return matches[0] if matches else None
+
+def _is_name(token):
+    return token[0].isalpha() or token[0] == '_'
+
+class SQLValidator:
+    """Checks generated SQL against the schema catalog without touching the data file
+
+    Identifiers are resolved against the catalog for precise errors with
+    suggestions; EXPLAIN on a schema-only in-memory database then catches the
+    rest (syntax, bare columns, functions). Only EXPLAIN decides validity, so an
+    unusual but valid query is never rejected by the resolver alone.
+    """
+
+    def __init__(self, catalog, ddl=None):
+        self.catalog = catalog
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(':memory:', check_same_thread=False)
+        self._conn.executescript(ddl or catalog.ddl())
+
+    def resolve_identifiers(self, sql):
+        """Errors for tables and qualified columns that the catalog does not know"""
+        tokens = canonical_tokens(sql)
+        errors = []
+        aliases = {}
+        derived = set()
+        depth = 0
+        from_depths = set()
+        expect_table = False
+        # First pass: FROM/JOIN tables and their aliases, CTE and subquery names
+        for i, token in enumerate(tokens):
+            following = tokens[i + 1] if i + 1 < len(tokens) else None
+            after_as = tokens[i + 2] if following == 'as' and i + 2 < len(tokens) else following
+            if expect_table:
+                expect_table = False
+                if _is_name(token) and '.' not in token:
+                    table = token if self.catalog.has_table(token) else None
+                    if table is None and token not in derived:
+                        errors.append(_error('unknown_table', f"no such table: {token}", token,
+                                             _suggest(token, self.catalog.table_names())))
+                    aliases[token] = table
+                    if after_as and _is_name(after_as) and after_as not in _RESERVED:
+                        aliases[after_as] = table
+                    continue
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                from_depths.discard(depth)
+                depth -= 1
+                # ") AS t" or ") t" names a subquery
+                if after_as and _is_name(after_as) and after_as not in _RESERVED:
+                    derived.add(after_as)
+            elif token in ('from', 'join'):
+                from_depths.add(depth)
+                expect_table = True
+            elif token == ',' and depth in from_depths:
+                expect_table = True
+            elif token == 'with' or (token == ',' and depth == 0 and after_as != following):
+                # CTE names: WITH name AS (...), name AS (...)
+                if following and _is_name(following):
+                    derived.add(following)
+            elif token in ('where', 'group', 'order', 'limit', 'having', 'union', 'intersect', 'except', 'select'):
+                from_depths.discard(depth)
+
+        # Second pass: qualified column references
+        for token in tokens:
+            if '.' not in token or not _is_name(token):
+                continue
+            qualifier, column = token.rsplit('.', 1)
+            if column == '*' or qualifier in derived:
+                continue
+            if qualifier in aliases:
+                table = aliases[qualifier]
+            elif self.catalog.has_table(qualifier):
+                table = qualifier
+            else:
+                errors.append(_error('unknown_table', f"no such table or alias: {qualifier}", qualifier,
+                                     _suggest(qualifier, list(aliases) + self.catalog.table_names())))
+                continue
+            if table is not None and not self.catalog.has_column(table, column):
+                errors.append(_error('unknown_column', f"no such column: {table}.{column}", token,
+                                     _suggest(column, [c['name'] for c in self.catalog.columns(table)])))
+        return errors
+
+    def explain(self, sql):
+        """Compile the query with EXPLAIN on the schema-only database; None or an error dict"""
+        try:
+            with self._lock:
+                self._conn.execute(f"EXPLAIN {sql}").fetchall()
+        except (sqlite3.Error, sqlite3.Warning) as e:
+            message = str(e)
+            if message.startswith('no such table'):
+                kind = 'unknown_table'
+            elif message.startswith('no such column'):
+                kind = 'unknown_column'
+            elif message.startswith('ambiguous column'):
+                kind = 'ambiguous_column'
+            else:
+                kind = 'syntax'
+            identifier = message.split(': ', 1)[1] if ': ' in message else None
+            return _error(kind, message, identifier)
+        return None
+
+    def validate(self, sql):
+        """Return {'valid': bool, 'errors': [{kind, message, identifier, suggestion}, ...]}"""
+        tokens = canonical_tokens(sql) if sql else ()
+        if not tokens:
+            return {'valid': False, 'errors': [_error('empty', "empty query")]}
+        if tokens[0] not in ('select', 'with'):
+            return {'valid': False, 'errors': [_error('not_select', f"only SELECT queries are allowed, got {tokens[0]}")]}
+        explain_error = self.explain(sql)
+        if explain_error is None:
+            return {'valid': True, 'errors': []}
+        errors = self.resolve_identifiers(sql)
+        return {'valid': False, 'errors': errors or [explain_error]}
+
+def format_validation_errors(errors):
+    """One line per error, with the suggested fix, for logs and repair prompts"""
+    lines = []
+    for error in errors:
+        line = error['message']
+        if error.get('suggestion'):
+            line += f" (did you mean {error['suggestion']}?)"
+        lines.append(line)
+    return '; '.join(lines)
+
+def schema_ddl_from_db(db_path):
+    """CREATE statements stored in a database file (reads sqlite_master only, no data pages)"""
+    if not db_path or not os.path.exists(db_path):
+        return None
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            rows = conn.execute("SELECT sql FROM sqlite_master WHERE type IN ('table', 'view') AND sql IS NOT NULL "
+                                "AND name NOT LIKE 'sqlite_%'").fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    return ';\n'.join(row[0] for row in rows) + ';' if rows else None
+
+@lru_cache(maxsize=None)
+def load_validator(cache_dir='vector_db', db_path=None):
+    """Validator over the catalog built by setup, or None when there is no catalog yet
+
+    EXPLAIN runs against the schema of db_path when it has one, so columns the
+    DDL file omits but the database has (e.g. inputevents.totalamount) still pass.
+    """
+    try:
+        catalog = load_catalog(cache_dir=cache_dir)
+    except FileNotFoundError:
+        return None
+    return SQLValidator(catalog, schema_ddl_from_db(db_path))
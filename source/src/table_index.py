@@ -0,0 +1,146 @@
+import os
+import re
+import json
+import numpy as np
+import pandas as pd
+import faiss
+from mmap_store import read_faiss_index, write_faiss_index, save_array
+from embedding_store import encode_with_store
+
+# Candidate tables whose columns are searched for each query
+DEFAULT_TABLE_K = 3
+
+def _table_paths(vector_db_dir):
+    prefix = os.path.join(vector_db_dir, 'schema_table')
+    return {
+        'index': f"{prefix}_index.faiss",
+        'metadata': f"{prefix}_metadata.csv",
+        'member_offsets': f"{prefix}_member_offsets.npy",
+        'members': f"{prefix}_members.npy",
+        'report': f"{prefix}_report.json"
+    }
+
+def table_index_exists(vector_db_dir='vector_db'):
+    return os.path.exists(_table_paths(vector_db_dir)['index'])
+
+def table_records(schema_metadata):
+    """One record per table (text from its columns and their descriptions) and the schema rows of its columns"""
+    columns = schema_metadata[schema_metadata['column_name'].notna()]
+    records, members = [], []
+    for table, group in columns.groupby('table_name', sort=False):
+        described = [f"{name} ({description})" if isinstance(description, str) and description else str(name)
+                     for name, description in zip(group['column_name'], group['description'])]
+        records.append({'table_name': table,
+                        'text_for_embedding': f"Table: {table}\nColumns: {', '.join(described)}"})
+        members.append(group.index.to_numpy())
+    return records, members
+
+def search_columns(query_embedding, store, column_index, top_k=5, table_k=DEFAULT_TABLE_K):
+    """Return up to top_k (schema row, score) column matches from the table_k best-matching tables
+
+    Only the table index and the columns of the selected tables are scored, so
+    the cost grows with the relevant tables rather than with the whole schema.
+    Tables take turns in rank order, each contributing its next best column, so
+    one join key repeated across tables cannot crowd out the others.
+    """
+    _, table_ids = store['index'].search(query_embedding, min(table_k, store['index'].ntotal))
+    rankings = []
+    for table_id in table_ids[0]:
+        if table_id < 0:
+            continue
+        start, end = store['member_offsets'][table_id], store['member_offsets'][table_id + 1]
+        rows = np.asarray(store['members'][start:end], dtype=np.int64)
+        if len(rows):
+            scores = column_index.reconstruct_batch(rows) @ query_embedding[0]
+            rankings.append([(int(rows[i]), float(scores[i])) for i in np.argsort(-scores, kind='stable')])
+    results = []
+    for position in range(max((len(ranking) for ranking in rankings), default=0)):
+        for ranking in rankings:
+            if position < len(ranking) and len(results) < top_k:
+                results.append(ranking[position])
+    return results
+
+def _gold_table_coverage(rows, schema_metadata, gold_tables):
+    """Share of the query's tables that appear among the tables of the retrieved columns"""
+    found = {schema_metadata['table_name'].iat[row] for row in rows}
+    return len(found & gold_tables) / len(gold_tables)
+
+def build_table_index(vector_db_dir='vector_db', model=None, model_name='all-MiniLM-L6-v2', table_k=DEFAULT_TABLE_K,
+                      recall_sample=500, top_k=5, seed=0):
+    """Embed one vector per table and record which schema rows are its columns
+
+    When training data was vectorized, its examples serve as sample queries: the
+    report compares how many of the tables each gold query uses are reached by
+    the flat and by the table-first column search.
+    """
+    schema_metadata = pd.read_csv(os.path.join(vector_db_dir, 'schema_metadata.csv'))
+    records, members = table_records(schema_metadata)
+    embeddings = encode_with_store([r['text_for_embedding'] for r in records], vector_db_dir, 'schema_tables',
+                                   model_name, model=model, show_progress_bar=False)
+    faiss.normalize_L2(embeddings)
+    index = faiss.IndexFlatIP(embeddings.shape[1])
+    index.add(embeddings)
+
+    member_offsets = np.zeros(len(members) + 1, dtype=np.int64)
+    np.cumsum([len(rows) for rows in members], out=member_offsets[1:])
+    paths = _table_paths(vector_db_dir)
+    write_faiss_index(index, paths['index'])
+    pd.DataFrame(records).to_csv(paths['metadata'], index=False)
+    save_array(paths['member_offsets'], member_offsets)
+    save_array(paths['members'], np.concatenate(members).astype(np.int64) if members else np.zeros(0, dtype=np.int64))
+
+    report = {
+        'tables': len(records),
+        'columns': int(member_offsets[-1]),
+        'table_k': table_k,
+        'top_k': top_k,
+        # Upper bound until sample queries measure it: the table_k widest tables
+        'mean_columns_scored': float(np.sort(np.diff(member_offsets))[::-1][:table_k].sum())
+    }
+    train_index_path = os.path.join(vector_db_dir, 'train_index.faiss')
+    if os.path.exists(train_index_path):
+        store = load_table_store(vector_db_dir)
+        column_index = faiss.read_index(os.path.join(vector_db_dir, 'schema_index.faiss'))
+        train_index = faiss.read_index(train_index_path)
+        queries = pd.read_csv(os.path.join(vector_db_dir, 'train_metadata.csv'), usecols=['query'])['query']
+        patterns = {r['table_name']: re.compile(rf"\b{re.escape(r['table_name'])}\b", re.IGNORECASE) for r in records}
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(train_index.ntotal, min(recall_sample, train_index.ntotal), replace=False)
+        flat_coverage, table_coverage, scored = [], [], []
+        for row in sample:
+            gold_tables = {table for table, pattern in patterns.items() if pattern.search(str(queries.iat[row]))}
+            if not gold_tables:
+                continue
+            query = train_index.reconstruct(int(row)).reshape(1, -1)
+            _, flat_ids = column_index.search(query, top_k)
+            flat_rows = [int(i) for i in flat_ids[0] if i >= 0 and isinstance(schema_metadata['table_name'].iat[i], str)]
+            table_rows = [r for r, _ in search_columns(query, store, column_index, top_k, table_k)]
+            flat_coverage.append(_gold_table_coverage(flat_rows, schema_metadata, gold_tables))
+            table_coverage.append(_gold_table_coverage(table_rows, schema_metadata, gold_tables))
+            _, table_ids = store['index'].search(query, table_k)
+            scored.append(sum(int(store['member_offsets'][t + 1] - store['member_offsets'][t]) for t in table_ids[0] if t >= 0))
+        if scored:
+            report.update({
+                'sample_queries': len(scored),
+                'flat_gold_table_coverage': float(np.mean(flat_coverage)),
+                'table_first_gold_table_coverage': float(np.mean(table_coverage)),
+                'mean_columns_scored': float(np.mean(scored))
+            })
+    with open(paths['report'], 'w') as f:
+        json.dump(report, f, indent=2)
+    summary = (f"Table index complete: {report['tables']} tables over {report['columns']} columns, "
+               f"~{report['mean_columns_scored']:.0f} columns scored per query (top {table_k} tables)")
+    if 'sample_queries' in report:
+        summary += (f"; gold table coverage@{top_k} {report['flat_gold_table_coverage']:.2%} flat -> "
+                    f"{report['table_first_gold_table_coverage']:.2%} table-first")
+    print(summary)
+    return report
+
+def load_table_store(vector_db_dir='vector_db', mmap=True):
+    """Load the table index and the table -> column row arrays (memory-mapped)"""
+    paths = _table_paths(vector_db_dir)
+    return {
+        'index': read_faiss_index(paths['index'], mmap),
+        'member_offsets': np.load(paths['member_offsets'], mmap_mode='r'),
+        'members': np.load(paths['members'], mmap_mode='r')
+    }
@@ -0,0 +1,151 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import faiss
+from sql_generator import example_key
+from mmap_store import read_faiss_index, write_faiss_index, save_array
+
+# Upper bound on the group size used for the medoid similarity matrix
+MAX_MEDOID_CANDIDATES = 4096
+
+def _template_paths(vector_db_dir):
+    prefix = os.path.join(vector_db_dir, 'train_template')
+    return {
+        'index': f"{prefix}_index.faiss",
+        'medoid_rows': f"{prefix}_medoid_rows.npy",
+        'medoid_groups': f"{prefix}_medoid_groups.npy",
+        'member_offsets': f"{prefix}_member_offsets.npy",
+        'members': f"{prefix}_members.npy",
+        'report': f"{prefix}_report.json"
+    }
+
+def template_index_exists(vector_db_dir='vector_db'):
+    return os.path.exists(_template_paths(vector_db_dir)['index'])
+
+def select_medoids(vectors, k, seed=0):
+    """Greedy k-medoids on cosine similarity: each pick maximizes total best-similarity coverage"""
+    if len(vectors) <= k:
+        return np.arange(len(vectors))
+    candidates = np.arange(len(vectors))
+    if len(vectors) > MAX_MEDOID_CANDIDATES:
+        candidates = np.random.default_rng(seed).choice(len(vectors), MAX_MEDOID_CANDIDATES, replace=False)
+    similarity = vectors[candidates] @ vectors[candidates].T
+    chosen = [int(np.argmax(similarity.sum(axis=1)))]
+    coverage = similarity[chosen[0]].copy()
+    while len(chosen) < k:
+        gains = np.maximum(similarity, coverage).sum(axis=1)
+        gains[chosen] = -np.inf
+        best = int(np.argmax(gains))
+        chosen.append(best)
+        coverage = np.maximum(coverage, similarity[best])
+    return candidates[chosen]
+
+def build_template_index(vector_db_dir='vector_db', medoids_per_template=2, recall_sample=500, top_k=5, seed=0):
+    """Group training examples by template and index a few medoid vectors per template
+
+    Groups larger than medoids_per_template**2 keep about sqrt(size) medoids, so a
+    template with many paraphrases (or the pool of template-less rows) stays covered.
+    """
+    full_index = faiss.read_index(os.path.join(vector_db_dir, 'train_index.faiss'))
+    metadata = pd.read_csv(os.path.join(vector_db_dir, 'train_metadata.csv'), usecols=['template', 'query'])
+    vectors = full_index.reconstruct_n(0, full_index.ntotal)
+
+    # Group rows by template (or literal-masked SQL when the template is missing)
+    keys = [example_key({'template': t, 'query': q}) for t, q in zip(metadata['template'], metadata['query'])]
+    groups = {}
+    for row, key in enumerate(keys):
+        groups.setdefault(key, []).append(row)
+
+    medoid_rows, medoid_groups, member_offsets, members = [], [], [0], []
+    for group_id, rows in enumerate(groups.values()):
+        rows = np.array(rows)
+        k = min(len(rows), max(medoids_per_template, int(np.sqrt(len(rows)))))
+        for position in select_medoids(vectors[rows], k, seed):
+            medoid_rows.append(rows[position])
+            medoid_groups.append(group_id)
+        members.extend(rows.tolist())
+        member_offsets.append(len(members))
+
+    medoid_rows = np.array(medoid_rows, dtype=np.int64)
+    primary = faiss.IndexFlatIP(vectors.shape[1])
+    primary.add(vectors[medoid_rows])
+
+    paths = _template_paths(vector_db_dir)
+    write_faiss_index(primary, paths['index'])
+    save_array(paths['medoid_rows'], medoid_rows)
+    save_array(paths['medoid_groups'], np.array(medoid_groups, dtype=np.int32))
+    save_array(paths['member_offsets'], np.array(member_offsets, dtype=np.int64))
+    save_array(paths['members'], np.array(members, dtype=np.int64))
+
+    # Template recall: share of the distinct templates in the flat top-k also found by the clustered search
+    store = load_template_store(vector_db_dir)
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(full_index.ntotal, min(recall_sample, full_index.ntotal), replace=False)
+    group_of_row = np.empty(full_index.ntotal, dtype=np.int32)
+    for group_id in range(len(member_offsets) - 1):
+        group_of_row[members[member_offsets[group_id]:member_offsets[group_id + 1]]] = group_id
+    recalls = []
+    for row in queries:
+        query = vectors[row:row + 1]
+        _, flat_ids = full_index.search(query, top_k)
+        flat_groups = {int(group_of_row[i]) for i in flat_ids[0] if i >= 0}
+        clustered_groups = {int(group_of_row[i]) for i, _ in search_templates(query, store, top_k)}
+        recalls.append(len(flat_groups & clustered_groups) / len(flat_groups))
+
+    report = {
+        'examples': int(full_index.ntotal),
+        'templates': len(groups),
+        'primary_vectors': int(primary.ntotal),
+        'vector_reduction': float(full_index.ntotal / max(1, primary.ntotal)),
+        'primary_index_bytes': os.path.getsize(paths['index']),
+        'full_index_bytes': os.path.getsize(os.path.join(vector_db_dir, 'train_index.faiss')),
+        'template_recall_at_k': float(np.mean(recalls)) if recalls else 0.0,
+        'top_k': top_k
+    }
+    with open(paths['report'], 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Template index complete: {report['primary_vectors']} medoids for {report['templates']} templates "
+          f"({report['vector_reduction']:.1f}x fewer vectors than {report['examples']} examples), "
+          f"template recall@{top_k} {report['template_recall_at_k']:.2%}")
+    return report
+
+def load_template_store(vector_db_dir='vector_db', mmap=True):
+    """Load the medoid index and the group membership arrays (memory-mapped)"""
+    paths = _template_paths(vector_db_dir)
+    return {
+        'index': read_faiss_index(paths['index'], mmap),
+        'medoid_rows': np.load(paths['medoid_rows'], mmap_mode='r'),
+        'medoid_groups': np.load(paths['medoid_groups'], mmap_mode='r'),
+        'member_offsets': np.load(paths['member_offsets'], mmap_mode='r'),
+        'members': np.load(paths['members'], mmap_mode='r')
+    }
+
+def search_templates(query_embedding, store, top_k=5, full_index=None):
+    """Return up to top_k (train row, score) pairs from distinct templates
+
+    Only the medoid index is searched. With `full_index`, the members of each
+    selected template are fetched on demand and the best-scoring member is returned.
+    """
+    fetch = min(store['index'].ntotal, top_k * 4)
+    scores, ids = store['index'].search(query_embedding, fetch)
+    results = []
+    seen = set()
+    for score, idx in zip(scores[0], ids[0]):
+        if idx < 0:
+            continue
+        group_id = int(store['medoid_groups'][idx])
+        if group_id in seen:
+            continue
+        seen.add(group_id)
+        row, best = int(store['medoid_rows'][idx]), float(score)
+        if full_index is not None:
+            start, end = store['member_offsets'][group_id], store['member_offsets'][group_id + 1]
+            member_rows = np.asarray(store['members'][start:end])
+            member_vectors = np.vstack([full_index.reconstruct(int(r)) for r in member_rows])
+            member_scores = member_vectors @ query_embedding[0]
+            row, best = int(member_rows[np.argmax(member_scores)]), float(member_scores.max())
+        results.append((row, best))
+        if len(results) == top_k:
+            break
+    return results
@@ -0,0 +1,108 @@
+import sqlite3
+import pytest
+import pandas as pd
+from db_shards import plan_query, shard_of, _merge_aggregates
+
+# Four shards; d_labitems is replicated, hadm_id is co-located with subject_id
+MANIFEST = {
+    'n_shards': 4,
+    'sharded_tables': frozenset({'patients', 'admissions', 'labevents', 'prescriptions'}),
+    'replicated_tables': ['d_labitems'],
+    'colocated_keys': frozenset({'hadm_id'})
+}
+SUBJECT = 10014729
+SHARD = shard_of(SUBJECT, MANIFEST['n_shards'])
+PINNED = f"SELECT admissions.hadm_id FROM admissions WHERE admissions.subject_id = {SUBJECT}"
+
+ROUTED = [
+    f"SELECT gender FROM patients WHERE subject_id = {SUBJECT}",
+    f"SELECT COUNT(*) FROM admissions WHERE admissions.subject_id = {SUBJECT} AND admission_type = 'URGENT'",
+    f"SELECT gender FROM patients WHERE subject_id = {SUBJECT} AND (gender = 'F' OR gender = 'M')",
+    # Pinned to one subject, so grouping, ordering and DISTINCT need no merge
+    f"SELECT DISTINCT drug FROM prescriptions WHERE subject_id = {SUBJECT} ORDER BY drug LIMIT 5",
+    f"SELECT COUNT(DISTINCT hadm_id) FROM admissions WHERE subject_id = {SUBJECT}",
+    # Through a co-located key
+    f"SELECT drug FROM prescriptions WHERE prescriptions.hadm_id IN ( {PINNED} )",
+    f"SELECT drug FROM prescriptions WHERE starttime > '2100-01-01' AND prescriptions.hadm_id IN ( {PINNED} ) "
+    "ORDER BY drug",
+]
+
+# sql -> plan kind, for queries that cannot be routed
+NOT_ROUTED = [
+    # OR drops the pin: rows still concatenate or add up across shards...
+    (f"SELECT gender FROM patients WHERE subject_id = {SUBJECT} OR subject_id = 10014730", 'scatter_rows'),
+    (f"SELECT COUNT(*) FROM patients WHERE subject_id = {SUBJECT} OR subject_id = 10014730", 'scatter_aggregate'),
+    # ...unless the query needs all rows in one place
+    (f"SELECT drug FROM prescriptions WHERE prescriptions.hadm_id IN ( {PINNED} ) OR drug = 'x' ORDER BY drug",
+     'full'),
+    (f"SELECT drug FROM prescriptions WHERE prescriptions.hadm_id IN ( {PINNED} OR admissions.subject_id = 3 )",
+     'full'),
+    # hadm_id is co-located, stay_id is not
+    (f"SELECT drug FROM prescriptions WHERE prescriptions.stay_id IN ( {PINNED} )", 'full'),
+    # Pinned to two shards at once
+    (f"SELECT drug FROM prescriptions WHERE prescriptions.hadm_id IN ( {PINNED} ) "
+     f"AND prescriptions.subject_id = {SUBJECT + 1}", 'full'),
+    # The subject is an expression, not a number
+    (f"SELECT gender FROM patients WHERE subject_id = {SUBJECT} + 1", 'scatter_rows'),
+    ("SELECT DISTINCT gender FROM patients", 'full'),
+    ("SELECT gender FROM patients ORDER BY dob", 'full'),
+    ("SELECT gender FROM patients LIMIT 1", 'full'),
+    ("SELECT gender, COUNT(*) FROM patients GROUP BY gender", 'full'),
+    ("SELECT COUNT(DISTINCT hadm_id) FROM admissions WHERE admission_type = 'URGENT'", 'full'),
+    ("SELECT gender FROM patients WHERE gender = 'F' UNION SELECT gender FROM patients WHERE gender = 'M'", 'full'),
+    # Compound expressions over aggregates
+    ("SELECT COUNT(*) + 1 FROM patients", 'full'),
+    ("SELECT MAX(valuenum) - MIN(valuenum) FROM labevents WHERE itemid = 50912", 'full'),
+    # Two sharded sources
+    ("SELECT COUNT(*) FROM labevents JOIN admissions ON labevents.hadm_id = admissions.hadm_id", 'full'),
+]
+
+@pytest.mark.parametrize("sql", ROUTED)
+def test_routes_pinned_queries(sql):
+    assert plan_query(sql, MANIFEST) == {'kind': 'route', 'shard': SHARD}
+
+def test_replicated_only_goes_to_first_shard():
+    assert plan_query("SELECT label FROM d_labitems WHERE itemid = 50912", MANIFEST) == {'kind': 'route', 'shard': 0}
+
+@pytest.mark.parametrize("sql, kind", NOT_ROUTED)
+def test_plan_kind(sql, kind):
+    plan = plan_query(sql, MANIFEST)
+    assert plan['kind'] == kind
+    if kind == 'scatter_rows':
+        assert plan['sql'] == sql
+
+def test_avg_partials_and_merge():
+    sql = "SELECT AVG(valuenum) AS mean_value, COUNT(*), MAX(valuenum) FROM labevents WHERE itemid = 50912"
+    assert plan_query(sql, MANIFEST) == {
+        'kind': 'scatter_aggregate',
+        'sql': "SELECT TOTAL(valuenum) AS p0_sum, COUNT(valuenum) AS p0_count, COUNT(*) AS p1, MAX(valuenum) AS p2 "
+               "FROM labevents WHERE itemid = 50912",
+        'merge': 'SUM(p0_sum) / SUM(p0_count) AS "mean_value", SUM(p1) AS "COUNT(*)", MAX(p2) AS "MAX(valuenum)"'
+    }
+
+@pytest.mark.parametrize("shard_values", [
+    [[1.0, 2.0, None], [4.0], []],
+    [[None], [None, None], []],
+])
+def test_avg_merge_matches_full_scan(shard_values):
+    """Partials run per shard and merged give what AVG over all rows gives, NULLs and empty shards included"""
+    sql = "SELECT AVG(valuenum) FROM labevents WHERE itemid = 50912"
+    plan = plan_query(sql, MANIFEST)
+    columns, rows = None, []
+    everything = sqlite3.connect(':memory:')
+    everything.execute("CREATE TABLE labevents (itemid INTEGER, valuenum REAL)")
+    for values in shard_values:
+        shard = sqlite3.connect(':memory:')
+        shard.execute("CREATE TABLE labevents (itemid INTEGER, valuenum REAL)")
+        for conn in (shard, everything):
+            conn.executemany("INSERT INTO labevents VALUES (50912, ?)", [(value,) for value in values])
+        cursor = shard.execute(plan['sql'])
+        columns = [column[0] for column in cursor.description]
+        rows += cursor.fetchall()
+    merged = _merge_aggregates(columns, rows, plan['merge'])
+    expected = everything.execute(sql).fetchone()[0]
+    assert list(merged.columns) == ['AVG(valuenum)']
+    if expected is None:
+        assert pd.isna(merged.iloc[0, 0])
+    else:
+        assert merged.iloc[0, 0] == pytest.approx(expected)
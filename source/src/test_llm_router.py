@@ -0,0 +1,88 @@
+import sqlite3
+import pytest
+import main
+from llm_backend import StubBackend
+from llm_router import LLMRouter
+from metrics import PipelineMetrics
+from schema_catalog import build_catalog
+
+QUESTION = "How many patients are in the database?"
+GOOD_SQL = "SELECT COUNT(*) AS patients FROM patients"
+
+# (top_score, template_margin, question_words, abstain_margin) -> expected route
+ROUTING_CASES = [
+    ((0.95, 0.10, 8, 5.0), 'fast'),
+    ((0.95, None, 8, None), 'fast'),
+    ((0.79, 0.10, 8, 5.0), 'strong'),      # nearest example too far
+    ((None, None, 8, 5.0), 'strong'),      # no dense score (BM25 retrieval)
+    ((0.95, 0.01, 8, 5.0), 'strong'),      # two templates about as close
+    ((0.95, 0.10, 31, 5.0), 'strong'),     # long question
+    ((0.95, 0.10, 8, 1.0), 'strong'),      # barely medical
+]
+
+def make_router(fast_sql, metrics):
+    fast = StubBackend(lambda prompt: fast_sql, model_name='fast')
+    strong = StubBackend(lambda prompt: GOOD_SQL, model_name='strong')
+    return LLMRouter(fast, strong, metrics=metrics)
+
+@pytest.mark.parametrize("signals, route", ROUTING_CASES)
+def test_choose(signals, route):
+    top_score, template_margin, question_words, abstain_margin = signals
+    router = make_router(GOOD_SQL, PipelineMetrics())
+    assert router.choose({'top_score': top_score, 'template_margin': template_margin,
+                          'question_words': question_words, 'abstain_margin': abstain_margin}) == route
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    """A two-patient database, its schema catalog, and retrieval that makes every question easy"""
+    db_path = str(tmp_path / "test.sqlite")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE patients (subject_id INTEGER PRIMARY KEY, gender TEXT)")
+    conn.executemany("INSERT INTO patients VALUES (?, ?)", [(1, 'F'), (2, 'M')])
+    conn.commit()
+    conn.close()
+    ddl = tmp_path / "schema.sql"
+    ddl.write_text("CREATE TABLE patients (\n    subject_id INTEGER PRIMARY KEY,\n    gender TEXT\n);\n")
+    build_catalog(str(ddl), cache_dir=str(tmp_path))
+    search_results = {
+        'schema_results': [{'table_name': 'patients', 'column_name': 'subject_id', 'column_type': 'INTEGER'}],
+        'train_results': [{'question': QUESTION, 'query': GOOD_SQL, 'score': 0.97},
+                          {'question': "How many admissions are there?", 'query': "SELECT COUNT(*) FROM admissions",
+                           'score': 0.60}]
+    }
+    monkeypatch.setattr(main, 'search_context', lambda *args, **kwargs: search_results)
+    monkeypatch.setattr(main, 'medical_relevance', lambda query_text: (10.0, 1.0))
+    return str(tmp_path), db_path
+
+def run(pipeline, router, metrics, validate=True):
+    vector_db_dir, db_path = pipeline
+    return main.process_user_query(QUESTION, None, vector_db_dir=vector_db_dir, db_path=db_path, metrics=metrics,
+                                   query_embedding=[0.0], concurrent=False, validate=validate, router=router)
+
+def test_fast_route_answers_easy_question(pipeline):
+    metrics = PipelineMetrics()
+    router = make_router(GOOD_SQL, metrics)
+    result = run(pipeline, router, metrics)
+    assert (result['route'], result['escalated'], result['execution_success']) == ('fast', False, True)
+    assert result['data']['patients'].tolist() == [2]
+    assert router.summary()['strong']['calls'] == 0
+
+@pytest.mark.parametrize("fast_sql, validate, stage", [
+    ("SELECT no_such_column FROM patients", True, 'validation'),
+    ("SELECT COUNT(*) FROM no_such_table", False, 'execution'),
+])
+def test_fast_failure_escalates_to_strong(pipeline, fast_sql, validate, stage):
+    metrics = PipelineMetrics()
+    router = make_router(fast_sql, metrics)
+    result = run(pipeline, router, metrics, validate=validate)
+    assert (result['route'], result['escalated'], result['execution_success']) == ('strong', True, True), stage
+    assert result['sql_query'] == GOOD_SQL
+    assert result['data']['patients'].tolist() == [2]
+    summary = router.summary()
+    assert (summary['fast']['calls'], summary['fast']['escalations'], summary['fast']['successes']) == (1, 1, 0)
+    assert (summary['strong']['calls'], summary['strong']['successes']) == (1, 1)
+    stages = metrics.summary()
+    assert 'escalate' in stages
+    if validate:
+        # Both answers were validated; the fast one was escalated, not repaired
+        assert stages['validate']['count'] == 2 and 'repair' not in stages
@@ -0,0 +1,76 @@
+import sqlite3
+import pytest
+from sql_rewrite import rewrite_sargable
+
+TIME_COLUMNS = frozenset({'charttime'})
+WHERE = "SELECT * FROM t WHERE "
+
+# (format, literal, operator) -> rewritten predicate
+PREFIX_CASES = [
+    ('%Y', '2100', '=', "(charttime >= '2100-01-01 00:00:00' AND charttime < '2101-01-01 00:00:00')"),
+    ('%Y', '2100', '<', "charttime < '2100-01-01 00:00:00'"),
+    ('%Y', '2100', '<=', "charttime < '2101-01-01 00:00:00'"),
+    ('%Y', '2100', '>', "charttime >= '2101-01-01 00:00:00'"),
+    ('%Y', '2100', '>=', "charttime >= '2100-01-01 00:00:00'"),
+    # 2100 is not a leap year
+    ('%Y-%m', '2100-02', '=', "(charttime >= '2100-02-01 00:00:00' AND charttime < '2100-03-01 00:00:00')"),
+    ('%Y-%m', '2100-02', '<', "charttime < '2100-02-01 00:00:00'"),
+    ('%Y-%m', '2100-02', '<=', "charttime < '2100-03-01 00:00:00'"),
+    ('%Y-%m', '2100-02', '>', "charttime >= '2100-03-01 00:00:00'"),
+    ('%Y-%m', '2100-02', '>=', "charttime >= '2100-02-01 00:00:00'"),
+    ('%Y-%m', '2100-12', '=', "(charttime >= '2100-12-01 00:00:00' AND charttime < '2101-01-01 00:00:00')"),
+]
+
+UNTOUCHED = [
+    WHERE + "strftime('%Y', charttime) != '2100'",
+    WHERE + "strftime('%Y-%m', charttime) <> '2100-02'",
+    # Not prefixes of the timestamp
+    WHERE + "strftime('%m', charttime) = '02'",
+    WHERE + "strftime('%Y-%m-%d %H', charttime) = '2100-02-01 10'",
+    # Literal of the wrong shape, or a column not verified as canonical
+    WHERE + "strftime('%Y', charttime) = '21'",
+    WHERE + "strftime('%Y', storetime) = '2100'",
+    # Result column names would change
+    "SELECT strftime('%Y', charttime) = '2100' FROM t",
+    # Bounds that depend on another column cannot use the index
+    WHERE + "datetime(charttime, 'start of month') = datetime(a.admittime, 'start of month')",
+    # Units differ
+    WHERE + "datetime(charttime, 'start of year') = datetime(current_time, 'start of month', '-1 month')",
+]
+
+@pytest.mark.parametrize("fmt, literal, op, predicate", PREFIX_CASES)
+def test_prefix_bounds(fmt, literal, op, predicate):
+    assert rewrite_sargable(WHERE + f"strftime('{fmt}', charttime) {op} '{literal}'", TIME_COLUMNS) == \
+        (WHERE + predicate, 1)
+
+@pytest.mark.parametrize("sql", UNTOUCHED)
+def test_untouched(sql):
+    assert rewrite_sargable(sql, TIME_COLUMNS) == (sql, 0)
+
+def test_select_list_kept_where_rewritten():
+    sql = "SELECT strftime('%Y', charttime) = '2100' FROM t WHERE strftime('%Y', charttime) = '2100'"
+    assert rewrite_sargable(sql, TIME_COLUMNS) == (
+        "SELECT strftime('%Y', charttime) = '2100' FROM t "
+        "WHERE (charttime >= '2100-01-01 00:00:00' AND charttime < '2101-01-01 00:00:00')", 1)
+
+def test_start_of_constant_bound():
+    rhs = "datetime(current_time, 'start of year', '-1 year')"
+    sql = WHERE + f"datetime(charttime, 'start of year') = {rhs}"
+    assert rewrite_sargable(sql, TIME_COLUMNS) == (
+        WHERE + f"(charttime >= {rhs} AND charttime < datetime({rhs}, '+1 year'))", 1)
+
+def test_rewrites_select_the_same_rows():
+    """Every rewritten filter keeps exactly the rows of the original, NULLs and boundaries included"""
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE t (id INTEGER, charttime TEXT)")
+    times = [None, '2099-12-31 23:59:59', '2100-01-01 00:00:00', '2100-02-01 00:00:00', '2100-02-28 23:59:59',
+             '2100-03-01 00:00:00', '2100-12-31 23:59:59', '2101-01-01 00:00:00', '2007-06-15 12:00:00']
+    conn.executemany("INSERT INTO t VALUES (?, ?)", enumerate(times))
+    for fmt, literal, op, _ in PREFIX_CASES:
+        sql = f"SELECT id FROM t WHERE strftime('{fmt}', charttime) {op} '{literal}' ORDER BY id"
+        rewritten, count = rewrite_sargable(sql, TIME_COLUMNS)
+        assert count == 1
+        assert conn.execute(rewritten).fetchall() == conn.execute(sql).fetchall(), sql
+    sql = "SELECT id FROM t WHERE datetime(charttime, 'start of month') = datetime('2100-02-14', 'start of month')"
+    rewritten, count = rewrite_sargable(sql, TIME_COLUMNS)
+    assert count == 1 and conn.execute(rewritten).fetchall() == conn.execute(sql).fetchall() == [(3,), (4,)]
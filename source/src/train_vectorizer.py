@@ -3,7 +3,9 @@ import numpy as np
 import faiss
 import os
 import json
-from sentence_transformers import SentenceTransformer
+from mmap_store import write_faiss_index
+from embedding_store import encode_with_store
+from memory_profile import memory_stage
 
 def process_train_csv(csv_path):
     """Process training data from CSV file with question-query pairs"""
@@ -46,12 +48,13 @@ def process_train_csv(csv_path):
 def vectorize_training_data(csv_path, output_dir='vector_db', model_name='all-MiniLM-L6-v2'):
     """Vectorize training data and save to FAISS index"""
     # Process training data
-    records = process_train_csv(csv_path)
+    with memory_stage('train_records'):
+        records = process_train_csv(csv_path)
     
-    # Generate embeddings
-    model = SentenceTransformer(model_name)
+    # Generate embeddings (only texts missing from the embedding store are encoded)
     texts = [r['text_for_embedding'] for r in records]
-    embeddings = model.encode(texts, show_progress_bar=True)
+    with memory_stage('train_encode'):
+        embeddings = encode_with_store(texts, output_dir, 'train', model_name)
     
     # Normalize for cosine similarity
     faiss.normalize_L2(embeddings)
@@ -59,13 +62,15 @@ def vectorize_training_data(csv_path, output_dir='vector_db', model_name='all-Mi
     # Build FAISS index
     os.makedirs(output_dir, exist_ok=True)
     dimension = embeddings.shape[1]
-    index = faiss.IndexFlatIP(dimension)
-    index.add(embeddings)
+    with memory_stage('train_index'):
+        index = faiss.IndexFlatIP(dimension)
+        index.add(embeddings)
+        write_faiss_index(index, os.path.join(output_dir, "train_index.faiss"))
     
-    # Save index and metadata
-    faiss.write_index(index, os.path.join(output_dir, "train_index.faiss"))
-    metadata = pd.DataFrame(records)
-    metadata.to_csv(os.path.join(output_dir, "train_metadata.csv"), index=False)
+    # Save metadata
+    with memory_stage('train_metadata'):
+        metadata = pd.DataFrame(records)
+        metadata.to_csv(os.path.join(output_dir, "train_metadata.csv"), index=False)
     
     print(f"Training data vectorization complete: {len(records)} examples vectorized")
     return records, embeddings
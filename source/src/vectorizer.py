@@ -2,8 +2,9 @@ import pandas as pd
 import numpy as np
 import faiss
 import os
-from sentence_transformers import SentenceTransformer
 from typing import List, Dict, Any
+from mmap_store import write_faiss_index
+from embedding_store import encode_with_store
 
 def read_schema_excel(file_path: str) -> pd.DataFrame:
     df = pd.read_excel(file_path)
@@ -44,11 +45,9 @@ def preprocess_text(df: pd.DataFrame) -> List[Dict[str, Any]]:
         records.append(record)
     return records
 
-def generate_embeddings(records, model_name='all-MiniLM-L6-v2'):
-    model = SentenceTransformer(model_name)
+def generate_embeddings(records, model_name='all-MiniLM-L6-v2', output_dir='vector_db'):
     texts = [record['text_for_embedding'] for record in records]
-    embeddings = model.encode(texts, show_progress_bar=True)
-    return embeddings
+    return encode_with_store(texts, output_dir, 'schema', model_name)
 
 def build_faiss_index(embeddings, records, output_dir='vector_db'):
     os.makedirs(output_dir, exist_ok=True)
@@ -56,7 +55,7 @@ def build_faiss_index(embeddings, records, output_dir='vector_db'):
     dimension = embeddings.shape[1]
     index = faiss.IndexFlatIP(dimension)
     index.add(embeddings)
-    faiss.write_index(index, os.path.join(output_dir, "schema_index.faiss"))
+    write_faiss_index(index, os.path.join(output_dir, "schema_index.faiss"))
     metadata = pd.DataFrame(records)
     metadata.to_csv(os.path.join(output_dir, "schema_metadata.csv"), index=False)
     print(f"FAISS index and metadata saved to {output_dir}")
@@ -73,7 +72,7 @@ def vectorize_schema(excel_file, output_dir='vector_db', model_name='all-MiniLM-
     processed_records = preprocess_text(schema_df)
     
     print("Generating embeddings...")
-    embeddings = generate_embeddings(processed_records, model_name)
+    embeddings = generate_embeddings(processed_records, model_name, output_dir)
     
     print("Building FAISS index...")
     build_faiss_index(embeddings, processed_records, output_dir)